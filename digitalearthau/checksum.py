@@ -0,0 +1,577 @@
+"""
+Verify and generate package checksum files for datasets.
+
+Package checksum files are as written by eodatasets: a 'package.sha1' inside a dataset folder,
+or a '{name}.sha1' beside a single-file dataset.
+
+Files are hashed concurrently, and copies (see dea-move) are hashed as they're written, so each
+file is only read once.
+"""
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed, FIRST_COMPLETED
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+
+import click
+import structlog
+from boltons import fileutils
+from eodatasets3 import verify
+
+from digitalearthau import collections, uiutil
+from digitalearthau.paths import get_dataset_base_path, get_dataset_paths
+
+_LOG = structlog.get_logger()
+
+DEFAULT_HASH_WORKERS = 8
+
+# Large, page-aligned reads are far faster than small ones on Lustre.
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Largest chunk to hand to the kernel per copy_file_range()/sendfile() call.
+_KERNEL_CHUNK_SIZE = 1024 * 1024 * 1024
+
+
+class FileCheck(NamedTuple):
+    path: Path
+    expected_hash: Optional[str]
+    actual_hash: Optional[str]
+
+    @property
+    def passed(self) -> bool:
+        # A file with no expected checksum can't fail.
+        return self.expected_hash is None or self.expected_hash == self.actual_hash
+
+
+def package_checksum_path(dataset_path: Path) -> Path:
+    """
+    The checksum file for a dataset's base path.
+
+    >>> import tempfile
+    >>> tempdir = Path(tempfile.mkdtemp())
+    >>> package_checksum_path(tempdir).name == 'package.sha1'
+    True
+    >>> file_ = Path(tempfile.mktemp(suffix='-dataset-file.tif'))
+    >>> file_.open('a').close()
+    >>> file_chk = package_checksum_path(file_)
+    >>> str(file_chk).endswith('-dataset-file.tif.sha1')
+    True
+    >>> file_chk.parent == file_.parent
+    True
+    """
+    if dataset_path.is_dir():
+        return dataset_path.joinpath('package.sha1')
+
+    return dataset_path.parent.joinpath(dataset_path.name + '.sha1')
+
+
+def read_checksum_file(checksum_path: Path) -> Dict[Path, str]:
+    """
+    Read a checksum file, returning the expected hash of each (absolute) file path.
+    """
+    ch = verify.PackageChecksum()
+    ch.read(checksum_path)
+    return dict(ch.items())
+
+
+def _new_hash():
+    return hashlib.sha1()
+
+
+def hash_file(path: Path, buffer_size=COPY_BUFFER_SIZE) -> str:
+    """
+    Calculate the checksum of a file, in the same format as our checksum files.
+    """
+    h = _new_hash()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(str(path), 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+
+def _stream_copy(source: Path, destination: Path, buffer_size: int) -> str:
+    """Copy a file, hashing the bytes as they pass through"""
+    h = _new_hash()
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(str(source), 'rb', buffering=0) as src, open(str(destination), 'wb', buffering=0) as dst:
+        while True:
+            n = src.readinto(buffer)
+            if not n:
+                break
+            h.update(view[:n])
+            written = 0
+            while written < n:
+                written += dst.write(view[written:n])
+    return h.hexdigest()
+
+
+def _kernel_copy(source: Path, destination: Path, buffer_size: int) -> str:
+    """
+    Copy a file within the kernel, then hash what was written to the destination.
+
+    The source is only read by the kernel, and the hash verifies the bytes that actually landed.
+    """
+    with open(str(source), 'rb') as src, open(str(destination), 'wb') as dst:
+        remaining = os.fstat(src.fileno()).st_size
+        use_copy_range = hasattr(os, 'copy_file_range')
+        while remaining > 0:
+            chunk = min(remaining, _KERNEL_CHUNK_SIZE)
+            if use_copy_range:
+                try:
+                    copied = os.copy_file_range(src.fileno(), dst.fileno(), chunk)
+                except OSError:
+                    # Eg. unsupported across these filesystems.
+                    use_copy_range = False
+                    continue
+            else:
+                copied = os.sendfile(dst.fileno(), src.fileno(), None, chunk)
+            if copied == 0:
+                break
+            remaining -= copied
+        dst.flush()
+        os.fsync(dst.fileno())
+
+    return hash_file(destination, buffer_size=buffer_size)
+
+
+def copy_and_hash(source: Path, destination: Path, kernel_copy=False, buffer_size=COPY_BUFFER_SIZE) -> str:
+    """
+    Copy a file (with its permissions and times), returning the checksum of the copied bytes.
+    """
+    if kernel_copy:
+        digest = _kernel_copy(source, destination, buffer_size)
+    else:
+        digest = _stream_copy(source, destination, buffer_size)
+    shutil.copystat(str(source), str(destination))
+    return digest
+
+
+def _walk_tree(source_dir: Path) -> Iterable[Tuple[Path, Tuple[str, ...], List[str]]]:
+    """
+    Each directory in the tree, with its offset from the root and its file names.
+
+    Symlinks are followed, and their targets copied, as shutil.copytree does by default.
+    """
+    for dirpath, dirnames, filenames in os.walk(str(source_dir), followlinks=True):
+        dirnames.sort()
+        yield Path(dirpath), Path(dirpath).relative_to(source_dir).parts, sorted(filenames)
+
+
+def copy_tree_and_verify(source_dir: Path,
+                         dest_dir: Path,
+                         expected: Optional[Dict[Path, str]] = None,
+                         kernel_copy=False,
+                         log=_LOG) -> List[FileCheck]:
+    """
+    Copy a directory tree, checking each file against the expected checksums (keyed by absolute source path).
+
+    Returns the failed checks: empty if the copy is good. Files listed in the checksums but not found
+    in the source are failures too.
+    """
+    expected = expected or {}
+    failures = []
+    seen = set()
+
+    directories = []
+    for source_subdir, offset, filenames in _walk_tree(source_dir):
+        # Every directory is created, including empty ones. (Parents are always walked first)
+        dest_subdir = dest_dir.joinpath(*offset)
+        dest_subdir.mkdir(exist_ok=bool(offset))
+        directories.append((source_subdir, dest_subdir))
+
+        for name in filenames:
+            source_file = source_subdir.joinpath(name)
+            digest = copy_and_hash(source_file, dest_subdir.joinpath(name), kernel_copy=kernel_copy)
+            check = FileCheck(source_file, expected.get(source_file), digest)
+            seen.add(source_file)
+            if check.passed:
+                log.debug("checksum.pass", file=source_file)
+            else:
+                log.error("checksum.failure", file=source_file)
+                failures.append(check)
+
+    for path, hash_ in expected.items():
+        if path not in seen:
+            log.error("checksum.missing_file", file=path)
+            failures.append(FileCheck(path, hash_, None))
+
+    # Directory times are changed by the copy itself, so they're set afterwards.
+    for source_subdir, dest_subdir in directories:
+        shutil.copystat(str(source_subdir), str(dest_subdir))
+
+    return failures
+
+
+def copy_file_and_verify(source: Path,
+                         destination: Path,
+                         expected: Optional[Dict[Path, str]] = None,
+                         kernel_copy=False,
+                         log=_LOG) -> List[FileCheck]:
+    """
+    Copy a single file, checking it against the expected checksums (keyed by absolute source path).
+    """
+    digest = copy_and_hash(source, destination, kernel_copy=kernel_copy)
+    check = FileCheck(source, (expected or {}).get(source), digest)
+    if not check.passed:
+        log.error("checksum.failure", file=source)
+        return [check]
+    log.debug("checksum.pass", file=source)
+    return []
+
+
+def write_checksum_file(checksum_path: Path, hashes: Dict[Path, str]):
+    """
+    Write a checksum file for the given (absolute) file paths, in the same format as eodatasets.
+    """
+    with fileutils.atomic_save(str(checksum_path)) as f:
+        f.writelines(
+            '{}\t{}\n'.format(hash_, path.relative_to(checksum_path.parent).as_posix()).encode('utf-8')
+            for path, hash_ in sorted(hashes.items())
+        )
+
+
+class HashResult(NamedTuple):
+    path: Path
+    # None if the file doesn't exist.
+    hash: Optional[str]
+    size: int
+    # Was it from the cache, rather than read?
+    cached: bool
+
+
+class HashCache:
+    """
+    Previously calculated file hashes, reusable while a file's size and mtime haven't changed.
+
+    Stored as an append-only json-lines file.
+    """
+
+    def __init__(self, cache_path: Path) -> None:
+        self.cache_path = cache_path
+        self._entries = {}  # type: Dict[str, Tuple[int, float, str]]
+        self._lock = threading.Lock()
+
+        if cache_path.exists():
+            with cache_path.open('r') as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self._entries[entry['path']] = (entry['size'], entry['mtime'], entry['sha1'])
+        self._out = cache_path.open('a')
+
+    def get(self, path: Path, st: os.stat_result) -> Optional[str]:
+        entry = self._entries.get(str(path))
+        if entry is None:
+            return None
+        size, mtime, hash_ = entry
+        if size != st.st_size or mtime != st.st_mtime:
+            return None
+        return hash_
+
+    def add(self, path: Path, st: os.stat_result, hash_: str):
+        with self._lock:
+            self._entries[str(path)] = (st.st_size, st.st_mtime, hash_)
+            self._out.write(json.dumps(dict(path=str(path), size=st.st_size, mtime=st.st_mtime, sha1=hash_)) + '\n')
+
+    def close(self):
+        self._out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _hash_one(path: Path, cache: Optional[HashCache], buffer_size: int) -> HashResult:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return HashResult(path, None, 0, False)
+
+    if cache is not None:
+        hash_ = cache.get(path, st)
+        if hash_ is not None:
+            return HashResult(path, hash_, st.st_size, True)
+
+    hash_ = hash_file(path, buffer_size=buffer_size)
+    if cache is not None:
+        cache.add(path, st, hash_)
+    return HashResult(path, hash_, st.st_size, False)
+
+
+def hash_files(paths: Iterable[Path],
+               workers=DEFAULT_HASH_WORKERS,
+               cache: HashCache = None,
+               buffer_size=COPY_BUFFER_SIZE) -> Iterable[HashResult]:
+    """
+    Hash the given files concurrently, yielding results as they finish.
+
+    The input is consumed lazily, so only a few files per worker are in-flight at once.
+    """
+    max_in_flight = workers * 4
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = set()
+        for path in paths:
+            if len(in_flight) >= max_in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            in_flight.add(executor.submit(_hash_one, path, cache, buffer_size))
+
+        for future in as_completed(in_flight):
+            yield future.result()
+
+
+def verify_files(expected: Dict[Path, str],
+                 workers=DEFAULT_HASH_WORKERS,
+                 cache: HashCache = None,
+                 log=_LOG) -> List[FileCheck]:
+    """
+    Check the given files against their expected hashes, returning any failures.
+    """
+    failures = []
+    for result in hash_files(expected.keys(), workers=workers, cache=cache):
+        check = FileCheck(result.path, expected[result.path], result.hash)
+        if check.passed:
+            log.debug("checksum.pass", file=result.path)
+        else:
+            log.error("checksum.failure", file=result.path)
+            failures.append(check)
+    return failures
+
+
+class Throughput:
+    """
+    Running totals for a checksum run.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start_time = time.time()
+        self.end_time = None  # type: Optional[float]
+
+        self.dataset_count = 0
+        self.missing_manifest_count = 0
+        self.file_count = 0
+        self.failure_count = 0
+        self.read_bytes = 0
+        self.cached_bytes = 0
+
+    def add(self, result: HashResult):
+        self.file_count += 1
+        if result.cached:
+            self.cached_bytes += result.size
+        else:
+            self.read_bytes += result.size
+
+    def finish(self):
+        self.end_time = time.time()
+
+    def report(self) -> str:
+        secs = (self.end_time or time.time()) - self.start_time
+        mb_per_sec = (self.read_bytes / 1024 / 1024) / secs if secs else 0
+        return (
+            f"{self.name}: {self.dataset_count} datasets, {self.file_count} files, "
+            f"{self.failure_count} failed, {self.missing_manifest_count} without checksums. "
+            f"Read {self.read_bytes / 1024 ** 3:.2f}GiB ({self.cached_bytes / 1024 ** 3:.2f}GiB cached) "
+            f"in {secs:.0f}s: {mb_per_sec:.1f}MiB/s"
+        )
+
+
+def _iter_collection_datasets(collection: collections.Collection, within: Optional[Path]) -> Iterable[Path]:
+    if within:
+        return collection.iter_fs_paths_within(within)
+    return collection.iter_fs_paths()
+
+
+def verify_datasets(metadata_paths: Iterable[Path],
+                    stats: Throughput,
+                    workers=DEFAULT_HASH_WORKERS,
+                    cache: HashCache = None,
+                    log=_LOG) -> Throughput:
+    """
+    Verify each dataset's files against its checksum file.
+    """
+    # Expected hashes of files that have been queued for hashing
+    expected = {}  # type: Dict[Path, str]
+
+    def queue_files():
+        for metadata_path in metadata_paths:
+            checksum_path = package_checksum_path(get_dataset_base_path(metadata_path))
+            if not checksum_path.exists():
+                log.warning("checksum.missing", checksum_file=checksum_path)
+                stats.missing_manifest_count += 1
+                continue
+
+            stats.dataset_count += 1
+            for path, hash_ in read_checksum_file(checksum_path).items():
+                expected[path] = hash_
+                yield path
+
+    for result in hash_files(queue_files(), workers=workers, cache=cache):
+        stats.add(result)
+        expected_hash = expected.pop(result.path)
+        if result.hash is None:
+            log.error("checksum.missing_file", file=result.path)
+            stats.failure_count += 1
+        elif result.hash != expected_hash:
+            log.error("checksum.failure", file=result.path)
+            stats.failure_count += 1
+        else:
+            log.debug("checksum.pass", file=result.path)
+
+    return stats
+
+
+def generate_checksums(metadata_paths: Iterable[Path],
+                       stats: Throughput,
+                       workers=DEFAULT_HASH_WORKERS,
+                       cache: HashCache = None,
+                       force=False,
+                       dry_run=False,
+                       log=_LOG) -> Throughput:
+    """
+    Write a checksum file for each dataset that doesn't have one (or all datasets, if forced).
+    """
+    # For each checksum file being built: the count of files remaining, and the hashes so far.
+    pending = {}  # type: Dict[Path, Tuple[int, Dict[Path, str]]]
+    file_owners = {}  # type: Dict[Path, Path]
+    # Checksum files with a file that couldn't be read.
+    failed = set()  # type: Set[Path]
+
+    def queue_files():
+        for metadata_path in metadata_paths:
+            base_path, all_files = get_dataset_paths(metadata_path)
+            checksum_path = package_checksum_path(base_path)
+            if checksum_path.exists() and not force:
+                continue
+
+            files = [f for f in all_files if f != checksum_path]
+            if not files:
+                continue
+
+            stats.dataset_count += 1
+            pending[checksum_path] = (len(files), {})
+            for f in files:
+                file_owners[f] = checksum_path
+                yield f
+
+    for result in hash_files(queue_files(), workers=workers, cache=cache):
+        stats.add(result)
+        checksum_path = file_owners.pop(result.path)
+        remaining, hashes = pending[checksum_path]
+        remaining -= 1
+        pending[checksum_path] = (remaining, hashes)
+
+        if result.hash is None:
+            log.error("checksum.missing_file", file=result.path)
+            stats.failure_count += 1
+            failed.add(checksum_path)
+        else:
+            hashes[result.path] = result.hash
+
+        if remaining == 0:
+            del pending[checksum_path]
+            # Don't write a partial checksum file if a file disappeared underneath us.
+            if checksum_path in failed:
+                failed.remove(checksum_path)
+                continue
+
+            log.info("checksum.write", checksum_file=checksum_path, file_count=len(hashes), dry_run=dry_run)
+            if not dry_run:
+                write_checksum_file(checksum_path, hashes)
+
+    return stats
+
+
+def _run_for_collections(collection_names, within, cache_path, run):
+    uiutil.init_logging()
+    collections.init_nci_collections(None)
+
+    selected = []
+    for name in collection_names:
+        collection = collections.get_collection(name)
+        if collection is None:
+            raise click.BadParameter(f"Unknown collection {name!r}", param_hint='COLLECTION_NAMES')
+        selected.append(collection)
+
+    reports = []
+    cache = HashCache(Path(cache_path)) if cache_path else None
+    try:
+        for collection in selected:
+            stats = Throughput(collection.name)
+            run(_iter_collection_datasets(collection, Path(within).absolute() if within else None), stats, cache)
+            stats.finish()
+            reports.append(stats)
+    finally:
+        if cache:
+            cache.close()
+
+    for stats in reports:
+        click.echo(stats.report(), err=True)
+
+    if any(stats.failure_count for stats in reports):
+        sys.exit(1)
+
+
+@click.group(help=__doc__)
+def cli():
+    pass
+
+
+_WORKERS_OPTION = click.option('--workers', '-j', type=int, default=DEFAULT_HASH_WORKERS, show_default=True,
+                               help="Number of files to hash at once")
+_CACHE_OPTION = click.option('--cache', 'cache_path', type=click.Path(dir_okay=False, writable=True),
+                             help="File of previously calculated hashes, reused for unchanged files")
+_WITHIN_OPTION = click.option('--within', type=click.Path(exists=True, file_okay=False),
+                              help="Only datasets within this folder")
+
+
+@cli.command('verify')
+@_WORKERS_OPTION
+@_CACHE_OPTION
+@_WITHIN_OPTION
+@click.argument('collection_names', nargs=-1, required=True)
+def verify_cmd(workers: int, cache_path: str, within: str, collection_names: List[str]):
+    """
+    Verify the files of all datasets in the given collections against their checksum files.
+    """
+    def run(metadata_paths, stats, cache):
+        verify_datasets(metadata_paths, stats, workers=workers, cache=cache)
+
+    _run_for_collections(collection_names, within, cache_path, run)
+
+
+@cli.command('generate')
+@_WORKERS_OPTION
+@_CACHE_OPTION
+@_WITHIN_OPTION
+@click.option('--force', is_flag=True, default=False,
+              help="Replace existing checksum files")
+@click.option('--dry-run', is_flag=True, default=False)
+@click.argument('collection_names', nargs=-1, required=True)
+def generate_cmd(workers: int, cache_path: str, within: str, force: bool, dry_run: bool,
+                 collection_names: List[str]):
+    """
+    Write checksum files for datasets in the given collections that don't have them (eg. ingested NetCDFs)
+    """
+    def run(metadata_paths, stats, cache):
+        generate_checksums(metadata_paths, stats, workers=workers, cache=cache, force=force, dry_run=dry_run)
+
+    _run_for_collections(collection_names, within, cache_path, run)
+
+
+if __name__ == '__main__':
+    cli()
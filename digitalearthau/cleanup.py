@@ -5,20 +5,23 @@ On a clean-up, a dataset is moved to a `.trash` folder, and its
 reference is removed from the index.
 """
 import sys
+import uuid
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterable, List, Optional, Set, Tuple
 
 import click
 import structlog
 from click import echo, style
-from sqlalchemy import select, and_
+from sqlalchemy import select, and_, func, cast, String
 
 from datacube.index import Index
 from datacube.drivers.postgres import _api as pgapi
 from datacube.ui import click as ui
 from datacube.utils import uri_to_local_path
 from digitalearthau import paths, uiutil
+from digitalearthau.index import BatchedIndexWriter
 from dateutil import tz
 
 
@@ -36,6 +39,10 @@ def cli():
 @click.option('--dry-run',
               is_flag=True,
               help="Don't make any changes (ie. don't trash anything)")
+@click.option('--jobs', '-j',
+              type=int,
+              default=1,
+              help="Number of locations to check and trash at once")
 @ui.pass_index()
 @click.argument('files',
                 type=click.Path(exists=True, readable=True),
@@ -43,7 +50,8 @@ def cli():
 def archived(index: Index,
              dry_run: bool,
              files: List[str],
-             min_trash_age_hours: int):
+             min_trash_age_hours: int,
+             jobs: int):
     """
     Clean-up archived locations.
 
@@ -60,7 +68,8 @@ def archived(index: Index,
     uiutil.init_logging(work_path.joinpath('log.jsonl').open('a'))
     log = structlog.getLogger("cleanup-archived")
 
-    log.info("cleanup.start", dry_run=dry_run, input_paths=files, min_trash_age_hours=min_trash_age_hours)
+    log.info("cleanup.start", dry_run=dry_run, input_paths=files, min_trash_age_hours=min_trash_age_hours,
+             jobs=jobs)
     echo(f"Logging to {work_path}", err=True)
 
     for input_file in files:
@@ -69,7 +78,8 @@ def archived(index: Index,
             index,
             Path(input_file).absolute().as_uri(),
             min_trash_age_hours,
-            log
+            log,
+            jobs=jobs,
         )
         total_count += count
         total_trash_count += trash_count
@@ -78,103 +88,192 @@ def archived(index: Index,
     echo(f"Finished; {total_trash_count} trashed.", err=True)
 
 
+# How many candidate locations to check against the index at once.
+_CANDIDATE_BATCH_SIZE = 1000
+
+
 def _cleanup_uri(dry_run: bool,
                  index: Index,
                  input_uri: str,
                  min_trash_age_hours: int,
-                 log):
+                 log,
+                 jobs: int = 1):
     trash_count = 0
 
     latest_time_to_archive = _as_utc(datetime.utcnow()) - timedelta(hours=min_trash_age_hours)
 
     echo(f"Cleaning {'(dry run) ' if dry_run else ''}{style(input_uri, bold=True)}", err=True)
 
-    locations = _get_archived_locations_within(index, latest_time_to_archive, input_uri)
-    echo(f"  {len(locations)} locations archived more than {min_trash_age_hours}hr ago", err=True)
-    with click.progressbar(locations,
-                           # stderr should be used for runtime information, not stdout
-                           file=sys.stderr) as location_iter:
-        for uri in location_iter:
-            log = log.bind(uri=uri)
-            local_path = uri_to_local_path(uri)
-            if not local_path.exists():
-                # An index record exists, but the file isn't on the disk.
-                # We won't remove the record from the index: maybe the filesystem is temporarily unmounted?
-                log.warning('location.not_exist')
-                continue
-
-            # Multiple datasets can point to the same location (eg. a stacked file).
-            indexed_datasets = set(index.datasets.get_datasets_for_location(uri))
-
-            # Check that there's no other active locations for this dataset.
-            active_dataset = _get_dataset_where_active(uri, indexed_datasets)
-            if active_dataset:
-                log.info("location.has_active", active_dataset_id=active_dataset.id)
-                continue
-
-            # Are there any dataset ids in the file that we haven't indexed? Skip it.
-            unindexed_ids = get_unknown_dataset_ids(index, uri)
-            if unindexed_ids:
-                log.info('location.has_unknown', unknown_dataset_ids=unindexed_ids)
-                continue
-
-            was_trashed = paths.trash_uri(uri, dry_run=dry_run, log=log)
-            if not dry_run:
-                for dataset in indexed_datasets:
-                    index.datasets.remove_location(dataset.id, uri)
-
-            if was_trashed:
-                trash_count += 1
-
-            log = log.unbind('uri')
-    return len(locations), trash_count
+    # In parallel mode, workers do the filesystem work while index changes are batched here.
+    # Otherwise each location's changes are applied as soon as it's trashed.
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    # Dataset ids are read in separate processes: NetCDF (HDF5) reads aren't thread-safe.
+    reader = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    index_writer = BatchedIndexWriter(index, batch_size=1 if executor is None else 500, dry_run=dry_run, log=log)
+
+    # pylint: disable=protected-access
+    with index.datasets._db.begin() as db, index_writer:
+        query = _archived_locations_query(latest_time_to_archive, input_uri)
+        location_count = _count_rows(db, query)
+        echo(f"  {location_count} locations archived more than {min_trash_age_hours}hr ago", err=True)
+
+        # Stream the candidates with a server-side cursor, rather than loading them all.
+        locations = db._connection.execution_options(stream_results=True).execute(query)
+        try:
+            with click.progressbar(locations,
+                                   length=location_count,
+                                   # stderr should be used for runtime information, not stdout
+                                   file=sys.stderr) as location_iter:
+                for batch in _batches(location_iter, _CANDIDATE_BATCH_SIZE):
+                    trash_count += _cleanup_locations(db, dry_run, batch, index_writer, log,
+                                                      executor=executor, reader=reader, jobs=jobs)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+            if reader is not None:
+                reader.shutdown()
+
+    return location_count, trash_count
+
+
+def _cleanup_locations(db,
+                       dry_run: bool,
+                       locations: List[Tuple[str, List[uuid.UUID]]],
+                       index_writer: BatchedIndexWriter,
+                       log,
+                       executor: ThreadPoolExecutor = None,
+                       reader: Executor = None,
+                       jobs: int = 1) -> int:
+    """
+    Trash the given archived locations, skipping any with unknown datasets inside.
+
+    The index has already established that they're eligible: all datasets at each location have archived it.
+    """
+    # Read the dataset ids inside each location that's on disk.
+    uris = [uri for uri, _ in locations]
+    if reader is None:
+        location_ids = map(_read_location_ids, uris)
+    else:
+        location_ids = reader.map(_read_location_ids, uris, chunksize=max(1, len(uris) // (jobs * 4)))
+
+    on_disk = []
+    for (uri, dataset_ids), file_ids in zip(locations, location_ids):
+        if file_ids is None:
+            # An index record exists, but the file isn't on the disk.
+            # We won't remove the record from the index: maybe the filesystem is temporarily unmounted?
+            log.warning('location.not_exist', uri=uri)
+            continue
+        on_disk.append((uri, dataset_ids, file_ids))
+
+    known_ids = _get_known_dataset_ids(db, set().union(*(file_ids for _, _, file_ids in on_disk)))
+
+    to_trash = []
+    for uri, dataset_ids, file_ids in on_disk:
+        # Are there any dataset ids in the file that we haven't indexed? Skip it.
+        unindexed_ids = file_ids - known_ids
+        if unindexed_ids:
+            log.info('location.has_unknown', uri=uri, unknown_dataset_ids=unindexed_ids)
+            continue
+        to_trash.append((uri, dataset_ids))
+
+    if executor is None:
+        was_trashed = {uri: paths.trash_uri(uri, dry_run=dry_run, log=log.bind(uri=uri)) for uri, _ in to_trash}
+    else:
+        was_trashed = paths.trash_uris((uri for uri, _ in to_trash),
+                                       dry_run=dry_run, log=log, workers=jobs)
+
+    trash_count = 0
+    for uri, dataset_ids in to_trash:
+        if was_trashed[uri]:
+            trash_count += 1
+        elif uri_to_local_path(uri).exists():
+            # The move failed (and was logged): it's still there, so keep its location in the index.
+            continue
+
+        for dataset_id in dataset_ids:
+            index_writer.remove_location(dataset_id, uri)
+
+    return trash_count
+
+
+def _read_location_ids(uri: str) -> Optional[Set[uuid.UUID]]:
+    """The dataset ids within the given location, or None if it's not on disk"""
+    local_path = uri_to_local_path(uri)
+    if not local_path.exists():
+        return None
+    return set(paths.get_path_dataset_ids(local_path))
 
 
 def get_unknown_dataset_ids(index, uri):
     """Get ids of datasets in the file that have never been indexed"""
     on_disk_dataset_ids = set(paths.get_path_dataset_ids(uri_to_local_path(uri)))
-    unknown_ids = set()
-    for dataset_id in on_disk_dataset_ids:
-        if not index.datasets.has(dataset_id):
-            unknown_ids.add(dataset_id)
-
-    return unknown_ids
+    # pylint: disable=protected-access
+    with index.datasets._db.begin() as db:
+        return on_disk_dataset_ids - _get_known_dataset_ids(db, on_disk_dataset_ids)
 
 
 # TODO: expand api to support this?
 # pylint: disable=protected-access
-def _get_archived_locations_within(index, latest_time_to_archive, uri) -> set:
+def _archived_locations_query(latest_time_to_archive, uri):
+    """
+    Locations within the uri that are eligible for cleanup: every dataset at the location
+    has archived it, at least one of them before the given time.
+
+    Returns rows of (uri, [dataset ids]).
+    """
     assert uri.startswith('file:')
 
     scheme, body = pgapi._split_uri(uri)
-
-    with index.datasets._db.begin() as db:
-        locations = set(
-            uri for (uri,) in
-            db._connection.execute(
-                select(
-                    [pgapi._dataset_uri_field(pgapi.DATASET_LOCATION)]
-                ).select_from(
-                    pgapi.DATASET.join(pgapi.DATASET_LOCATION)
-                ).where(
-                    and_(
-                        pgapi.DATASET_LOCATION.c.archived != None,
-                        pgapi.DATASET_LOCATION.c.uri_scheme == 'file',
-                        pgapi.DATASET_LOCATION.c.uri_body.like(body + '%'),
-                        pgapi.DATASET_LOCATION.c.archived < latest_time_to_archive
-                    )
-                )
-            )
+    location = pgapi.DATASET_LOCATION
+
+    return select(
+        [
+            pgapi._dataset_uri_field(location),
+            func.array_agg(cast(location.c.dataset_ref, String)),
+        ]
+    ).where(
+        and_(
+            location.c.uri_scheme == 'file',
+            location.c.uri_body.like(body + '%'),
+        )
+    ).group_by(
+        location.c.uri_scheme, location.c.uri_body
+    ).having(
+        and_(
+            # No datasets still use this location
+            func.bool_and(location.c.archived != None),
+            func.bool_or(location.c.archived < latest_time_to_archive),
         )
+    )
+
 
-    return locations
+def _count_rows(db, query) -> int:
+    return db._connection.execute(
+        select([func.count()]).select_from(query.alias())
+    ).scalar()
 
 
-def _get_dataset_where_active(uri, datasets):
-    for d in datasets:
-        if uri in d.uris:
-            return d
-    return None
+def _get_known_dataset_ids(db, dataset_ids: Set[uuid.UUID]) -> Set[uuid.UUID]:
+    """Which of the given dataset ids are in the index?"""
+    if not dataset_ids:
+        return set()
+
+    return set(
+        id_ for (id_,) in db._connection.execute(
+            select([pgapi.DATASET.c.id]).where(pgapi.DATASET.c.id.in_(list(dataset_ids)))
+        )
+    )
+
+
+def _batches(rows, batch_size: int) -> Iterable[List[Tuple[str, List[uuid.UUID]]]]:
+    batch = []
+    for uri, dataset_refs in rows:
+        batch.append((uri, [uuid.UUID(ref) for ref in dataset_refs]))
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def _as_utc(d):
@@ -1,14 +1,27 @@
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import Dict, Iterable, List, NamedTuple, Optional
+
 import click
 import structlog
-import collections
+from dateutil import tz
+from sqlalchemy import and_, exists, func
+from sqlalchemy.sql import Select
 
 from datacube import Datacube
-from datacube.model import Dataset
+from datacube.drivers.postgres import _api as pgapi
+from datacube.index import Index, fields
+from datacube.model import Dataset, DatasetType, Range
 from datacube.ui import click as ui
 from digitalearthau import uiutil
+from digitalearthau.lineage import LineageGraph, load_product_lineage
 
 _LOG = structlog.getLogger('archive-locationless')
-_siblings_count = 0
+
+# How many locationless datasets to archive in each index call.
+ARCHIVE_BATCH_SIZE = 1000
 
 
 @click.command()
@@ -35,9 +48,13 @@ _siblings_count = 0
 @click.option('--test-dc-config', '-C',
               default=None,
               help='Custom datacube config file (testing purpose only)')
+@click.option('--jobs', '-j',
+              type=int,
+              default=1,
+              help="Split the query's time range into this many partitions, and check them in parallel")
 @ui.parsed_search_expressions
 def main(expressions, check_locationless, archive_locationless, check_ancestors, check_siblings, archive_siblings,
-         test_dc_config):
+         test_dc_config, jobs):
     """
     Find problem datasets using the index.
 
@@ -53,42 +70,225 @@ def main(expressions, check_locationless, archive_locationless, check_ancestors,
     TODO: This could be merged into it as a post-processing step, although it's less safe than sync if
     TODO: the index is being updated concurrently by another
     """
-    global _siblings_count
     uiutil.init_logging()
-    with Datacube(config=test_dc_config) as dc:
-        _LOG.info('query', query=expressions)
-        count = 0
-        archive_count = 0
-        locationless_count = 0
-        for dataset in dc.index.datasets.search(**expressions):
-            count += 1
-            # Archive if it has no locations.
-            # (the sync tool removes locations that don't exist anymore on disk,
-            # but can't archive datasets as another path may be added later during the sync)
-            if check_locationless or archive_locationless:
-                if dataset.uris is not None and len(dataset.uris) == 0:
-                    locationless_count += 1
-
-                    if archive_locationless:
-                        dc.index.datasets.archive([dataset.id])
-                        archive_count += 1
-                        _LOG.info("locationless_dataset_id.archived", dataset_id=str(dataset.id))
-                    else:
-                        _LOG.info("locationless_dataset_id", dataset_id=str(dataset.id))
-
-            # If an ancestor is archived, it may have been replaced. This one may need
-            # to be reprocessed too.
-            if check_ancestors or archive_siblings or check_siblings:
-                archive_count += _check_ancestors(check_ancestors, check_siblings, archive_siblings, dc, dataset)
-
-        _LOG.info("coherence.finish",
-                  datasets_count=count,
-                  locationless_count=locationless_count,
-                  siblings_count=_siblings_count,
-                  archived_count=archive_count)
-
-
-def _archive_duplicate_siblings(dc, ids):
+    _LOG.info('query', query=expressions)
+
+    checks = Checks(
+        check_locationless=check_locationless,
+        archive_locationless=archive_locationless,
+        check_ancestors=check_ancestors,
+        check_siblings=check_siblings,
+        archive_siblings=archive_siblings,
+    )
+    partitions = partition_by_time(expressions, jobs)
+
+    if len(partitions) == 1:
+        if jobs > 1:
+            _LOG.warning('partitions.no_time_range', message="Query has no time range to split: running serially")
+        counts = _check_partition(test_dc_config, checks, partitions[0])
+    else:
+        _LOG.info('partitions', partition_count=len(partitions),
+                  partitions=[p.expressions['time'] for p in partitions])
+        # Each worker opens its own index connection.
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            counts = sum(
+                executor.map(partial(_check_partition, test_dc_config, checks), partitions),
+                CoherenceCounts()
+            )
+
+    _LOG.info("coherence.finish",
+              datasets_count=counts.dataset_count,
+              locationless_count=counts.locationless_count,
+              siblings_count=counts.siblings_count,
+              archived_count=counts.archived_count)
+
+
+class Checks(NamedTuple):
+    """Which checks to run"""
+    check_locationless: bool = False
+    archive_locationless: bool = False
+    check_ancestors: bool = False
+    check_siblings: bool = False
+    archive_siblings: bool = False
+
+
+class CoherenceCounts(NamedTuple):
+    """Totals of what was found. Counts of separate partitions can be added together"""
+    dataset_count: int = 0
+    locationless_count: int = 0
+    siblings_count: int = 0
+    archived_count: int = 0
+
+    def __add__(self, other: 'CoherenceCounts') -> 'CoherenceCounts':
+        return CoherenceCounts(*(a + b for a, b in zip(self, other)))
+
+
+class Partition(NamedTuple):
+    """
+    A search, and the range of dataset start times that it is responsible for.
+
+    Searching by time returns any dataset that overlaps the time range, so neighbouring partitions'
+    searches can return the same dataset. Only the partition that owns the dataset's start time
+    checks it: [owned_begin, owned_end), where None is unbounded.
+    """
+    expressions: dict
+    owned_begin: Optional[datetime] = None
+    owned_end: Optional[datetime] = None
+
+    def owns(self, dataset_begin: Optional[datetime]) -> bool:
+        if dataset_begin is None:
+            # No time to partition by: the first partition checks it.
+            return self.owned_begin is None
+        dataset_begin = _as_utc(dataset_begin)
+        if self.owned_begin is not None and dataset_begin < self.owned_begin:
+            return False
+        if self.owned_end is not None and dataset_begin >= self.owned_end:
+            return False
+        return True
+
+
+def partition_by_time(expressions: dict, count: int) -> List[Partition]:
+    """
+    Split the query's time range into equal partitions.
+
+    A query without a time range can't be split, and is returned as a single partition.
+
+    >>> [p.owned_begin for p in partition_by_time({'time': Range(datetime(2017, 1, 1), datetime(2017, 1, 3))}, 2)]
+    [None, datetime.datetime(2017, 1, 2, 0, 0, tzinfo=tzutc())]
+    >>> [p.expressions for p in partition_by_time({'product': 'ls8_nbar_albers'}, 2)]
+    [{'product': 'ls8_nbar_albers'}]
+    """
+    time = expressions.get('time')
+    if count <= 1 or not isinstance(time, Range) or time.begin is None or time.end is None:
+        return [Partition(expressions)]
+
+    begin, end = _as_utc(time.begin), _as_utc(time.end)
+    step = (end - begin) / count
+    ticks = [begin + i * step for i in range(count)] + [end]
+
+    # The outer partitions also own any datasets that start outside the query range but overlap it.
+    return [
+        Partition(
+            dict(expressions, time=Range(a, b)),
+            owned_begin=a if i > 0 else None,
+            owned_end=b if i < count - 1 else None,
+        )
+        for i, (a, b) in enumerate(zip(ticks[:-1], ticks[1:]))
+    ]
+
+
+def _check_partition(dc_config: Optional[str], checks: Checks, partition: Partition) -> CoherenceCounts:
+    with Datacube(config=dc_config) as dc:
+        return check_partition(dc, checks, partition)
+
+
+def check_partition(dc: Datacube, checks: Checks, partition: Partition) -> CoherenceCounts:
+    """Run the requested checks over the datasets owned by one partition of the query"""
+    counts = CoherenceCounts()
+
+    # Archive if it has no locations.
+    # (the sync tool removes locations that don't exist anymore on disk,
+    # but can't archive datasets as another path may be added later during the sync)
+    if checks.check_locationless or checks.archive_locationless:
+        locationless_ids = find_locationless_datasets(dc.index, partition.expressions, partition)
+        if checks.archive_locationless:
+            for batch in _batches(locationless_ids, ARCHIVE_BATCH_SIZE):
+                dc.index.datasets.archive(batch)
+                counts += CoherenceCounts(locationless_count=len(batch), archived_count=len(batch))
+                for dataset_id in batch:
+                    _LOG.info("locationless_dataset_id.archived", dataset_id=str(dataset_id))
+        else:
+            for dataset_id in locationless_ids:
+                counts += CoherenceCounts(locationless_count=1)
+                _LOG.info("locationless_dataset_id", dataset_id=str(dataset_id))
+
+    # If an ancestor is archived, it may have been replaced. This one may need
+    # to be reprocessed too.
+    if checks.check_ancestors or checks.archive_siblings or checks.check_siblings:
+        # The datasets of each product that we'll check, to limit the lineage we load.
+        searches = {
+            product.id: _owned_datasets_query(product, query, partition)
+            for product, query in dc.index.products.search_robust(**partition.expressions)
+        }
+        # Lineage graphs of each product, loaded as needed.
+        lineage = {}  # type: Dict[int, LineageGraph]
+        for dataset in dc.index.datasets.search(**partition.expressions):
+            if not partition.owns(dataset.time.begin if dataset.time else None):
+                continue
+            product_id = dataset.type.id
+            graph = lineage.get(product_id)
+            if graph is None:
+                # The lineage of the partition's datasets is loaded in bulk the first time we see the product.
+                graph = lineage[product_id] = load_product_lineage(
+                    dc.index, product_id, datasets=searches.get(product_id), log=_LOG
+                )
+            counts += CoherenceCounts(dataset_count=1)
+            counts += _check_ancestors(checks.check_siblings, checks.archive_siblings, dc, dataset, graph, lineage)
+
+    return counts
+
+
+def find_locationless_datasets(index: Index,
+                               expressions: dict,
+                               partition: Partition = None) -> Iterable[uuid.UUID]:
+    """
+    Find active datasets matching the search expressions that have no active locations.
+
+    This is a single anti-join query per product, streaming back only the matching ids.
+
+    If a partition is given, only datasets whose start time it owns are returned.
+    """
+    for product, query in index.products.search_robust(**expressions):
+        locationless = _owned_datasets_query(product, query, partition).where(
+            ~exists().where(
+                and_(
+                    pgapi.DATASET_LOCATION.c.dataset_ref == pgapi.DATASET.c.id,
+                    pgapi.DATASET_LOCATION.c.archived == None,
+                )
+            )
+        )
+
+        # pylint: disable=protected-access
+        with index.datasets._db.begin() as db:
+            for (dataset_id,) in db._connection.execution_options(stream_results=True).execute(locationless):
+                yield dataset_id
+
+
+def _owned_datasets_query(product: DatasetType, query: dict, partition: Partition = None) -> Select:
+    """
+    A query for the ids of active datasets of the product matching the search.
+
+    If a partition is given, only datasets whose start time it owns are selected.
+    """
+    query = dict(query, dataset_type_id=product.id)
+    dataset_fields = product.metadata_type.dataset_fields
+    query_exprs = tuple(fields.to_expressions(dataset_fields.get, **query))
+
+    search = pgapi.PostgresDbAPI.search_datasets_query(
+        query_exprs,
+        select_fields=(dataset_fields['id'],),
+    )
+    if partition is not None:
+        dataset_begin = func.lower(dataset_fields['time'].alchemy_expression)
+        if partition.owned_begin is not None:
+            search = search.where(dataset_begin >= partition.owned_begin)
+        if partition.owned_end is not None:
+            search = search.where(dataset_begin < partition.owned_end)
+    return search
+
+
+def _batches(items: Iterable, batch_size: int) -> Iterable[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _archive_duplicate_siblings(dc, lineage: Dict[int, LineageGraph], graph: LineageGraph, ids):
     """Archive old versions of duplicate datasets.
 
     When given a list of duplicate sibling datasets, keep the most recently
@@ -96,61 +296,66 @@ def _archive_duplicate_siblings(dc, ids):
 
     Return the number of archived duplicates.
     """
-    # Look up the indexed time for each datset and store in a dict
-    id_to_index_time = {ds_id: dc.index.datasets.get(ds_id).indexed_time
-                        for ds_id in ids}
-
     # Sort by indexed time, and split into [newest : older_duplicates]
-    newest_ds, *older_duplicates = collections.OrderedDict(sorted(id_to_index_time.items(), key=lambda t: t[1], reverse=True))
+    newest_ds, *older_duplicates = sorted(ids, key=graph.indexed_time, reverse=True)
 
     dc.index.datasets.archive(older_duplicates)
+    # Keep the loaded graphs consistent with the index, so later checks see the archival.
+    for g in lineage.values():
+        g.mark_archived(older_duplicates)
 
-    _LOG.info("dataset_id.archived", ids=older_duplicates)
-    _LOG.info("dataset_id.kept", id=newest_ds)
+    _LOG.info("dataset_id.archived", ids=[str(id_) for id_ in older_duplicates])
+    _LOG.info("dataset_id.kept", id=str(newest_ds))
 
     return len(older_duplicates)
 
 
-def _check_ancestors(check_ancestors: bool,
-                     check_siblings: bool,
+def _check_ancestors(check_siblings: bool,
                      archive_siblings: bool,
                      dc: Datacube,
-                     dataset: Dataset):
-    global _siblings_count
-    ancestors_archive_count = 0
-    dataset = dc.index.datasets.get(dataset.id, include_sources=True)
-    if dataset.sources:
-        for classifier, source_dataset in dataset.sources.items():
-            if source_dataset.is_archived:
-                _LOG.info(
-                    "ancestor.dataset_id",
-                    dataset_id=str(dataset.id),
-                    source_type=classifier,
-                    source_dataset_id=str(source_dataset.id)
-                )
-            elif check_siblings or archive_siblings:
-                # If a source dataset has other siblings they may be duplicates.
-                # (this only applies to source products that are 1:1 with
-                # descendants, not pass-to-scene or scene-to-tile conversions)
-                siblings = dc.index.datasets.get_derived(source_dataset.id)
-
-                # Only active siblings of the same type.
-                siblings = [
-                    s for s in siblings
-                    if s != dataset and not s.is_archived and s.type == dataset.type
-                ]
-                if siblings:
-                    _siblings_count += 1
-                    sibling_ids = [str(d.id) for d in siblings]
-                    _LOG.info("dataset.siblings_exist",
-                              dataset_id=str(dataset.id),
-                              siblings=sibling_ids)
-
-                    # Choose the most recent sibling and archive others
-                    if archive_siblings:
-                        ancestors_archive_count += _archive_duplicate_siblings(dc, sibling_ids + [str(dataset.id)])
-
-    return ancestors_archive_count
+                     dataset: Dataset,
+                     graph: LineageGraph,
+                     lineage: Dict[int, LineageGraph]) -> CoherenceCounts:
+    counts = CoherenceCounts()
+
+    for classifier, source_dataset_id in graph.sources(dataset.id):
+        if graph.is_archived(source_dataset_id):
+            _LOG.info(
+                "ancestor.dataset_id",
+                dataset_id=str(dataset.id),
+                source_type=classifier,
+                source_dataset_id=str(source_dataset_id)
+            )
+        elif check_siblings or archive_siblings:
+            # If a source dataset has other siblings they may be duplicates.
+            # (this only applies to source products that are 1:1 with
+            # descendants, not pass-to-scene or scene-to-tile conversions)
+
+            # Only active siblings of the same type. (the graph only contains datasets of this type)
+            siblings = [
+                s for s in graph.derived(source_dataset_id)
+                if s != dataset.id and not graph.is_archived(s)
+            ]
+            if siblings:
+                counts += CoherenceCounts(siblings_count=1)
+                _LOG.info("dataset.siblings_exist",
+                          dataset_id=str(dataset.id),
+                          siblings=[str(s) for s in siblings])
+
+                # Choose the most recent sibling and archive others
+                if archive_siblings:
+                    counts += CoherenceCounts(archived_count=_archive_duplicate_siblings(
+                        dc, lineage, graph, siblings + [dataset.id]
+                    ))
+
+    return counts
+
+
+def _as_utc(d: datetime) -> datetime:
+    # UTC is default if not specified
+    if d.tzinfo is None:
+        return d.replace(tzinfo=tz.tzutc())
+    return d.astimezone(tz.tzutc())
 
 
 if __name__ == '__main__':
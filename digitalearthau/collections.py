@@ -13,6 +13,7 @@ from pathlib import Path
 from typing import Iterable, Optional, List, Dict, NamedTuple, Sequence
 
 from datacube.index import Index
+from digitalearthau.pathmatch import PathTrie
 
 
 class Trust(Enum):
@@ -34,7 +35,8 @@ class Collection(NamedTuple):
 
     index_: Index = None
 
-    # The fields that together uniquely identify a dataset (for finding duplicates)
+    # The fields that together uniquely identify a dataset (for finding duplicates).
+    # As well as search fields, these can be the calculated keys in duplicates.VIRTUAL_FIELDS.
     unique: Sequence[str] = None
 
     # If something is archived, how many days before we can delete it? None means never
@@ -146,10 +148,26 @@ def _constrain_pattern(within_path: Path, pattern: str):
 
 _COLLECTIONS = {}  # type: Dict[str, Collection]
 
+# Compiled index of collection file patterns. Built on first use, and discarded whenever collections are added.
+_COLLECTION_PATHS = None  # type: Optional[PathTrie]
+
 
 def _add(*cs: Collection):
+    global _COLLECTION_PATHS
     for c in cs:
         _COLLECTIONS[c.name] = c
+    _COLLECTION_PATHS = None
+
+
+def _collection_path_index() -> PathTrie:
+    global _COLLECTION_PATHS
+    if _COLLECTION_PATHS is None:
+        trie = PathTrie()
+        for c in get_collections():
+            for pat in c.file_patterns:
+                trie.add(pat, c)
+        _COLLECTION_PATHS = trie
+    return _COLLECTION_PATHS
 
 
 def get_collection(name: str) -> Optional[Collection]:
@@ -181,14 +199,8 @@ def get_collections_in_path(p: Path) -> Iterable[Collection]:
         '2016-07-27/S2A_OPER_MSI_ARD_TL_SGS__20160727T054920_A005719_T53KRU_N02.04'))]
     ['s2a_ard_granule']
     """
-    for c in get_collections():
-        for pat in c.file_patterns:
-            # Match either the whole pattern parent folders of it.
-            if fnmatch.fnmatch(str(p), str(pat)) or \
-                    any(fnmatch.fnmatch(str(p), str(subpat)) for subpat in Path(pat).parents):
-                yield c
-                # Break from the pattern loop so that we don't return the same collection multiple times
-                break
+    # Matches either the whole pattern or parent folders of it.
+    yield from _collection_path_index().matches(p)
 
 
 def init_nci_collections(index: Index):
@@ -214,7 +226,7 @@ def init_nci_collections(index: Index):
             query,
             file_patterns=file_patterns,
             index_=index,
-            unique=('time', 'sat_path', 'sat_row'),
+            unique=('solar_day', 'sat_path', 'sat_row'),
             delete_archived_after_days=delete_archived_after_days,
             # Scenes default to trusting disk. They're atomically written to the destination,
             # and the jobs themselves wont index.
@@ -416,7 +428,7 @@ def init_nci_collections(index: Index):
                     'LS5_TM_{name}/*_*/LS5*{name}*.nc'.format(project=project,
                                                               name=name.upper()),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -430,7 +442,7 @@ def init_nci_collections(index: Index):
                     '*_*/LS7*{name}*.nc'.format(project=project,
                                                 name=name.upper()),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -444,7 +456,7 @@ def init_nci_collections(index: Index):
                     '*_*/LS8*{name}*.nc'.format(project=project,
                                                 name=name.upper()),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -461,7 +473,7 @@ def init_nci_collections(index: Index):
                     '/g/data/{project}/datacube/002/FC/'
                     'LS5_TM_FC/*_*/LS5*FC*.nc'.format(project=project),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -474,7 +486,7 @@ def init_nci_collections(index: Index):
                     '/g/data/{project}/datacube/002/FC/'
                     'LS7_ETM_FC/*_*/LS7*FC*.nc'.format(project=project),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -487,7 +499,7 @@ def init_nci_collections(index: Index):
                     '/g/data/{project}/datacube/002/FC/'
                     'LS8_OLI_FC/*_*/LS8*FC*.nc'.format(project=project),
                 ),
-                unique=('time', 'lat', 'lon'),
+                unique=('time', 'tile_index'),
                 index_=index,
                 # Tiles default to trusting index over the disk: they were indexed at the end of the job,
                 # so unfinished tiles could be left on disk.
@@ -502,7 +514,7 @@ def init_nci_collections(index: Index):
             name=name,
             query={'product': name},
             file_patterns=['/g/data/fk4/datacube/002/WOfS/WOfS_25_2_1/netcdf/*_*/LS_WATER_3577_*.nc'],
-            unique=('time', 'lat', 'lon'),
+            unique=('time', 'tile_index'),
             # Tiles default to trusting index over the disk: they were indexed at the end of the job,
             # so unfinished tiles could be left on disk.
             trust=Trust.INDEX
@@ -527,7 +539,7 @@ def init_nci_collections(index: Index):
             query={'product': 'pq_count_summary'},
             file_patterns=['/g/data/fk4/datacube/002/stats/pq_count/history/LS_PQ_COUNT/*_*/LS_PQ_COUNT_3577_*.nc'],
             index_=index,
-            unique=('time', 'lat', 'lon')
+            unique=('time', 'tile_index')
         )
     )
     _add(
@@ -536,7 +548,7 @@ def init_nci_collections(index: Index):
             query={'product': 'pq_count_annual_summary'},
             index_=index,
             file_patterns=['/g/data/fk4/datacube/002/stats/pq_count/annual/LS_PQ_COUNT/*_*/LS_PQ_COUNT_3577_*.nc'],
-            unique=('time', 'lat', 'lon')
+            unique=('time', 'tile_index')
         )
     )
 
@@ -617,3 +629,6 @@ def init_nci_collections(index: Index):
 
     yaml_path = be_path + 'be-landsat-30years_3_-13.yaml'
     assert list(get_collections_in_path(yaml_path)) is not None
+
+    # Compile the path index once, up-front, as it's used for every path we classify.
+    _collection_path_index()
@@ -1,27 +1,92 @@
 # coding=utf-8
 
 import csv
+import queue
 import sys
-from datetime import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
 from functools import singledispatch
-from typing import Iterable
+from typing import Any, Iterable, List, NamedTuple, Tuple
 from uuid import UUID
 
 import click
 from dateutil import tz
 from psycopg2._range import Range
+from sqlalchemy import Date, and_, cast, func, select
 
+from datacube.drivers.postgres import _api as pgapi
 from datacube.index import Index
 from datacube.index.fields import Field
 from datacube.model import DatasetType, MetadataType
 from datacube.ui.click import global_cli_options, pass_index
 from digitalearthau import collections
 
+# How many products to search at once (each on its own database connection)
+DEFAULT_WORKERS = 4
+
+# Tiles are stored in folders named by their tile index, such as ".../LS8_OLI_NBAR/15_-40/LS8_....nc"
+TILE_INDEX_PATTERN = r'/(-?[0-9]+_-?[0-9]+)/[^/]*$'
+
+
+class VirtualField(NamedTuple):
+    """
+    A grouping key calculated by the database, that isn't one of the metadata type's search fields.
+    """
+    name: str
+    description: str
+    alchemy_expression: Any
+
+
+def _solar_day_field(md: MetadataType) -> VirtualField:
+    """
+    The local solar day of the dataset's centre time, using the centre of its longitude range.
+
+    (scenes acquired either side of UTC midnight are on the same solar day)
+    """
+    time, lon = md.dataset_fields.get('time'), md.dataset_fields.get('lon')
+    if time is None or lon is None:
+        raise ValueError(f'solar_day requires time and lon fields, which {md.name} does not have')
+
+    center_time = time.lower.alchemy_expression + (
+        time.greater.alchemy_expression - time.lower.alchemy_expression
+    ) / 2
+    center_lon = (lon.lower.alchemy_expression + lon.greater.alchemy_expression) / 2
+
+    # A degree of longitude is four minutes of solar time.
+    solar_time = func.timezone('UTC', center_time) + func.make_interval(0, 0, 0, 0, 0, 0, center_lon * 240)
+    return VirtualField('solar_day', 'Local solar day of the dataset', cast(solar_time, Date))
+
+
+def _tile_index_field(md: MetadataType) -> VirtualField:
+    """
+    The tile index of a tiled dataset, parsed from its (active) location.
+    """
+    location = pgapi.DATASET_LOCATION
+    tile_index = select(
+        [func.min(func.substring(location.c.uri_body, TILE_INDEX_PATTERN))]
+    ).where(
+        and_(
+            location.c.dataset_ref == pgapi.DATASET.c.id,
+            location.c.archived == None,
+        )
+    ).as_scalar()
+    return VirtualField('tile_index', 'Tile index (x_y) of the dataset', tile_index)
+
+
+VIRTUAL_FIELDS = {
+    'solar_day': _solar_day_field,
+    'tile_index': _tile_index_field,
+}
+
 
 def parse_field_expression(md: MetadataType, expression: str):
     parts = expression.split('.')
     assert all(p.isidentifier() for p in parts)
 
+    if expression in VIRTUAL_FIELDS:
+        return VIRTUAL_FIELDS[expression](md)
+
     name = parts.pop(0)
     field = md.dataset_fields.get(name)
     if not field:
@@ -39,30 +104,121 @@ def parse_field_expression(md: MetadataType, expression: str):
 def write_duplicates_csv(
         index: Index,
         collections_: Iterable[collections.Collection],
-        out_stream):
-    has_started = False
+        out_stream,
+        workers=DEFAULT_WORKERS):
+    searches = []  # type: List[Tuple[DatasetType, Tuple[Field, ...]]]
     for collection in collections_:
         matching_products = index.products.search(**collection.query)
         for product in matching_products:
             unique_fields = tuple(parse_field_expression(product.metadata_type, f)
                                   for f in collection.unique)
+            searches.append((product, unique_fields))
+
+    if not searches:
+        return
+
+    # The header is always that of the first product, even if it has no duplicates.
+    first_fields = searches[0][1]
+    _write_csv(first_fields, (), out_stream)
+
+    for unique_fields, dupe in _search_concurrently(index, searches, workers):
+        _write_csv(unique_fields, [dupe], out_stream, append=True)
 
-            _write_csv(
-                unique_fields,
-                get_dupes(index, unique_fields, product),
-                out_stream,
-                append=has_started
-            )
-            has_started = True
+
+def _search_concurrently(index: Index,
+                         searches: List[Tuple[DatasetType, Tuple[Field, ...]]],
+                         workers: int) -> Iterable[Tuple[Tuple[Field, ...], dict]]:
+    """
+    Search each product for duplicates at once, yielding groups as they're found.
+
+    Each product is streamed from its own connection, and groups are passed back here
+    so that only this thread writes the output.
+    """
+    results = queue.Queue(maxsize=workers * 4)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _search(product, unique_fields):
+        try:
+            for dupe in get_dupes(index, unique_fields, product):
+                if stop.is_set():
+                    return
+                _put((unique_fields, dupe))
+        except Exception as e:  # pylint: disable=broad-except
+            _put(e)
+        finally:
+            _put(done)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for product, unique_fields in searches:
+            executor.submit(_search, product, unique_fields)
+
+        try:
+            remaining = len(searches)
+            while remaining:
+                item = results.get()
+                if item is done:
+                    remaining -= 1
+                elif isinstance(item, Exception):
+                    raise item
+                else:
+                    yield item
+        finally:
+            stop.set()
 
 
 def get_dupes(index, unique_fields, product):
     # type: (Index, Iterable[Field], DatasetType) -> Iterable[dict]
+    """
+    Find groups of active datasets in the product with the same values for all the given fields.
+
+    The grouping values are all calculated in the database, and the groups are streamed back.
+    """
+    unique_fields = tuple(unique_fields)
     headers = _get_headers(unique_fields)
 
-    for group, dataset_refs in index.datasets.search_product_duplicates(product, *unique_fields):
-        values = (product.name,) + group + (len(dataset_refs), list(dataset_refs))
-        yield dict(zip(headers, values))
+    dataset = pgapi.DATASET
+    keys = select(
+        [dataset.c.id.label('id'), *(f.alchemy_expression.label(f'key_{i}') for i, f in enumerate(unique_fields))]
+    ).select_from(
+        # pylint: disable=protected-access
+        pgapi.PostgresDbAPI._from_expression(
+            dataset, None, [f for f in unique_fields if not isinstance(f, VirtualField)]
+        )
+    ).where(
+        and_(
+            dataset.c.archived == None,
+            dataset.c.dataset_type_ref == product.id,
+        )
+    ).alias('keys')
+
+    key_columns = [keys.c[f'key_{i}'] for i in range(len(unique_fields))]
+    query = select(
+        [func.array_agg(keys.c.id)] + key_columns
+    ).where(
+        # A dataset missing a value (eg. no tile index, as it has no active location) can't be
+        # a duplicate: otherwise all such datasets would be grouped together.
+        and_(*(column.isnot(None) for column in key_columns))
+    ).group_by(
+        *key_columns
+    ).having(
+        func.count(keys.c.id) > 1
+    )
+
+    # pylint: disable=protected-access
+    with index.datasets._db.begin() as db:
+        for record in db._connection.execution_options(stream_results=True).execute(query):
+            dataset_refs = sorted(set(record[0]), key=str)
+            values = (product.name,) + tuple(record[1:]) + (len(dataset_refs), dataset_refs)
+            yield dict(zip(headers, values))
 
 
 def _get_headers(unique_fields):
@@ -120,6 +276,11 @@ def printable_list(val):
     return ' '.join(printable(v) for v in val)
 
 
+@printable.register(date)
+def printable_date(val):
+    return val.isoformat()
+
+
 @printable.register(UUID)
 def printable_uuid(val):
     return str(val)
@@ -143,21 +304,22 @@ collections.init_nci_collections(None)
 @click.command('duplicates')
 @global_cli_options
 @click.option('-a', '--all_', is_flag=True)
+@click.option('--workers', '-j', type=int, default=DEFAULT_WORKERS, show_default=True,
+              help="Number of products to search at once")
 @click.argument('collections_', type=click.Choice(collections.registered_collection_names()), nargs=-1)
 @pass_index(app_name="find-duplicates")
-def cli(index, all_, collections_):
+def cli(index, all_, workers, collections_):
     """
     Find duplicate datasets for a collection.
 
     (eg. if a dataset has been reprocessed but both versions are indexed and active)
 
-    This uses the unique fields defined in a collection to try to group them.
-
-    Note that this is really a prototype: it won't report all duplicates as the unique fields aren't good enough.
+    This uses the unique fields defined in a collection to try to group them. As well as
+    the metadata type's search fields, these can use keys calculated by the database:
 
-      - Scenes group by "day" not "solar day"
+      - solar_day: the local solar day of the dataset (for grouping scenes)
 
-      - Tiled products should be grouped by tile_index, but it's not in the metadata.
+      - tile_index: parsed from the dataset's location (for grouping tiles)
 
     """
     collections.init_nci_collections(index)
@@ -170,7 +332,8 @@ def cli(index, all_, collections_):
     write_duplicates_csv(
         index,
         [collections.get_collection(name) for name in collection_names],
-        sys.stdout
+        sys.stdout,
+        workers=workers,
     )
 
 
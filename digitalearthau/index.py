@@ -2,7 +2,7 @@ import uuid
 import structlog
 
 from datetime import datetime
-from typing import Iterable
+from typing import Callable, Iterable, List, Optional, Tuple
 from datacube.index import Index
 from datacube.model import Dataset
 from datacube.utils import uri_to_local_path
@@ -104,3 +104,66 @@ def get_datasets_for_uri(index: Index, uri: str) -> Iterable[DatasetLite]:
     """Get all datasets at the given uri"""
     for d in index.datasets.get_datasets_for_location(uri=uri):
         yield DatasetLite.from_agdc(d)
+
+
+class BatchedIndexWriter:
+    """
+    Queue dataset location and archival changes, and apply them to the index in batched transactions.
+
+    A single writer should be used from one thread only (typically the main thread, while workers do
+    the slow filesystem work). Use it as a context manager so that the final batch is always applied.
+
+    Each change can have an `on_applied` callback, called once its transaction has been committed.
+    """
+
+    def __init__(self, index: Index, batch_size: int = 500, dry_run=False, log=_LOG) -> None:
+        self.index = index
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.log = log
+
+        self._pending = []  # type: List[Tuple[str, tuple, Optional[Callable[[], None]]]]
+        self.applied_count = 0
+
+    def add_location(self, dataset_id: uuid.UUID, uri: str, on_applied=None):
+        self._queue('insert_dataset_location', (dataset_id, uri), on_applied)
+
+    def archive_location(self, dataset_id: uuid.UUID, uri: str, on_applied=None):
+        self._queue('archive_location', (dataset_id, uri), on_applied)
+
+    def remove_location(self, dataset_id: uuid.UUID, uri: str, on_applied=None):
+        self._queue('remove_location', (dataset_id, uri), on_applied)
+
+    def archive_dataset(self, dataset_id: uuid.UUID, on_applied=None):
+        self._queue('archive_dataset', (dataset_id,), on_applied)
+
+    def _queue(self, operation: str, args: tuple, on_applied: Optional[Callable[[], None]]):
+        self._pending.append((operation, args, on_applied))
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Apply all queued changes in one transaction"""
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+
+        if not self.dry_run:
+            # pylint: disable=protected-access
+            with self.index.datasets._db.begin() as transaction:
+                for operation, args, _ in batch:
+                    getattr(transaction, operation)(*args)
+
+        self.applied_count += len(batch)
+        self.log.debug("index.batch.applied", change_count=len(batch), dry_run=self.dry_run)
+
+        for _, _, on_applied in batch:
+            if on_applied is not None:
+                on_applied()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Changes already queued describe completed work, so they're applied even if the caller failed.
+        self.flush()
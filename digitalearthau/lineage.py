@@ -0,0 +1,221 @@
+"""
+Bulk-loaded lineage (source/derived) graphs of datasets.
+
+Fetching each dataset's sources and derived datasets through the index api takes several
+queries per dataset. Instead, we load the lineage edges of a product (or of the datasets
+being checked) in one streaming query, and keep them in a compact array-backed graph.
+"""
+import uuid
+from array import array
+from datetime import datetime
+from typing import Dict, Iterable, List, NamedTuple, Tuple
+
+import structlog
+from sqlalchemy import select
+from sqlalchemy.sql import Select
+
+from datacube.drivers.postgres import _api as pgapi
+from datacube.index import Index
+
+_LOG = structlog.getLogger('dea-lineage')
+
+
+class LineageEdge(NamedTuple):
+    """A dataset, one of its sources, and the minimal attributes of each"""
+    dataset_id: uuid.UUID
+    dataset_archived: bool
+    dataset_indexed_time: datetime
+    classifier: str
+    source_id: uuid.UUID
+    source_archived: bool
+
+
+class LineageGraph:
+    """
+    Datasets of one product, linked to their source datasets.
+
+    Nodes are numbered, and their attributes are kept in flat arrays. Edges are stored in both
+    directions as compressed adjacency lists (an offsets array into an array of edge numbers),
+    so that looking up a dataset's sources or derived datasets doesn't need any per-node objects.
+    """
+
+    def __init__(self,
+                 ids: List[uuid.UUID],
+                 archived: bytearray,
+                 indexed_times: array,
+                 classifiers: List[str],
+                 edge_sources: array,
+                 edge_derived: array,
+                 edge_classifiers: array) -> None:
+        self._ids = ids
+        self._node_of = {id_: i for i, id_ in enumerate(ids)}  # type: Dict[uuid.UUID, int]
+        self._archived = archived
+        self._indexed_times = indexed_times
+
+        self._classifiers = classifiers
+        self._edge_sources = edge_sources
+        self._edge_derived = edge_derived
+        self._edge_classifiers = edge_classifiers
+
+        self._source_offsets, self._source_edges = _adjacency(edge_derived, len(ids))
+        self._derived_offsets, self._derived_edges = _adjacency(edge_sources, len(ids))
+
+    @classmethod
+    def from_edges(cls, edges: Iterable[LineageEdge]) -> 'LineageGraph':
+        ids = []  # type: List[uuid.UUID]
+        node_of = {}  # type: Dict[uuid.UUID, int]
+        archived = bytearray()
+        indexed_times = array('d')
+
+        classifiers = []  # type: List[str]
+        classifier_of = {}  # type: Dict[str, int]
+
+        edge_sources = array('l')
+        edge_derived = array('l')
+        edge_classifiers = array('l')
+
+        def node(id_: uuid.UUID, is_archived: bool) -> int:
+            i = node_of.get(id_)
+            if i is None:
+                i = node_of[id_] = len(ids)
+                ids.append(id_)
+                archived.append(is_archived)
+                indexed_times.append(0.0)
+            return i
+
+        for edge in edges:
+            derived = node(edge.dataset_id, edge.dataset_archived)
+            if edge.dataset_indexed_time is not None:
+                indexed_times[derived] = edge.dataset_indexed_time.timestamp()
+
+            classifier = classifier_of.get(edge.classifier)
+            if classifier is None:
+                classifier = classifier_of[edge.classifier] = len(classifiers)
+                classifiers.append(edge.classifier)
+
+            edge_derived.append(derived)
+            edge_sources.append(node(edge.source_id, edge.source_archived))
+            edge_classifiers.append(classifier)
+
+        return cls(ids, archived, indexed_times, classifiers, edge_sources, edge_derived, edge_classifiers)
+
+    def __contains__(self, dataset_id: uuid.UUID) -> bool:
+        return dataset_id in self._node_of
+
+    def __len__(self):
+        return len(self._ids)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self._edge_sources)
+
+    def sources(self, dataset_id: uuid.UUID) -> List[Tuple[str, uuid.UUID]]:
+        """The (classifier, id) of each source of the dataset"""
+        i = self._node_of.get(dataset_id)
+        if i is None:
+            return []
+        return [
+            (self._classifiers[self._edge_classifiers[e]], self._ids[self._edge_sources[e]])
+            for e in self._source_edges[self._source_offsets[i]:self._source_offsets[i + 1]]
+        ]
+
+    def derived(self, dataset_id: uuid.UUID) -> List[uuid.UUID]:
+        """Ids of datasets in this product that were derived from the given one"""
+        i = self._node_of.get(dataset_id)
+        if i is None:
+            return []
+        return [
+            self._ids[self._edge_derived[e]]
+            for e in self._derived_edges[self._derived_offsets[i]:self._derived_offsets[i + 1]]
+        ]
+
+    def is_archived(self, dataset_id: uuid.UUID) -> bool:
+        return bool(self._archived[self._node_of[dataset_id]])
+
+    def indexed_time(self, dataset_id: uuid.UUID) -> float:
+        """When the dataset was indexed (as a unix timestamp). Only known for datasets of this product"""
+        return self._indexed_times[self._node_of[dataset_id]]
+
+    def mark_archived(self, dataset_ids: Iterable[uuid.UUID]):
+        """Record that datasets have been archived in the index (ignoring any not in this graph)"""
+        for id_ in dataset_ids:
+            i = self._node_of.get(id_)
+            if i is not None:
+                self._archived[i] = True
+
+
+def _adjacency(edge_nodes: array, node_count: int) -> Tuple[array, array]:
+    """
+    Group edge numbers by node: edges of node i are edges[offsets[i]:offsets[i + 1]]
+
+    >>> offsets, edges = _adjacency(array('l', [2, 0, 2]), 3)
+    >>> list(offsets), list(edges)
+    ([0, 1, 1, 3], [1, 0, 2])
+    """
+    offsets = array('l', [0]) * (node_count + 1)
+    for node in edge_nodes:
+        offsets[node + 1] += 1
+    for i in range(node_count):
+        offsets[i + 1] += offsets[i]
+
+    positions = array('l', offsets[:-1])
+    edges = array('l', [0]) * len(edge_nodes)
+    for e, node in enumerate(edge_nodes):
+        edges[positions[node]] = e
+        positions[node] += 1
+
+    return offsets, edges
+
+
+def load_product_lineage(index: Index, product_id: int, datasets: Select = None, log=_LOG) -> LineageGraph:
+    """
+    Load the lineage of datasets in a product, with one streaming query.
+
+    :param datasets: A query selecting the ids of the datasets of interest (such as a search). Only their
+        sources, and the datasets of the product derived from those sources (their siblings), are loaded.
+        By default, the lineage of the whole product is loaded.
+    """
+    graph = LineageGraph.from_edges(_stream_product_edges(index, product_id, datasets))
+    log.info("lineage.loaded", product_id=product_id, dataset_count=len(graph), edge_count=graph.edge_count)
+    return graph
+
+
+def _stream_product_edges(index: Index, product_id: int, datasets: Select = None) -> Iterable[LineageEdge]:
+    derived = pgapi.DATASET.alias('derived')
+    source = pgapi.DATASET.alias('source')
+    # Aliased, so that the datasets query (which uses the plain tables) isn't correlated with ours.
+    lineage = pgapi.DATASET_SOURCE.alias('lineage')
+
+    query = select([
+        derived.c.id,
+        derived.c.archived.isnot(None),
+        derived.c.added,
+        lineage.c.classifier,
+        source.c.id,
+        source.c.archived.isnot(None),
+    ]).select_from(
+        lineage.join(
+            derived, derived.c.id == lineage.c.dataset_ref
+        ).join(
+            source, source.c.id == lineage.c.source_dataset_ref
+        )
+    ).where(
+        derived.c.dataset_type_ref == product_id
+    )
+
+    if datasets is not None:
+        # Edges from the sources of the given datasets: their own, and those of their siblings.
+        datasets_lineage = pgapi.DATASET_SOURCE.alias('datasets_lineage')
+        query = query.where(
+            lineage.c.source_dataset_ref.in_(
+                select([datasets_lineage.c.source_dataset_ref]).where(
+                    datasets_lineage.c.dataset_ref.in_(datasets)
+                )
+            )
+        )
+
+    # pylint: disable=protected-access
+    with index.datasets._db.begin() as db:
+        # Stream with a server-side cursor: a product can have millions of edges.
+        for row in db._connection.execution_options(stream_results=True).execute(query):
+            yield LineageEdge(*row)
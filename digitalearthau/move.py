@@ -2,33 +2,58 @@
 
 from __future__ import print_function
 
+import json
 import os
 import shutil
 import tempfile
-from contextlib import suppress
+import threading
+import uuid
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from contextlib import suppress, contextmanager
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Iterable
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
 import click
 import structlog
 from boltons import fileutils
-from eodatasets3 import verify
 
 from datacube.index import Index
 from datacube.model import Dataset
 from datacube.ui import click as ui
 from digitalearthau import paths as path_utils
+from digitalearthau.checksum import copy_file_and_verify, copy_tree_and_verify, read_checksum_file, \
+    package_checksum_path, verify_files
 from digitalearthau.collections import init_nci_collections, get_collections_in_path
+from digitalearthau.index import BatchedIndexWriter, DatasetLite
 from digitalearthau.paths import is_base_directory, BASE_DIRECTORIES, get_dataset_paths, split_path_from_base
 from digitalearthau.uiutil import init_logging
 
 _LOG = structlog.get_logger()
 
+# How many datasets can be copied into the same destination folder at once.
+# (so that many jobs don't all hammer the same Lustre OST)
+DEFAULT_JOBS_PER_DESTINATION = 2
+
 
 @click.command()
 @ui.global_cli_options
 @click.option('--dry-run', is_flag=True, default=False)
 @click.option('--checksum/--no-checksum', is_flag=True, default=True)
+@click.option('--kernel-copy', is_flag=True, default=False,
+              help="Copy within the kernel (copy_file_range/sendfile), verifying checksums by reading "
+                   "back the destination rather than hashing the source as it's copied")
+@click.option('--jobs', '-j', type=int, default=1,
+              help="Number of datasets to copy and verify at once")
+@click.option('--jobs-per-destination', type=int, default=DEFAULT_JOBS_PER_DESTINATION,
+              show_default=True,
+              help="Maximum concurrent copies into any one destination folder")
+@click.option('--journal', 'journal_path',
+              type=click.Path(dir_okay=False, writable=True),
+              help="Record the progress of each dataset in this file. If it already exists, "
+                   "unfinished moves from the previous run are resumed")
 @click.option('--destination', '-d',
               required=True,
               type=click.Path(exists=True, writable=True),
@@ -37,7 +62,7 @@ _LOG = structlog.get_logger()
                 type=click.Path(exists=True, readable=True),
                 nargs=-1)
 @ui.pass_index('move')
-def cli(index, dry_run, paths, destination, checksum):
+def cli(index, dry_run, paths, destination, checksum, kernel_copy, jobs, jobs_per_destination, journal_path):
     """
     Move the given folder of datasets into the given destination folder.
 
@@ -52,6 +77,9 @@ def cli(index, dry_run, paths, destination, checksum):
 
     * Both the source(s) and destination paths are expected to be paths containing existing DEA collections.
     (See collections.py and paths.py)
+
+    * With a --journal, an interrupted run can be resumed by running again with the same journal (with no
+    paths needed).
     """
     init_logging()
     init_nci_collections(index)
@@ -66,6 +94,8 @@ def cli(index, dry_run, paths, destination, checksum):
     # We want to iterate all datasets in the given input folder, so we find collections that exist in
     # that folder and then iterate through all the collection datasets within that folder. Simple :)
 
+    journal = MoveJournal(Path(journal_path)) if journal_path else None
+
     # We do this aggressively to find errors in arguments immediately. (with the downside of `paths` memory usage)
     resulting_paths = []
     for input_path in map(Path, paths):
@@ -77,24 +107,176 @@ def cli(index, dry_run, paths, destination, checksum):
             resulting_paths.extend(list(collection.iter_fs_paths_within(input_path)))
 
     _LOG.info("dataset.count", input_count=len(paths), dataset_count=len(resulting_paths))
+    if journal:
+        _LOG.info("journal.resume", journal=journal.path, unfinished_count=len(journal.unfinished()))
 
     # TODO: @ui.executor_cli_options
-    move_all(
-        index,
-        resulting_paths,
-        Path(destination),
-        dry_run=dry_run,
-        checksum=checksum
-    )
+    try:
+        move_all(
+            index,
+            resulting_paths,
+            Path(destination),
+            dry_run=dry_run,
+            checksum=checksum,
+            kernel_copy=kernel_copy,
+            jobs=jobs,
+            jobs_per_destination=jobs_per_destination,
+            journal=journal,
+        )
+    finally:
+        if journal:
+            journal.close()
+
+
+def move_all(index: Index,
+             paths: Iterable[Path],
+             destination_base_path: Path,
+             dry_run=False,
+             checksum=True,
+             kernel_copy=False,
+             jobs=1,
+             jobs_per_destination=DEFAULT_JOBS_PER_DESTINATION,
+             journal: 'MoveJournal' = None):
+    destination_limit = _FolderLimit(jobs_per_destination)
+    if dry_run:
+        # Nothing is done, so there's nothing to record.
+        journal = None
+
+    # Unfinished moves from a previous run are resumed from their last recorded state.
+    items = []  # type: List[Union[Path, Tuple[FileMover, str]]]
+    if journal:
+        items.extend((FileMover.from_journal_record(index, record), record['state'])
+                     for record in journal.unfinished())
+    items.extend(path for path in paths if not (journal and journal.has(path)))
+
+    def copy_dataset(item) -> Optional[Tuple[FileMover, str]]:
+        if isinstance(item, tuple):
+            mover, state = item
+        else:
+            mover = FileMover.evaluate_and_create(index, item, dest_base_path=destination_base_path)
+            if not mover:
+                return None
+            state = mover.current_state()
+            if journal:
+                journal.record(mover, MOVE_PLANNED)
+
+        with destination_limit.acquire(mover.dest_path.parent):
+            state = mover.ensure_copied(state, dry_run=dry_run, checksum=checksum,
+                                        kernel_copy=kernel_copy, journal=journal)
+        return (mover, state) if state else None
+
+    if jobs <= 1:
+        # Apply index changes immediately, one dataset at a time.
+        with BatchedIndexWriter(index, batch_size=1, dry_run=dry_run) as index_writer:
+            for item in items:
+                copied = copy_dataset(item)
+                if copied:
+                    mover, state = copied
+                    mover.record_move(index_writer, state, journal=journal)
+        return
+
+    # Workers do the copying and verification, while all index changes are made here in the main
+    # thread, in batched transactions.
+    with BatchedIndexWriter(index, dry_run=dry_run) as index_writer, \
+            ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(copy_dataset, item) for item in items]
+        recorded = set()
+
+        def record_copied(future):
+            recorded.add(future)
+            copied = future.result()
+            if copied:
+                mover, state = copied
+                mover.record_move(index_writer, state, journal=journal)
+
+        try:
+            for future in as_completed(futures):
+                record_copied(future)
+        except BaseException:
+            # Don't start any more copies, but keep the work of those already done: their
+            # index changes are applied before we give up.
+            for future in futures:
+                future.cancel()
+            wait(futures)
+            for future in futures:
+                if future not in recorded and not future.cancelled() and future.exception() is None:
+                    record_copied(future)
+            index_writer.flush()
+            raise
+
+
+# The states of a dataset move, in order.
+MOVE_PLANNED = 'planned'
+MOVE_COPIED = 'copied'
+MOVE_VERIFIED = 'verified'
+MOVE_DEST_ADDED = 'dest-location-added'
+MOVE_SOURCE_ARCHIVED = 'source-archived'
+
+
+class MoveJournal:
+    """
+    A record of the progress of each dataset move, so that an interrupted run can be resumed.
+
+    Stored as append-only json-lines: one line for each state a dataset reaches.
+    """
+
+    def __init__(self, journal_path: Path) -> None:
+        self.path = journal_path
+        # Latest record of each dataset, by source metadata path.
+        self._records = OrderedDict()  # type: Dict[str, dict]
+        self._lock = threading.Lock()
+
+        if journal_path.exists():
+            with journal_path.open('r') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records[record['source_metadata_path']] = record
+        self._out = journal_path.open('a')
+
+    def has(self, metadata_path: Path) -> bool:
+        return str(metadata_path.absolute()) in self._records
+
+    def unfinished(self) -> List[dict]:
+        return [r for r in self._records.values() if r['state'] != MOVE_SOURCE_ARCHIVED]
+
+    def record(self, mover: 'FileMover', state: str):
+        record = dict(mover.to_journal_record(), state=state, time=datetime.utcnow().isoformat())
+        with self._lock:
+            self._records[record['source_metadata_path']] = record
+            self._out.write(json.dumps(record) + '\n')
+            # The next run trusts this record, so make sure it's on disk before we continue.
+            self._out.flush()
+            os.fsync(self._out.fileno())
+
+    def close(self):
+        self._out.close()
+
+    def __len__(self):
+        return len(self._records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
-def move_all(index: Index, paths: Iterable[Path], destination_base_path: Path, dry_run=False, checksum=True):
-    for path in paths:
-        mover = FileMover.evaluate_and_create(index, path, dest_base_path=destination_base_path)
-        if not mover:
-            continue
+class _FolderLimit:
+    """
+    Limit how many workers can be using each folder at once.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self._lock = threading.Lock()
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(limit))
 
-        mover.move(dry_run=dry_run, checksum=checksum)
+    @contextmanager
+    def acquire(self, folder: Path):
+        with self._lock:
+            semaphore = self._semaphores[folder]
+        with semaphore:
+            yield
 
 
 class FileMover:
@@ -151,9 +333,6 @@ class FileMover:
         log.debug("found.metadata_path", metadata_path=metadata_path)
 
         dataset_path, dest_path, dest_md_path = cls._compute_paths(metadata_path, dest_base_path)
-        if dest_path.exists() or dest_md_path.exists():
-            log.info("skip.exists", dest_path=dest_path)
-            return None
 
         dataset_id = path_utils.get_path_dataset_id(metadata_path)
         log = log.bind(dataset_id=dataset_id)
@@ -166,7 +345,7 @@ class FileMover:
             log.warn("skip.not_indexed")
             return None
 
-        return FileMover(
+        mover = FileMover(
             source_path=dataset_path,
             dest_path=dest_path,
             source_metadata_path=metadata_path,
@@ -174,23 +353,166 @@ class FileMover:
             dataset=dataset,
             index=index
         )
+        if mover.current_state() == MOVE_SOURCE_ARCHIVED:
+            log.info("skip.exists", dest_path=dest_path)
+            return None
+        return mover
 
-    def move(self, dry_run=True, checksum=True):
-        dest_metadata_uri = self._do_copy(dry_run=dry_run, checksum=checksum)
-        if not dest_metadata_uri:
+    @classmethod
+    def from_journal_record(cls, index: Index, record: dict):
+        return FileMover(
+            source_path=Path(record['source_path']),
+            dest_path=Path(record['dest_path']),
+            source_metadata_path=Path(record['source_metadata_path']),
+            dest_metadata_path=Path(record['dest_metadata_path']),
+            # We only need its id.
+            dataset=DatasetLite(uuid.UUID(record['dataset_id'])),
+            index=index
+        )
+
+    def to_journal_record(self) -> dict:
+        return dict(
+            dataset_id=str(self.dataset.id),
+            source_path=str(self.source_path),
+            dest_path=str(self.dest_path),
+            source_metadata_path=str(self.from_metadata_path),
+            dest_metadata_path=str(self.dest_metadata_path),
+        )
+
+    def current_state(self) -> str:
+        """
+        How far along is this move, judging by the filesystem and index?
+
+        (a previous run may have been interrupted part-way)
+        """
+        if not (self.dest_path.exists() or self.dest_metadata_path.exists()):
+            return MOVE_PLANNED
+
+        active_uris = self.dataset.uris or []
+        if self.dest_uri not in active_uris:
+            # Copied, but the index was never updated.
+            return MOVE_COPIED
+        if self.source_uri in active_uris:
+            return MOVE_DEST_ADDED
+        return MOVE_SOURCE_ARCHIVED
+
+    def move(self, dry_run=True, checksum=True, kernel_copy=False):
+        state = self.ensure_copied(self.current_state(), dry_run=dry_run, checksum=checksum, kernel_copy=kernel_copy)
+        if not state:
             self.log.debug("index.skip")
             return
 
-        # Record destination location in index
-        if not dry_run:
-            self.index.datasets.add_location(self.dataset.id, uri=dest_metadata_uri)
-        self.log.info('index.dest.added', uri=dest_metadata_uri)
+        with BatchedIndexWriter(self.index, batch_size=1, dry_run=dry_run) as index_writer:
+            self.record_move(index_writer, state)
 
-        # Archive source file in index (for deletion soon)
+    def ensure_copied(self, state: str, dry_run=True, checksum=True, kernel_copy=False,
+                      journal: MoveJournal = None) -> Optional[str]:
+        """
+        Make sure the dataset has been copied and verified at the destination, continuing from the given state.
+
+        Returns the new state, or None if it couldn't be copied.
+        """
+        if state not in (MOVE_PLANNED, MOVE_COPIED):
+            return state
+
+        if self.dest_path.exists() or self.dest_metadata_path.exists():
+            # Something was copied previously (perhaps by an interrupted run): check it before trusting it.
+            self.log.info("copy.exists", dest_path=self.dest_path)
+            verified = self._verify_destination(checksum)
+            if verified is False:
+                return None
+            if verified is None:
+                # We can't tell whether it's complete, so copy it again.
+                self.log.info("copy.exists.unverifiable", dest_path=self.dest_path)
+                if not self._replace_destination(dry_run=dry_run, checksum=checksum, kernel_copy=kernel_copy):
+                    return None
+                self._record(journal, MOVE_COPIED)
+        else:
+            # Checksums are verified during the copy.
+            if not self.copy(dry_run=dry_run, checksum=checksum, kernel_copy=kernel_copy):
+                return None
+            self._record(journal, MOVE_COPIED)
+
+        self._record(journal, MOVE_VERIFIED)
+        return MOVE_VERIFIED
+
+    def _verify_destination(self, checksum=True) -> Optional[bool]:
+        """
+        Does the existing destination match the source's checksums?
+
+        None if it can't be verified (checksums are disabled, or the source has no checksum file)
+        """
+        if not checksum:
+            return None
+
+        expected = _read_expected_checksums(self.log, self.source_path)
+        if expected is None:
+            return None
+
+        # The same files, relative to the destination.
+        failures = verify_files(
+            {self.dest_path.joinpath(path.relative_to(self.source_path)): hash_ for path, hash_ in expected.items()},
+            log=self.log
+        )
+        self.log.info("checksum.complete", passes_checksum=not failures, dest_path=self.dest_path)
+        if failures:
+            self.log.warning("skip.exists.invalid", dest_path=self.dest_path)
+        return not failures
+
+    def _replace_destination(self, dry_run=True, checksum=True, kernel_copy=False) -> Optional[str]:
+        """
+        Trash the existing (unindexed) destination, and copy the dataset again.
+
+        Without a source checksum file the new copy can't be verified either, so it's copied unverified
+        rather than failing the run.
+        """
+        checksum = checksum and package_checksum_path(self.source_path).exists()
+
+        trash_path = path_utils.get_trash_path(self.dest_path)
+        self.log.info("copy.exists.trash", dest_path=self.dest_path, trash_path=trash_path)
         if not dry_run:
-            self.index.datasets.archive_location(self.dataset.id, self.source_uri)
+            fileutils.mkdir_p(str(trash_path.parent))
+            os.rename(str(self.dest_path), str(trash_path))
 
-        self.log.info('index.source.archived', uri=self.source_uri)
+        return self.copy(dry_run=dry_run, checksum=checksum, kernel_copy=kernel_copy)
+
+    def _record(self, journal: Optional[MoveJournal], state: str):
+        if journal:
+            journal.record(self, state)
+
+    def copy(self, dry_run=True, checksum=True, kernel_copy=False) -> Optional[str]:
+        """
+        Copy the dataset to its destination, without updating the index.
+
+        Returns the destination metadata uri, if copied.
+        """
+        return self._do_copy(dry_run=dry_run, checksum=checksum, kernel_copy=kernel_copy)
+
+    def record_move(self, index_writer: BatchedIndexWriter, state=MOVE_VERIFIED, journal: MoveJournal = None):
+        """
+        Queue the index changes for a copied dataset: add the destination location, and archive the source.
+
+        (continuing from the given state)
+        """
+        if state == MOVE_VERIFIED:
+            # Record destination location in index
+            index_writer.add_location(
+                self.dataset.id, self.dest_uri,
+                on_applied=partial(self._index_applied, journal, MOVE_DEST_ADDED, 'index.dest.added', self.dest_uri)
+            )
+
+        if state in (MOVE_VERIFIED, MOVE_DEST_ADDED):
+            # Archive source file in index (for deletion soon)
+            index_writer.archive_location(
+                self.dataset.id, self.source_uri,
+                on_applied=partial(self._index_applied, journal, MOVE_SOURCE_ARCHIVED, 'index.source.archived',
+                                   self.source_uri)
+            )
+
+    def _index_applied(self, journal: Optional[MoveJournal], state: str, event: str, uri: str):
+        """An index change has been committed"""
+        self.log.info(event, uri=uri)
+        self._record(journal, state)
 
     @staticmethod
     def _compute_paths(source_metadata_path, destination_base_path):
@@ -208,29 +530,37 @@ class FileMover:
 
         return dataset_path, new_dataset_location, new_metadata_location
 
-    def _do_copy(self, dry_run=True, checksum=True):
+    def _do_copy(self, dry_run=True, checksum=True, kernel_copy=False):
         log = self.log
         dest_path = self.dest_path
         dataset_path = self.source_path
 
+        # Checksums are verified as the data is copied, before the copy is moved into place.
+        expected_checksums = None
         if checksum:
-            successful_checksum = _verify_checksum(self.log, self.from_metadata_path,
-                                                   dry_run=dry_run)
-            self.log.info("checksum.complete", passes_checksum=successful_checksum)
-            if not successful_checksum:
+            expected_checksums = _read_expected_checksums(log, dataset_path)
+            if expected_checksums is None:
                 raise RuntimeError("Checksum failure on " + str(self.from_metadata_path))
 
         if dataset_path.is_dir():
-            self.copy_directory(dataset_path, dest_path, dry_run, log)
+            self.copy_directory(dataset_path, dest_path, dry_run, log,
+                                expected_checksums=expected_checksums, kernel_copy=kernel_copy)
         elif self.dest_path == self.dest_metadata_path:  # Metadata is contained within the dataset file. eg. *.nc
-            self.copy_file(dataset_path, dest_path, log)
+            self.copy_file(dataset_path, dest_path, log, dry_run=dry_run,
+                           expected_checksums=expected_checksums, kernel_copy=kernel_copy)
         else:
             # Datasets that are dataset file + sibling or metadata separate to data
             raise NotImplementedError("TODO: dataset files not yet supported")
 
         return self.dest_uri
 
-    def copy_file(self, from_, to, log):
+    def _check_copy(self, failures, expected_checksums):
+        if expected_checksums is not None:
+            self.log.info("checksum.complete", passes_checksum=not failures)
+        if failures:
+            raise RuntimeError("Checksum failure on " + str(self.from_metadata_path))
+
+    def copy_file(self, from_, to, log, dry_run=False, expected_checksums=None, kernel_copy=False):
         to_directory = to.parent
         log.debug("copy.mkdir", dest=to_directory)
         fileutils.mkdir_p(to.parent)
@@ -239,15 +569,18 @@ class FileMover:
         tmp_name = tempfile.mktemp(prefix='.dea-mv-', dir=to_directory)
         try:
             log.info("copy.put", src=from_, tmp_dest=tmp_name)
-            shutil.copy(from_, tmp_name)
-            log.debug("copy.put.done")
-            os.rename(tmp_name, to)
+            if not dry_run:
+                failures = copy_file_and_verify(from_, Path(tmp_name), expected_checksums,
+                                                kernel_copy=kernel_copy, log=log)
+                log.debug("copy.put.done")
+                self._check_copy(failures, expected_checksums)
+                os.rename(tmp_name, to)
         finally:
             log.debug('tmp_file.rm', tmp_file=tmp_name)
             with suppress(FileNotFoundError):
                 os.remove(tmp_name)
 
-    def copy_directory(self, from_, dest_path, dry_run, log):
+    def copy_directory(self, from_, dest_path, dry_run, log, expected_checksums=None, kernel_copy=False):
         log.debug("copy.mkdir", dest=dest_path.parent)
         fileutils.mkdir_p(str(dest_path.parent))
         # We don't want to risk partially-copied packaged left on disk, so we copy to a tmp dir in same
@@ -257,8 +590,10 @@ class FileMover:
             tmp_package = tmp_dir.joinpath(from_.name)
             log.info("copy.put", src=from_, tmp_dest=tmp_package)
             if not dry_run:
-                shutil.copytree(from_, tmp_package)
+                failures = copy_tree_and_verify(from_, tmp_package, expected_checksums,
+                                                kernel_copy=kernel_copy, log=log)
                 log.debug("copy.put.done")
+                self._check_copy(failures, expected_checksums)
                 os.rename(tmp_package, dest_path)
                 log.debug("copy.rename.done")
 
@@ -269,49 +604,16 @@ class FileMover:
             shutil.rmtree(tmp_dir, ignore_errors=True)
 
 
-def _verify_checksum(log, metadata_path, dry_run=True):
-    dataset_path, all_files = path_utils.get_dataset_paths(metadata_path)
-    checksum_file = _expected_checksum_path(dataset_path)
+def _read_expected_checksums(log, dataset_path: Path) -> Optional[Dict[Path, str]]:
+    checksum_file = package_checksum_path(dataset_path)
     if not checksum_file.exists():
         # Ingested data doesn't currently have them, so it's only a warning.
         log.warning("checksum.missing", checksum_file=checksum_file)
         return None
 
-    ch = verify.PackageChecksum()
-    ch.read(checksum_file)
-    if not dry_run:
-        for file, successful in ch.iteratively_verify():
-            if successful:
-                log.debug("checksum.pass", file=file)
-            else:
-                log.error("checksum.failure", file=file)
-                return False
-
-    log.debug("copy.verify", file_count=len(all_files))
-    return True
-
-
-def _expected_checksum_path(dataset_path):
-    """
-    :type dataset_path: pathlib.Path
-    :rtype: pathlib.Path
-
-    >>> import tempfile
-    >>> tempdir = Path(tempfile.mkdtemp())
-    >>> _expected_checksum_path(tempdir).name == 'package.sha1'
-    True
-    >>> file_ = Path(tempfile.mktemp(suffix='-dataset-file.tif'))
-    >>> file_.open('a').close()
-    >>> file_chk = _expected_checksum_path(file_)
-    >>> str(file_chk).endswith('-dataset-file.tif.sha1')
-    True
-    >>> file_chk.parent == file_.parent
-    True
-    """
-    if dataset_path.is_dir():
-        return dataset_path.joinpath('package.sha1')
-
-    return dataset_path.parent.joinpath(dataset_path.name + '.sha1')
+    expected = read_checksum_file(checksum_file)
+    log.debug("checksum.read", file_count=len(expected))
+    return expected
 
 
 if __name__ == '__main__':
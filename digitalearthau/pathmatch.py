@@ -0,0 +1,147 @@
+"""
+A compiled index for classifying filesystem paths by the glob patterns that own them.
+
+Literal path segments are stored in a prefix-trie, and wildcard segments are compiled
+to a regex per level, so that classifying a path takes time proportional to its depth
+rather than to the number of patterns.
+"""
+import fnmatch
+import glob
+import re
+from pathlib import PurePosixPath
+from typing import Any, Dict, List, Optional, Pattern, Set, Tuple, Union
+
+
+class _Node:
+    __slots__ = ('literal_children', 'pattern_children', 'values', 'terminal_values')
+
+    def __init__(self) -> None:
+        self.literal_children = {}  # type: Dict[str, _Node]
+        # Wildcard segments: (source pattern, compiled regex, child)
+        self.pattern_children = []  # type: List[Tuple[str, Pattern, _Node]]
+
+        # Values of all patterns passing through this node
+        self.values = set()  # type: Set[int]
+        # Values of patterns ending at this node
+        self.terminal_values = set()  # type: Set[int]
+
+    def child_for(self, segment: str) -> '_Node':
+        """Get (or create) the child node for the given pattern segment"""
+        if not glob.has_magic(segment):
+            return self.literal_children.setdefault(segment, _Node())
+
+        for source, _, child in self.pattern_children:
+            if source == segment:
+                return child
+
+        child = _Node()
+        self.pattern_children.append((segment, re.compile(fnmatch.translate(segment)), child))
+        return child
+
+    def matching_children(self, name: str) -> List['_Node']:
+        """All children whose segment matches the given path name"""
+        matches = [child for _, regex, child in self.pattern_children if regex.match(name)]
+
+        literal = self.literal_children.get(name)
+        if literal is not None:
+            matches.append(literal)
+        return matches
+
+
+class PathTrie:
+    """
+    Map glob patterns (or plain folder paths) to values, for fast lookup of the values owning a path.
+
+    Wildcards match within a single path segment, as with glob.
+
+    >>> trie = PathTrie()
+    >>> trie.add('/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/LS*/ga-metadata.yaml', 'ls8')
+    >>> trie.add('/g/data/v10/reprocess/ls7/level1/[0-9][0-9][0-9][0-9]/LS*/ga-metadata.yaml', 'ls7')
+    >>> trie.matches('/g/data/v10/reprocess')
+    ['ls8', 'ls7']
+    >>> trie.matches('/g/data/v10/reprocess/ls7/level1/2016')
+    ['ls7']
+    >>> trie.matches('/g/data/v10/reprocess/ls7/level1/2016/LS7_SOME_SCENE/ga-metadata.yaml')
+    ['ls7']
+    >>> trie.matches('/g/data/v10/reprocess/ls7/level1/20')
+    []
+    >>> trie.matches('/g/data/some/fake/path')
+    []
+    """
+
+    def __init__(self) -> None:
+        self._root = _Node()
+        self._values = []  # type: List[Any]
+        self._value_indexes = {}  # type: Dict[Any, int]
+
+    def add(self, pattern: Union[str, PurePosixPath], value: Any) -> None:
+        """
+        Add a glob pattern that belongs to the given value.
+
+        A value can have many patterns. Values are returned in the order they were first added.
+        """
+        if value not in self._value_indexes:
+            self._value_indexes[value] = len(self._values)
+            self._values.append(value)
+        value_index = self._value_indexes[value]
+
+        node = self._root
+        node.values.add(value_index)
+        for segment in _parts(pattern):
+            node = node.child_for(segment)
+            node.values.add(value_index)
+        node.terminal_values.add(value_index)
+
+    def matches(self, path: Union[str, PurePosixPath]) -> List[Any]:
+        """
+        Get the values with a pattern matching the given path, or matching one of the pattern's parent folders.
+
+        (ie. values that may have files within the given path)
+        """
+        nodes = [self._root]
+        for name in _parts(path):
+            nodes = [child for node in nodes for child in node.matching_children(name)]
+            if not nodes:
+                return []
+
+        return self._sorted_values(set().union(*(node.values for node in nodes)))
+
+    def longest_match(self, path: Union[str, PurePosixPath]) -> Optional[Tuple[Any, Tuple[str, ...]]]:
+        """
+        Find the value whose pattern matches the deepest folder of the given path, returning it
+        along with the remaining path segments beneath that folder.
+
+        >>> trie = PathTrie()
+        >>> trie.add('/g/data/fk4/datacube', 'fk4')
+        >>> trie.add('/g/data', 'gdata')
+        >>> trie.longest_match('/g/data/fk4/datacube/ls7/2003/something.nc')
+        ('fk4', ('ls7', '2003', 'something.nc'))
+        >>> trie.longest_match('/g/data/rs0/datacube')
+        ('gdata', ('rs0', 'datacube'))
+        >>> trie.longest_match('/g/data/fk4/datacube')
+        ('fk4', ())
+        >>> trie.longest_match('/scratch/something.nc')
+        """
+        parts = _parts(path)
+
+        best = None
+        nodes = [self._root]
+        for depth in range(len(parts) + 1):
+            terminal_values = set().union(*(node.terminal_values for node in nodes))
+            if terminal_values:
+                best = (self._sorted_values(terminal_values)[0], parts[depth:])
+
+            if depth == len(parts):
+                break
+            nodes = [child for node in nodes for child in node.matching_children(parts[depth])]
+            if not nodes:
+                break
+
+        return best
+
+    def _sorted_values(self, value_indexes: Set[int]) -> List[Any]:
+        return [self._values[i] for i in sorted(value_indexes)]
+
+
+def _parts(path: Union[str, PurePosixPath]) -> Tuple[str, ...]:
+    return PurePosixPath(str(path)).parts
@@ -1,17 +1,24 @@
 import atexit
+import bisect
 import datetime
+import functools
+import json
 import os
 import shutil
 import tempfile
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Iterable, Union, Tuple
+from typing import List, Iterable, Union, Tuple, Optional, Dict, NamedTuple
 
 import pathlib
 import structlog
 import logging
 
 from datacube.utils import is_supported_document_type, read_documents, InvalidDocException, uri_to_local_path
+from digitalearthau.pathmatch import PathTrie
 
 _LOG = structlog.getLogger()
 
@@ -42,8 +49,25 @@ NCI_WORK_ROOT = Path(os.environ.get('DEA_WORK_ROOT') or '/g/data/v10/work')
 _JOB_WORK_OFFSET = '{output_product}/{task_type}/{work_time:%Y-%m}/{work_time:%d-%H%M%S}'
 
 
+# Compiled index of BASE_DIRECTORIES. Built on first use, and discarded when a directory is registered.
+# (so add base directories with register_base_directory(), rather than to the list directly)
+_BASE_DIRECTORY_INDEX = None  # type: Optional[PathTrie]
+
+
 def register_base_directory(d: Union[str, Path]):
+    global _BASE_DIRECTORY_INDEX
     BASE_DIRECTORIES.append(str(d))
+    _BASE_DIRECTORY_INDEX = None
+
+
+def _base_directory_index() -> PathTrie:
+    global _BASE_DIRECTORY_INDEX
+    if _BASE_DIRECTORY_INDEX is None:
+        trie = PathTrie()
+        for d in BASE_DIRECTORIES:
+            trie.add(d, d)
+        _BASE_DIRECTORY_INDEX = trie
+    return _BASE_DIRECTORY_INDEX
 
 
 def is_base_directory(d: Path):
@@ -123,12 +147,12 @@ def split_path_from_base(file_path):
     ValueError: Unknown location: can't calculate base directory: /scratch/unknown_location/something.nc
     """
 
-    for root_location in BASE_DIRECTORIES:
-        if str(file_path).startswith(root_location):
-            dir_offset = str(file_path)[len(root_location) + 1:]
-            return Path(root_location), dir_offset
+    match = _base_directory_index().longest_match(file_path)
+    if match is None:
+        raise ValueError("Unknown location: can't calculate base directory: " + str(file_path))
 
-    raise ValueError("Unknown location: can't calculate base directory: " + str(file_path))
+    root_location, offset_parts = match
+    return Path(root_location), '/'.join(offset_parts)
 
 
 def write_files(files_spec, containing_dir=None):
@@ -232,25 +256,51 @@ def get_path_dataset_ids(path: Path) -> List[uuid.UUID]:
     return list(_path_dataset_ids(path))
 
 
+_SIBLING_METADATA_SUFFIX = '.ga-md.yaml'
+
+
+def get_dataset_base_path(metadata_path: Path) -> Path:
+    """
+    Get the base location for a given dataset (specified by the metadata path).
+
+    This is derived from the path alone: the dataset's contents are not listed.
+
+    >>> get_dataset_base_path(Path('/g/data/rs0/scenes/LS8_SCENE/ga-metadata.yaml'))
+    PosixPath('/g/data/rs0/scenes/LS8_SCENE')
+    >>> get_dataset_base_path(Path('/g/data/fk4/datacube/002/LS8_TILE.nc'))
+    PosixPath('/g/data/fk4/datacube/002/LS8_TILE.nc')
+    >>> get_dataset_base_path(Path('/tmp/LS7_SOMETHING.tif.ga-md.yaml'))
+    PosixPath('/tmp/LS7_SOMETHING.tif')
+    >>> get_dataset_base_path(Path('/tmp/something.txt'))
+    Traceback (most recent call last):
+    ...
+    ValueError: Unsupported path type: /tmp/something.txt
+    """
+    if metadata_path.suffix == '.nc':
+        return metadata_path
+    if metadata_path.name in ('ga-metadata.yaml', 'ARD-METADATA.yaml'):
+        return metadata_path.parent
+
+    if metadata_path.name.endswith(_SIBLING_METADATA_SUFFIX):
+        return metadata_path.parent.joinpath(metadata_path.name[:-len(_SIBLING_METADATA_SUFFIX)])
+
+    raise ValueError("Unsupported path type: " + str(metadata_path))
+
+
 def get_dataset_paths(metadata_path: Path) -> Tuple[Path, List[Path]]:
     """
     Get the base location and all files for a given dataset (specified by the metadata path)
     :param metadata_path:
     :return: (base_path, all_files)
     """
-    if metadata_path.suffix == '.nc':
-        return metadata_path, [metadata_path]
-    if metadata_path.name == 'ga-metadata.yaml':
-        return metadata_path.parent, list_file_paths(metadata_path.parent)
-    if metadata_path.name == 'ARD-METADATA.yaml':
-        return metadata_path.parent, list_file_paths(metadata_path.parent)
+    base_path = get_dataset_base_path(metadata_path)
 
-    sibling_suffix = '.ga-md.yaml'
-    if metadata_path.name.endswith(sibling_suffix):
-        data_file = metadata_path.parent.joinpath(metadata_path.name[:-len(sibling_suffix)])
-        return data_file, [metadata_path, data_file]
+    if metadata_path.suffix == '.nc':
+        return base_path, [metadata_path]
+    if metadata_path.name.endswith(_SIBLING_METADATA_SUFFIX):
+        return base_path, [metadata_path, base_path]
 
-    raise ValueError("Unsupported path type: " + str(metadata_path))
+    return base_path, list_file_paths(base_path)
 
 
 def read_document(path: Path) -> dict:
@@ -301,6 +351,58 @@ def get_metadata_path(dataset_path):
     raise ValueError('No metadata found for input %r' % dataset_path)
 
 
+# How many directory listings to remember for metadata lookups.
+DIRECTORY_LISTING_CACHE_SIZE = 256
+
+# A directory modified this recently may be modified again within the same mtime (on coarse-grained
+# filesystems), so we don't trust a cached listing of it.
+_LISTING_SETTLE_SECS = 2
+
+
+@functools.lru_cache(maxsize=DIRECTORY_LISTING_CACHE_SIZE)
+def _cached_directory_listing(directory: str, mtime_ns: int) -> Tuple[str, ...]:
+    # The mtime is part of the key so that changed directories are re-listed.
+    return _scan_names(directory)
+
+
+def _scan_names(directory: str) -> Tuple[str, ...]:
+    with os.scandir(directory) as entries:
+        return tuple(sorted(entry.name for entry in entries))
+
+
+def _list_directory(directory: Path) -> Tuple[str, ...]:
+    """
+    Get the (sorted) names within a directory, reusing a recent listing if the directory hasn't changed.
+
+    Many datasets in a large flat folder would otherwise re-list the same folder for every file.
+    """
+    try:
+        st = os.stat(str(directory))
+    except (FileNotFoundError, NotADirectoryError):
+        return ()
+
+    if time.time() - st.st_mtime < _LISTING_SETTLE_SECS:
+        return _scan_names(str(directory))
+    return _cached_directory_listing(str(directory), st.st_mtime_ns)
+
+
+def _names_with_prefix(sorted_names: Tuple[str, ...], prefix: str) -> Iterable[str]:
+    """
+    The names starting with the prefix, found by bisecting the sorted names.
+
+    >>> list(_names_with_prefix(('LS7.tif', 'LS7.tif.ga-md.yaml', 'LS8.tif', 'ga-metadata.yaml'), 'LS7.tif.ga-md'))
+    ['LS7.tif.ga-md.yaml']
+    >>> list(_names_with_prefix(('LS7.tif', 'LS8.tif'), 'ga-metadata'))
+    []
+    """
+    # Names with the prefix sort together, immediately from where the prefix itself would be.
+    for i in range(bisect.bisect_left(sorted_names, prefix), len(sorted_names)):
+        name = sorted_names[i]
+        if not name.startswith(prefix):
+            break
+        yield name
+
+
 def _find_any_metadata_suffix(path):
     """
     Find any supported metadata files that exist with the given file path stem.
@@ -311,7 +413,11 @@ def _find_any_metadata_suffix(path):
 
     :type path: pathlib.Path
     """
-    existing_paths = list(filter(is_supported_document_type, path.parent.glob(path.name + '*')))
+    existing_paths = [
+        path.parent.joinpath(name)
+        for name in _names_with_prefix(_list_directory(path.parent), path.name)
+        if is_supported_document_type(path.parent.joinpath(name))
+    ]
     if not existing_paths:
         return None
 
@@ -321,30 +427,129 @@ def _find_any_metadata_suffix(path):
     return existing_paths[0]
 
 
-def trash_uri(uri: str, dry_run=False, log=_LOG) -> bool:
+# An append-only record of everything moved to a trash folder, so that a day's trash can be undone.
+TRASH_JOURNAL_NAME = 'trash-journal.jsonl'
+
+DEFAULT_TRASH_WORKERS = 8
+
+_JOURNAL_LOCK = threading.Lock()
+
+
+class TrashMove(NamedTuple):
+    uri: str
+    # The dataset's base path (folder or file) and where it's moved to
+    original_path: Path
+    trash_path: Path
+
+    @property
+    def journal_path(self) -> Path:
+        """The journal file of the day's trash folder"""
+        # "{base}/.trash/{day}/{offset}" -> "{base}/.trash/{day}/trash-journal.jsonl"
+        root_path, _ = split_path_from_base(self.original_path)
+        day_folder = root_path.joinpath(*self.trash_path.relative_to(root_path).parts[:2])
+        return day_folder.joinpath(TRASH_JOURNAL_NAME)
+
+
+def _plan_trash(uri: str, log=_LOG) -> Optional[TrashMove]:
     local_path = uri_to_local_path(uri)
 
     if not local_path.exists():
         log.warning("trash.not_exist", path=local_path)
-        return False
+        return None
 
     # TODO: to handle sibling-metadata we should trash "all_dataset_paths" too.
-    base_path, all_dataset_files = get_dataset_paths(local_path)
+    base_path = get_dataset_base_path(local_path)
+    return TrashMove(uri, base_path, get_trash_path(base_path))
+
 
-    trash_path = get_trash_path(base_path)
+def _do_trash(move: TrashMove):
+    os.rename(str(move.original_path), str(move.trash_path))
+    _append_trash_journal(move)
 
-    log.info("trashing", base_path=base_path, trash_path=trash_path)
+
+def _append_trash_journal(move: TrashMove):
+    record = json.dumps(dict(
+        time=datetime.datetime.utcnow().isoformat(),
+        uri=move.uri,
+        original_path=str(move.original_path),
+        trash_path=str(move.trash_path),
+    ))
+    with _JOURNAL_LOCK:
+        with move.journal_path.open('a') as f:
+            f.write(record + '\n')
+
+
+def read_trash_journal(journal_path: Path) -> Iterable[TrashMove]:
+    """
+    Read the moves recorded in a trash journal, in the order they were made.
+    """
+    with journal_path.open('r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield TrashMove(record['uri'], Path(record['original_path']), Path(record['trash_path']))
+
+
+def trash_uri(uri: str, dry_run=False, log=_LOG) -> bool:
+    move = _plan_trash(uri, log=log)
+    if move is None:
+        return False
+
+    log.info("trashing", base_path=move.original_path, trash_path=move.trash_path)
 
     if not dry_run:
-        if not trash_path.parent.exists():
-            os.makedirs(str(trash_path.parent))
+        if not move.trash_path.parent.exists():
+            os.makedirs(str(move.trash_path.parent))
 
-        if trash_path.parent.exists():
-            os.rename(str(base_path), str(trash_path))
+        if move.trash_path.parent.exists():
+            _do_trash(move)
 
     return True
 
 
+def trash_uris(uris: Iterable[str],
+               dry_run=False,
+               log=_LOG,
+               workers=DEFAULT_TRASH_WORKERS) -> Dict[str, bool]:
+    """
+    Trash many dataset uris at once.
+
+    Trash folders are created up-front, then the renames are done in parallel. Every move is recorded
+    in the day's trash journal.
+
+    Returns whether each uri was trashed (False if it didn't exist).
+    """
+    results = {}  # type: Dict[str, bool]
+    moves = []  # type: List[TrashMove]
+    for uri in uris:
+        move = _plan_trash(uri, log=log)
+        results[uri] = move is not None
+        if move is not None:
+            moves.append(move)
+
+    for move in moves:
+        log.info("trashing", base_path=move.original_path, trash_path=move.trash_path)
+
+    if dry_run or not moves:
+        return results
+
+    for folder in sorted({move.trash_path.parent for move in moves}):
+        folder.mkdir(parents=True, exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(_do_trash, move): move for move in moves}
+        for future in as_completed(futures):
+            move = futures[future]
+            try:
+                future.result()
+            except OSError as e:
+                log.error("trash.failed", uri=move.uri, base_path=move.original_path, error=str(e))
+                results[move.uri] = False
+
+    return results
+
+
 def get_product_work_directory(
         output_product: str,
         time=datetime.datetime.utcnow(),
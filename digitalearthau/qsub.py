@@ -1,24 +1,36 @@
+import collections
+import heapq
 import itertools
 import logging
 import re
 import shlex
 import sys
-from functools import update_wrapper
+import time
+from functools import partial, update_wrapper
 from pathlib import Path
 from subprocess import Popen, PIPE
 from pprint import pprint
 import click
 import yaml
 from pydash import pick
-from typing import List, Tuple
+from typing import Dict, List, NamedTuple, Tuple
 
 from datacube.executor import (SerialExecutor,
                                mk_celery_executor,
                                _get_concurrent_executor,
                                _get_distributed_executor)
+from datacube import _celery_runner as cr
 from . import pbs
 from .runners import celery_environment
 from .runners.model import TaskDescription
+from .runners.completion import CompletionLog
+from .runners.local import LocalProcessExecutor
+from .runners.results import ResultConsumer
+from .runners.stragglers import NO_RETRIES, RetryPolicy, StragglerPolicy, TaskDurations
+from .runners.window import AdaptiveWindow, BROKER_MEMORY_BUDGET_FRACTION, parse_memory_size
+
+# Memory limit of the Redis broker we launch for pbs-celery runs. The task window is capped to fit within it.
+REDIS_MAXMEMORY = "4096mb"
 
 NUM_CPUS_PER_NODE = 48  # Gadi: 48 CPUs/node, 192 GB RAM/node, 400 GB PBS_JOBFS/node.
 RESERVED_MEM_PER_NODE = 1024   # in MB
@@ -469,7 +481,42 @@ def describe_task(task):
     return repr(task)
 
 
-def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50):
+class TaskCounts(NamedTuple):
+    successful: int
+    # Tasks that raised an error (on their final attempt)
+    failed: int
+    # Tasks that succeeded, but whose result couldn't be processed
+    result_failed: int = 0
+
+
+class _TaskState:
+    """A task, and its attempts so far"""
+    __slots__ = ('task', 'futures', 'failures', 'done', 'straggling')
+
+    def __init__(self, task) -> None:
+        self.task = task
+        # Attempts that are in flight. (More than one if it's been speculatively resubmitted)
+        self.futures = []
+        self.failures = 0
+        self.done = False
+        self.straggling = False
+
+
+class _Attempt(NamedTuple):
+    state: _TaskState
+    submitted_at: float
+    speculative: bool
+
+
+# How often to check for completed tasks, when we can't just wait for the next one.
+_COMPLETION_POLL_INTERVAL = 0.5
+
+
+def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50, window: AdaptiveWindow = None,
+              process_result_batch=None, result_queue_size=100, task_completed=None,
+              retry_policy: RetryPolicy = NO_RETRIES,
+              straggler_policy: StragglerPolicy = None,
+              is_idempotent=None) -> TaskCounts:
     """
 
     :param tasks: iterable of tasks. Usually a generator to create them as required.
@@ -479,42 +526,203 @@ def run_tasks(tasks, executor, run_task, process_result=None, queue_size=50):
                            takes a single argument, the return value from `run_task(task)`
     :param queue_size: How large the queue of tasks should be. Will depend on how fast tasks are
                        processed, and how much memory is available to buffer them.
+    :param window: Adjusts the number of tasks in flight as the run progresses.
+                   If not given, `queue_size` tasks are always kept in flight.
+    :param process_result_batch: an alternative to `process_result` that takes a list of results,
+                                 so that they can be handled together (eg. in one index transaction).
+    :param result_queue_size: How many completed results may wait to be processed before dispatch
+                              stalls for them.
+    :param task_completed: called with each task once it, and the processing of its result, has succeeded.
+    :param retry_policy: How many times to attempt failing tasks.
+    :param straggler_policy: If given, flag tasks that take much longer than the others.
+    :param is_idempotent: a function that says whether a task can safely be run twice at once. Only
+                          these tasks are resubmitted when they straggle (if the policy allows):
+                          without it, nothing is.
     """
     _LOG.debug('Starting running tasks...')
+    if window is None:
+        window = AdaptiveWindow.fixed(queue_size)
+    if straggler_policy is not None and isinstance(executor, SerialExecutor):
+        _LOG.warning("Tasks can't straggle in serial: ignoring the straggler policy")
+        straggler_policy = None
+    if straggler_policy is not None and straggler_policy.speculate and is_idempotent is None:
+        _LOG.warning("This app doesn't say which tasks can safely run twice: stragglers will be flagged, "
+                     "but not resubmitted")
+        straggler_policy = straggler_policy._replace(speculate=False)
+
+    tasks = iter(tasks)
     results = []
-    task_queue = itertools.islice(tasks, queue_size)
-    for task in task_queue:
-        _LOG.info('Running task: %s', describe_task(task))
-        results.append(executor.submit(run_task, task=task))
+    # Each in-flight attempt at a task, by id of its future
+    in_flight = {}  # type: Dict[int, _Attempt]
+    # Failed tasks waiting to be retried: (when, sequence number, task state)
+    retries = []  # type: List[Tuple[float, int, _TaskState]]
+    retry_sequence = itertools.count()
+    durations = TaskDurations()
+    stats = collections.Counter()
+
+    def submit(state: _TaskState, speculative=False):
+        _LOG.info('Running task: %s%s', describe_task(state.task), ' (speculative copy)' if speculative else '')
+        window.submitted(state.task)
+        future = executor.submit(run_task, task=state.task)
+        in_flight[id(future)] = _Attempt(state, time.monotonic(), speculative)
+        state.futures.append(future)
+        results.append(future)
+
+    def fill_window():
+        while len(results) < window.size:
+            # Retries that are due go first.
+            if retries and retries[0][0] <= time.monotonic():
+                _, _, state = heapq.heappop(retries)
+                submit(state)
+                continue
+
+            task = next(tasks, None)
+            if task is None:
+                return
+            submit(_TaskState(task))
+
+    def check_stragglers():
+        threshold = durations.straggler_threshold(straggler_policy)
+        if threshold is None:
+            return
 
-        _LOG.debug('Task queue filled, waiting for first result...')
+        now = time.monotonic()
+        speculative_count = sum(1 for attempt in in_flight.values() if attempt.speculative)
+        for future in list(results):
+            attempt = in_flight[id(future)]
+            state = attempt.state
+            if state.straggling or now - attempt.submitted_at < threshold:
+                continue
+
+            state.straggling = True
+            stats['stragglers'] += 1
+            _LOG.warning('Task is straggling: %s has taken %ds (median %ds)',
+                         describe_task(state.task), now - attempt.submitted_at, durations.median())
+
+            can_speculate = straggler_policy.speculate and speculative_count < straggler_policy.max_speculative
+            if can_speculate and is_idempotent(state.task):
+                submit(state, speculative=True)
+                speculative_count += 1
+                stats['speculative'] += 1
+
+    def task_failed(state: _TaskState, err: Exception) -> bool:
+        """Record a failed attempt. Returns True if the task has failed for good"""
+        if state.done:
+            # Another copy already succeeded.
+            return False
+        if state.futures:
+            _LOG.warning('A copy of task %s failed, waiting for the other: %s', describe_task(state.task), err)
+            return False
+
+        state.failures += 1
+        if not retry_policy.should_retry(state.failures):
+            return True
+
+        delay = retry_policy.delay(state.failures)
+        _LOG.warning('Task failed (attempt %d of %d), retrying in %ds: %s',
+                     state.failures, retry_policy.attempts, delay, err)
+        heapq.heappush(retries, (time.monotonic() + delay, next(retry_sequence), state))
+        stats['retries'] += 1
+        return False
+
+    def task_succeeded(state: _TaskState, attempt: _Attempt, result):
+        # Abandon any other copies that are still running.
+        # (any that completed at the same time as this one are ignored as they're handled)
+        for other in list(state.futures):
+            if other in results:
+                results.remove(other)
+                del in_flight[id(other)]
+                state.futures.remove(other)
+                executor.release(other)
+        state.done = True
+
+        durations.add(time.monotonic() - attempt.submitted_at)
+        if attempt.speculative:
+            stats['speculative_won'] += 1
+
+        if consumer is not None:
+            consumer.put(result, state.task)
+        elif task_completed is not None:
+            task_completed(state.task)
+
+    # Results are processed on a separate thread, so that dispatch isn't held up by them.
+    consumer = None
+    if process_result is not None or process_result_batch is not None:
+        consumer = ResultConsumer(process_result, process_result_batch,
+                                  queue_size=result_queue_size, on_processed=task_completed)
+        consumer.start()
 
     successful = failed = 0
-    while results:
-        result, results = executor.next_completed(results, None)
+    last_straggler_check = time.monotonic()
+    try:
+        fill_window()
+        _LOG.debug('Task queue filled, waiting for first result...')
 
-        # submit a new _task to replace the one we just finished
-        task = next(tasks, None)
-        if task:
-            _LOG.info('Running _task: %s', describe_task(task))
-            results.append(executor.submit(run_task, task=task))
+        while results or retries:
+            if not results:
+                # Only retries are left: wait until the next is due.
+                time.sleep(max(0.0, retries[0][0] - time.monotonic()))
+                fill_window()
+                continue
 
-        # Process the result
-        try:
-            actual_result = executor.result(result)
-            if process_result is not None:
-                process_result(actual_result)
-            successful += 1
-        except Exception as err:  # pylint: disable=broad-except
-            _LOG.exception('Task failed: %s', err)
-            failed += 1
-            continue
-        finally:
-            # Release the _task to free memory so there is no leak in executor/scheduler/worker process
-            executor.release(result)
-
-    _LOG.info('%d successful, %d failed', successful, failed)
-    return successful, failed
+            if straggler_policy is None:
+                result, _ = executor.next_completed(results, None)
+                completed = [result]
+            else:
+                # Poll, so that we notice stragglers even when nothing is completing.
+                ready, errored, _ = executor.get_ready(results)
+                completed = ready + errored
+                if time.monotonic() - last_straggler_check >= straggler_policy.check_interval:
+                    check_stragglers()
+                    last_straggler_check = time.monotonic()
+                if not completed:
+                    time.sleep(_COMPLETION_POLL_INTERVAL)
+                    fill_window()
+                    continue
+
+            for result in completed:
+                results.remove(result)
+                window.completed(time.monotonic() - in_flight[id(result)].submitted_at)
+
+            # submit new tasks to replace those we just finished (if the window allows)
+            fill_window()
+
+            for result in completed:
+                attempt = in_flight.pop(id(result))
+                state = attempt.state
+                state.futures.remove(result)
+                try:
+                    actual_result = executor.result(result)
+                except Exception as err:  # pylint: disable=broad-except
+                    if task_failed(state, err):
+                        _LOG.exception('Task failed: %s', err)
+                        failed += 1
+                    continue
+                finally:
+                    # Release the _task to free memory so there is no leak in executor/scheduler/worker process
+                    executor.release(result)
+
+                if state.done:
+                    # A copy of the task already succeeded: this one lost the race.
+                    continue
+                task_succeeded(state, attempt, actual_result)
+                successful += 1
+
+            # Retries may have been scheduled, or slots freed by abandoned copies.
+            fill_window()
+    finally:
+        # Completed work is still recorded if dispatch is interrupted.
+        if consumer is not None:
+            consumer.close()
+
+    if not window.is_fixed:
+        window.log_summary()
+    if stats:
+        _LOG.info('%d retries; %d stragglers, %d speculative copies (%d finished first)',
+                  stats['retries'], stats['stragglers'], stats['speculative'], stats['speculative_won'])
+    result_failed = consumer.failed if consumer is not None else 0
+    _LOG.info('%d successful, %d failed, %d failed result processing', successful, failed, result_failed)
+    return TaskCounts(successful, failed, result_failed)
 
 
 class TaskRunner(object):
@@ -523,9 +731,16 @@ class TaskRunner(object):
         self._opts = opts
         self._executor = None
         self._shutdown = None
-        self._queue_size = None
+        self._window = None
         self._user_queue_size = None
         self._workers_per_node = None
+        self._skip_completed = True
+        self._verify_outputs = False
+        self._retry_policy = NO_RETRIES
+        self._straggler_policy = None
+        self._chunk_size = 1
+        self._config_paths = None
+        self._environment = None
 
     def __repr__(self):
         args = '' if self._opts is None else '-{}'.format(str(self._opts))
@@ -537,73 +752,133 @@ class TaskRunner(object):
     def set_workers_per_node(self, value):
         self._workers_per_node = value
 
+    def set_completion_checks(self, skip_completed=True, verify_outputs=False):
+        self._skip_completed = skip_completed
+        self._verify_outputs = verify_outputs
+
+    def set_chunk_size(self, chunk_size: int):
+        self._chunk_size = chunk_size
+
+    def set_index_config(self, config_paths=None, environment=None):
+        """The datacube config (as given to `-C` and `--env`) that local workers should connect with"""
+        self._config_paths = config_paths
+        self._environment = environment
+
+    def set_retry_policy(self, policy: RetryPolicy):
+        self._retry_policy = policy
+
+    def set_straggler_policy(self, policy: StragglerPolicy):
+        self._straggler_policy = policy
+
     def start(self, task_desc: TaskDescription = None):
         def noop():
             pass
 
         def mk_pbs_celery(task_desc: TaskDescription):
-            qsize = pbs.preferred_queue_size()
+            cores = pbs.total_cores()
             port = 6379  # TODO: randomise
-            maxmemory = "4096mb"  # TODO: compute maxmemory from qsize
             executor, shutdown = celery_environment.launch_celery_worker_environment(
                 task_desc=task_desc,
-                redis_params=dict(port=port, maxmemory=maxmemory),
+                redis_params=dict(port=port, maxmemory=REDIS_MAXMEMORY),
                 workers_per_node=self._workers_per_node
             )
-            return (executor, qsize, shutdown)
+            # Keep every core busy, and let the window grow until the broker's memory is the limit.
+            window = AdaptiveWindow(
+                pbs.preferred_queue_size(),
+                min_size=cores,
+                max_size=cores * 16,
+                memory_probe=celery_environment.redis_memory_probe(
+                    pbs.hostname(), port, cr.get_redis_password()
+                ),
+                memory_budget_bytes=int(parse_memory_size(REDIS_MAXMEMORY) * BROKER_MEMORY_BUDGET_FRACTION),
+            )
+            return (executor, window, shutdown)
 
         def mk_dask(task_desc: TaskDescription):
-            qsize = 100
             executor = _get_distributed_executor(self._opts)
-            return (executor, qsize, noop)
+            return (executor, AdaptiveWindow(100, min_size=10, max_size=1000), noop)
 
         def mk_celery(task_desc: TaskDescription):
-            qsize = 100
             executor = mk_celery_executor(*self._opts)
-            return (executor, qsize, noop)
+            return (executor, AdaptiveWindow(100, min_size=10, max_size=1000), noop)
 
         def mk_multiproc(task_desc: TaskDescription):
-            qsize = 100
             executor = _get_concurrent_executor(self._opts)
-            return (executor, qsize, noop)
+            return (executor, AdaptiveWindow(100, min_size=10, max_size=1000), noop)
+
+        def mk_local(task_desc: TaskDescription):
+            workers = self._opts
+            executor = LocalProcessExecutor(workers, chunk_size=self._chunk_size,
+                                            app_name=task_desc.type_ if task_desc else 'dea-worker',
+                                            config_paths=self._config_paths,
+                                            environment=self._environment)
+            # Enough to keep every worker busy with a chunk while the next is queued.
+            in_flight = workers * self._chunk_size
+            return (executor, AdaptiveWindow(in_flight * 2, min_size=in_flight, max_size=in_flight * 8),
+                    executor.shutdown)
 
         def mk_serial(task_desc: TaskDescription):
-            qsize = 10
             executor = SerialExecutor()
-            return (executor, qsize, noop)
+            return (executor, AdaptiveWindow.fixed(10), noop)
 
         mk = dict(pbs_celery=mk_pbs_celery,
                   celery=mk_celery,
                   dask=mk_dask,
                   multiproc=mk_multiproc,
+                  local=mk_local,
                   serial=mk_serial)
 
         try:
             (self._executor,
-             default_queue_size,
+             default_window,
              self._shutdown) = mk.get(self._kind, mk_serial)(task_desc)
         except RuntimeError:
             _LOG.exception("Error starting executor")
             return False
 
         if self._user_queue_size is not None:
-            self._queue_size = self._user_queue_size
+            # A queue size given by the user is used as-is.
+            self._window = AdaptiveWindow.fixed(self._user_queue_size)
         else:
-            self._queue_size = default_queue_size
+            self._window = default_window
+        _LOG.info('Task window: %d in flight (min %d, max %d)',
+                  self._window.size, self._window.min_size, self._window.max_size)
 
     def stop(self):
         if self._shutdown is not None:
             self._shutdown()
             self._executor = None
-            self._queue_size = None
+            self._window = None
             self._shutdown = None
 
-    def __call__(self, task_desc: TaskDescription, tasks, run_task, on_task_complete=None):
+    def __call__(self, task_desc: TaskDescription, tasks, run_task, on_task_complete=None,
+                 on_task_batch_complete=None, is_idempotent=None) -> TaskCounts:
+        """
+        :param is_idempotent: a function that says whether a task can safely be run twice at once,
+                              so may be speculatively resubmitted if it straggles.
+        """
         if self._executor is None:
             if self.start(task_desc) is False:
                 raise RuntimeError('Failed to launch worker pool')
 
-        return run_tasks(tasks, self._executor, run_task, on_task_complete, self._queue_size)
+        run = partial(run_tasks,
+                      executor=self._executor,
+                      run_task=run_task,
+                      process_result=on_task_complete,
+                      window=self._window,
+                      process_result_batch=on_task_batch_complete,
+                      retry_policy=self._retry_policy,
+                      straggler_policy=self._straggler_policy,
+                      is_idempotent=is_idempotent)
+
+        if task_desc is None or task_desc.events_path is None:
+            return run(tasks)
+
+        # Record completed tasks in the job's events directory, so that a resubmitted job can skip them.
+        with CompletionLog.for_events_dir(task_desc.events_path) as completion_log:
+            if self._skip_completed:
+                tasks = completion_log.skip_completed(tasks, verify_outputs=self._verify_outputs)
+            return run(tasks, task_completed=completion_log.record)
 
 
 def get_current_obj(ctx=None):
@@ -621,6 +896,12 @@ class QsubRunState:
         self.qsub: QSubLauncher = None
         self.qsize: int = None
         self.workers_per_node: int = None
+        self.skip_completed: bool = True
+        self.verify_outputs: bool = False
+        self.retries: int = None
+        self.straggler_factor: float = None
+        self.speculate: bool = False
+        self.chunk_size: int = None
 
 
 def with_qsub_runner():
@@ -628,9 +909,15 @@ def with_qsub_runner():
     Will add the following options
 
     --parallel <int>
+    --chunk-size <int>
     --dask 'host:port'
     --celery 'host:port'|'pbs-launch'
     --queue-size <int>
+    --skip-completed|--rerun-completed
+    --verify-outputs
+    --retries <int>
+    --straggler-factor <float>
+    --speculate
     --qsub <qsub-params>
 
     Will populate variables
@@ -647,10 +934,10 @@ def with_qsub_runner():
             obj[o_key] = QsubRunState()
         return obj[o_key]
 
-    def add_multiproc_executor(ctx, param, value):
+    def add_local_executor(ctx, param, value):
         if value is None:
             return
-        state(ctx).runner = TaskRunner('multiproc', value)
+        state(ctx).runner = TaskRunner('local', value)
 
     def add_dask_executor(ctx, param, value):
         if value is None:
@@ -670,11 +957,29 @@ def with_qsub_runner():
             return
         state(ctx).qsize = value
 
+    def set_chunk_size(ctx, param, value):
+        state(ctx).chunk_size = value
+
     def set_workers_per_node(ctx, param, value):
         if value is None:
             return
         state(ctx).workers_per_node = value
 
+    def set_skip_completed(ctx, param, value):
+        state(ctx).skip_completed = value
+
+    def set_verify_outputs(ctx, param, value):
+        state(ctx).verify_outputs = value
+
+    def set_retries(ctx, param, value):
+        state(ctx).retries = value
+
+    def set_straggler_factor(ctx, param, value):
+        state(ctx).straggler_factor = value
+
+    def set_speculate(ctx, param, value):
+        state(ctx).speculate = value
+
     def capture_qsub(ctx, param, value):
         if value is None:
             return None
@@ -685,9 +990,14 @@ def with_qsub_runner():
         opts = [
             click.option('--parallel',
                          type=int,
-                         help='Run locally in parallel',
+                         help='Run locally in parallel, on this many worker processes',
                          expose_value=False,
-                         callback=add_multiproc_executor),
+                         callback=add_local_executor),
+            click.option('--chunk-size',
+                         type=click.IntRange(1, None),
+                         expose_value=False,
+                         callback=set_chunk_size,
+                         help='With --parallel, send tasks to workers this many at a time (for small tasks)'),
             click.option('--dask',
                          type=HostPort(),
                          help=(
@@ -715,6 +1025,33 @@ def with_qsub_runner():
                          expose_value=False,
                          callback=set_workers_per_node,
                          help='For code that parallelizes over cores'),
+            click.option('--skip-completed/--rerun-completed',
+                         default=True,
+                         expose_value=False,
+                         callback=set_skip_completed,
+                         help='Skip tasks recorded as completed by earlier runs of the job (default: skip)'),
+            click.option('--verify-outputs',
+                         is_flag=True,
+                         default=False,
+                         expose_value=False,
+                         callback=set_verify_outputs,
+                         help='When skipping completed tasks, rerun any whose output file is missing'),
+            click.option('--retries',
+                         type=click.IntRange(0, None),
+                         expose_value=False,
+                         callback=set_retries,
+                         help='Retry failed tasks this many times, with increasing delays (default: 0)'),
+            click.option('--straggler-factor',
+                         type=click.FloatRange(1, None),
+                         expose_value=False,
+                         callback=set_straggler_factor,
+                         help='Flag tasks that take this many times longer than the median'),
+            click.option('--speculate',
+                         is_flag=True,
+                         default=False,
+                         expose_value=False,
+                         callback=set_speculate,
+                         help='Resubmit flagged tasks (if they can safely run twice), taking the first to finish'),
             click.option('--qsub',
                          type=QSubParamType(),
                          callback=capture_qsub,
@@ -745,6 +1082,44 @@ def with_qsub_runner():
             if s.runner is not None and s.workers_per_node is not None:
                 s.runner.set_workers_per_node(s.workers_per_node)
 
+            if s.runner is not None and s.chunk_size is not None:
+                s.runner.set_chunk_size(s.chunk_size)
+
+            if s.qsub is not None and s.chunk_size is not None:
+                s.qsub.add_internal_args('--chunk-size', str(s.chunk_size))
+
+            if s.runner is not None:
+                s.runner.set_completion_checks(s.skip_completed, s.verify_outputs)
+
+            if s.runner is not None:
+                # Set by datacube's config and environment options, if the app has them.
+                obj = get_current_obj()
+                s.runner.set_index_config(obj.get('config_files'), obj.get('config_environment'))
+
+            if s.qsub is not None and not s.skip_completed:
+                s.qsub.add_internal_args('--rerun-completed')
+
+            if s.qsub is not None and s.verify_outputs:
+                s.qsub.add_internal_args('--verify-outputs')
+
+            if s.runner is not None and s.retries is not None:
+                s.runner.set_retry_policy(RetryPolicy(attempts=s.retries + 1))
+
+            if s.qsub is not None and s.retries is not None:
+                s.qsub.add_internal_args('--retries', str(s.retries))
+
+            if s.speculate and s.straggler_factor is None:
+                s.straggler_factor = StragglerPolicy().factor
+
+            if s.runner is not None and s.straggler_factor is not None:
+                s.runner.set_straggler_policy(StragglerPolicy(factor=s.straggler_factor, speculate=s.speculate))
+
+            if s.qsub is not None and s.straggler_factor is not None:
+                s.qsub.add_internal_args('--straggler-factor', str(s.straggler_factor))
+
+            if s.qsub is not None and s.speculate:
+                s.qsub.add_internal_args('--speculate')
+
         def extract_runner(*args, **kwargs):
             finalise_state()
             kwargs.update({arg_name: state().runner})
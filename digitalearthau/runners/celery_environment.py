@@ -10,12 +10,13 @@ from time import sleep, time
 
 import celery.events.state as celery_state
 import celery.states
+import redis
 import datetime
 import subprocess
 from celery.events import EventReceiver
 from dateutil import tz
 from multiprocessing import Process
-from typing import Optional, List, Iterable
+from typing import Callable, Optional, List, Iterable
 
 from datacube import _celery_runner as cr
 from digitalearthau import serialise, pbs
@@ -25,6 +26,13 @@ from digitalearthau.runners.model import TaskDescription
 
 _LOG = logging.getLogger(__name__)
 
+# How often the event logger writes a summary of task states, in seconds
+TASK_STATE_LOG_INTERVAL = 60
+
+# Collected events are written out once this many bytes are buffered, or after this many seconds.
+EVENT_BUFFER_SIZE = 256 * 1024
+EVENT_FLUSH_INTERVAL = 5
+
 # The stringified args that celery gives us back within task messages
 _EXAMPLE_TASK_ARGS = "'(functools.partial(<function do_fc_task at 0x7f47e7aad598>, {" \
                      "\'source_type\': \'ls8_nbar_albers\', \'output_type\': \'ls8_fc_albers\', " \
@@ -141,6 +149,7 @@ def _run_celery_task_logging(
 
     _LOG.info("Logger process started")
     state: celery_state.State = app.events.State()
+    task_states = TaskStateCounter()
 
     # TODO: handling immature shutdown cleanly? The celery runner itself might need better support for it...
 
@@ -150,12 +159,20 @@ def _run_celery_task_logging(
     signal.signal(signal.SIGTERM, signal.SIG_IGN)
 
     def handle_task(event):
+        event_type: str = event['type']
+        is_task_event = event_type.startswith('task-')
 
-        state.event(event)
+        if is_task_event and task_states.is_finished(event['uuid']):
+            # Its final event has been written, and it's been evicted from state.
+            _LOG.debug("Skipping late %r event of finished task %s", event_type, event['uuid'])
+            return
 
-        event_type: str = event['type']
+        previous_task: celery_state.Task = state.tasks.get(event['uuid']) if is_task_event else None
+        previous_state = previous_task.state if previous_task else None
+
+        state.event(event)
 
-        if not event_type.startswith('task-'):
+        if not is_task_event:
             _LOG.debug("Skipping event %r", event_type)
             return
 
@@ -167,12 +184,21 @@ def _run_celery_task_logging(
             _LOG.warning(f"No task found {event_type}")
             return
         output.write_item(_celery_event_to_task(task_desc, task))
-        _log_task_states(state)
+
+        if task_states.transition(task.id, previous_state, task.state):
+            # We've recorded all we need: don't let finished tasks accumulate in memory.
+            state.tasks.pop(task.id, None)
+        task_states.maybe_log()
 
     timestamp = datetime.datetime.utcnow().timestamp()
     events_path = task_desc.events_path.joinpath(f'{int(timestamp)}-{socket.gethostname()}-collected-events.jsonl')
 
-    with serialise.JsonLinesWriter(events_path.open('a')) as output:
+    # Events are buffered: flushing each one to Lustre slows the logger down. Every event repeats the
+    # job parameters and a handful of nodes, so their serialised forms are reused.
+    with serialise.JsonLinesWriter(events_path.open('a'),
+                                   buffer_size=EVENT_BUFFER_SIZE,
+                                   flush_interval=EVENT_FLUSH_INTERVAL,
+                                   cached_fields=('job_parameters', 'node')) as output:
         with app.connection() as connection:
 
             recv: EventReceiver = app.events.Receiver(connection, handlers={
@@ -189,6 +215,9 @@ def _run_celery_task_logging(
                 except socket.timeout:
                     pass
 
+                task_states.maybe_log()
+                output.flush_if_due()
+
                 # We get a signal from the main process when it has terminated all workers, but there may still be
                 # events to consume.
                 if should_shutdown.value:
@@ -206,7 +235,7 @@ def _run_celery_task_logging(
 
             _LOG.info("Celery event subscription finished")
 
-    _log_task_states(state)
+    task_states.log()
 
     # According to our recorded state we should have seen all workers stop.
     workers: List[celery_state.Worker] = list(state.workers.values())
@@ -224,11 +253,68 @@ def _run_celery_task_logging(
     _LOG.info("Logger process exiting")
 
 
-def _log_task_states(state):
-    # Print count of tasks in each state.
-    tasks: Iterable[celery_state.Task] = state.tasks.values()
-    task_states = collections.Counter(t.state for t in tasks)
-    _LOG.info("Task states: %s", ", ".join(f"{v} {k}" for (k, v) in task_states.items()))
+class TaskStateCounter:
+    """
+    Count celery tasks in each state, updated as each task changes state.
+
+    This lets finished tasks be evicted from the celery State. The ids of recently-finished
+    tasks are remembered, so that any of their events that arrive late can be ignored.
+
+    >>> counter = TaskStateCounter()
+    >>> counter.transition('a', None, 'RECEIVED'), counter.transition('b', None, 'RECEIVED')
+    (False, False)
+    >>> counter.transition('a', 'RECEIVED', 'STARTED'), counter.transition('a', 'STARTED', 'SUCCESS')
+    (False, True)
+    >>> counter.summary()
+    '1 RECEIVED, 1 SUCCESS'
+    >>> counter.is_finished('a'), counter.is_finished('b')
+    (True, False)
+    """
+
+    def __init__(self,
+                 log_interval: float = TASK_STATE_LOG_INTERVAL,
+                 remember_finished: int = 10000,
+                 clock: Callable[[], float] = time) -> None:
+        self.counts = collections.Counter()
+        self._log_interval = log_interval
+        self._clock = clock
+        self._last_log = clock()
+
+        self._remember_finished = remember_finished
+        self._finished = collections.OrderedDict()
+
+    def transition(self, task_id: str, previous_state: Optional[str], new_state: Optional[str]) -> bool:
+        """
+        Record a task's change of state. Returns True if it has finished.
+        """
+        if previous_state != new_state:
+            if previous_state is not None:
+                self.counts[previous_state] -= 1
+                if not self.counts[previous_state]:
+                    del self.counts[previous_state]
+            if new_state is not None:
+                self.counts[new_state] += 1
+
+        if new_state in celery.states.READY_STATES:
+            self._finished[task_id] = True
+            if len(self._finished) > self._remember_finished:
+                self._finished.popitem(last=False)
+            return True
+        return False
+
+    def is_finished(self, task_id: str) -> bool:
+        return task_id in self._finished
+
+    def summary(self) -> str:
+        return ", ".join(f"{v} {k}" for (k, v) in sorted(self.counts.items()))
+
+    def maybe_log(self):
+        if self._clock() - self._last_log >= self._log_interval:
+            self.log()
+
+    def log(self):
+        self._last_log = self._clock()
+        _LOG.info("Task states: %s", self.summary())
 
 
 def _utc_datetime(timestamp: float):
@@ -260,6 +346,27 @@ def _just_the_hostname(hostname: str):
     return parts[-1]
 
 
+def redis_memory_probe(host: str, port: int, password: str = None) -> Callable[[], Optional[float]]:
+    """
+    Make a function that returns the fraction of Redis' maxmemory that is in use (None if unknown)
+    """
+    server = redis.Redis(host, port, password=password)
+
+    def probe() -> Optional[float]:
+        try:
+            info = server.info('memory')
+        except redis.exceptions.RedisError as e:
+            _LOG.debug('Could not read redis memory: %s', e)
+            return None
+
+        max_memory = info.get('maxmemory')
+        if not max_memory:
+            return None
+        return info['used_memory'] / max_memory
+
+    return probe
+
+
 def launch_celery_worker_environment(task_desc: TaskDescription,
                                      redis_params: dict,
                                      workers_per_node: int = None):
@@ -0,0 +1,146 @@
+"""
+A record of which tasks of a job have completed, so that a resubmitted job can skip them.
+
+Completed tasks are appended to a JSON-Lines file in the job's events directory as each
+one finishes, so the record survives the job being killed (eg. at walltime).
+"""
+import datetime
+import json
+import logging
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional, Set
+
+from dateutil import tz
+
+from digitalearthau import serialise
+
+_LOG = logging.getLogger(__name__)
+
+COMPLETION_LOG_NAME = 'completed-tasks.jsonl'
+
+
+class CompletedTask(NamedTuple):
+    id: str
+    completion_time: datetime.datetime
+    # The task's output file, if known.
+    output_path: Optional[str] = None
+
+
+def task_identifier(task) -> str:
+    """
+    A unique name for the task.
+
+    As with `qsub.describe_task()`, but the output filename is preferred when there is one, as
+    several tasks can share a tile index (eg. one per year).
+
+    >>> task_identifier({'tile_index': (15, -40), 'filename': '/g/data/LS8_OLI_NBAR_15_-40_2015.nc'})
+    '/g/data/LS8_OLI_NBAR_15_-40_2015.nc'
+    >>> task_identifier({'tile_index': (15, -40)})
+    '(15, -40)'
+    """
+    output_path = _task_output_path(task)
+    if output_path is not None:
+        return output_path
+    if hasattr(task, 'get'):
+        tile_index = task.get('tile_index')
+        if tile_index is not None:
+            return str(tile_index)
+    return repr(task)
+
+
+def _task_output_path(task) -> Optional[str]:
+    if hasattr(task, 'get'):
+        filename = task.get('filename')
+        if filename is not None:
+            return str(filename)
+    return None
+
+
+class CompletionLog:
+    """
+    Record completed tasks, and skip those completed by previous runs.
+
+    Use as a context manager.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self._completed = self._read_completed(path)  # type: Set[str]
+        self._file = None
+        self._writer = None  # type: Optional[serialise.JsonLinesWriter]
+
+    @classmethod
+    def for_events_dir(cls, events_path: Path) -> 'CompletionLog':
+        return cls(events_path.joinpath(COMPLETION_LOG_NAME))
+
+    @staticmethod
+    def _read_completed(path: Path) -> Set[str]:
+        if not path.exists():
+            return set()
+        completed = set()
+        with path.open('r') as f:
+            for line in f:
+                line = line.strip()
+                # The last line may be incomplete if we were killed while writing it.
+                if not line:
+                    continue
+                try:
+                    completed.add(json.loads(line)['id'])
+                except ValueError:
+                    _LOG.warning('Ignoring unreadable line in %s: %r', path, line)
+        return completed
+
+    def __len__(self):
+        return len(self._completed)
+
+    def is_complete(self, task) -> bool:
+        return task_identifier(task) in self._completed
+
+    def record(self, task):
+        task_id = task_identifier(task)
+        if self._writer is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._file = self.path.open('a')
+            self._writer = serialise.JsonLinesWriter(self._file)
+        self._writer.write_item(
+            CompletedTask(
+                id=task_id,
+                completion_time=datetime.datetime.now(tz=tz.tzutc()),
+                output_path=_task_output_path(task),
+            )
+        )
+        self._completed.add(task_id)
+
+    def skip_completed(self, tasks: Iterable, verify_outputs=False) -> Iterator:
+        """
+        Filter out tasks completed in earlier runs.
+
+        :param verify_outputs: Rerun a completed task if its output file no longer exists.
+        """
+        if not self._completed:
+            yield from tasks
+            return
+
+        skipped = 0
+        for task in tasks:
+            if self.is_complete(task):
+                output_path = _task_output_path(task)
+                if verify_outputs and output_path is not None and not Path(output_path).exists():
+                    _LOG.warning('Rerunning completed task, as its output is missing: %s', output_path)
+                else:
+                    skipped += 1
+                    _LOG.debug('Skipping completed task: %s', task_identifier(task))
+                    continue
+            yield task
+        _LOG.info('Skipped %d tasks completed by earlier runs', skipped)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
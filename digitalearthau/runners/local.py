@@ -0,0 +1,207 @@
+"""
+Run tasks on a local pool of processes, each of which sets itself up once.
+
+Datacube's multiproc executor starts bare processes: every task pays again for importing
+datacube and GDAL and for connecting to the index. Here each worker process does that in
+its initialiser, and tasks can reuse the process' index with `worker_index()`.
+
+Small tasks can also be sent to workers in chunks, so that there's one round-trip to a
+worker per chunk rather than per task.
+"""
+import importlib
+import logging
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from typing import List, Optional, Sequence, Tuple
+
+from datacube.config import LocalConfig
+from datacube.index import Index, index_connect
+
+_LOG = logging.getLogger(__name__)
+
+# Imported by each worker when it starts. (Those that aren't installed are skipped)
+PRELOAD_MODULES = (
+    'datacube',
+    'datacube.api',
+    'datacube.drivers.netcdf',
+    'osgeo.gdal',
+    'rasterio',
+    'xarray',
+)
+
+# The index connection of this worker process, and how to open it
+_WORKER_INDEX = None  # type: Optional[Index]
+_WORKER_APP_NAME = 'dea-worker'
+_WORKER_CONFIG_PATHS = None  # type: Optional[Sequence[str]]
+_WORKER_ENVIRONMENT = None  # type: Optional[str]
+
+
+def _init_worker(app_name: str, preload_modules, open_index: bool,
+                 config_paths: Optional[Sequence[str]], environment: Optional[str]):
+    global _WORKER_APP_NAME, _WORKER_CONFIG_PATHS, _WORKER_ENVIRONMENT  # pylint: disable=global-statement
+    _WORKER_APP_NAME = app_name
+    _WORKER_CONFIG_PATHS = config_paths
+    _WORKER_ENVIRONMENT = environment
+
+    for module in preload_modules:
+        try:
+            importlib.import_module(module)
+        except ImportError:
+            _LOG.debug('Could not preload %s', module)
+
+    if open_index:
+        # Not every app uses the index: a failure here mustn't break the worker.
+        # A task that does will try again (and fail) in worker_index().
+        try:
+            worker_index()
+        except Exception:  # pylint: disable=broad-except
+            _LOG.warning('Could not connect to the index when starting worker', exc_info=True)
+
+
+def worker_index() -> Index:
+    """
+    The index connection of the current worker process.
+
+    Opened once per process (when it starts, for workers of a LocalProcessExecutor), and
+    reused by every task it runs. It uses the same datacube config as the process that
+    created the executor.
+    """
+    global _WORKER_INDEX  # pylint: disable=global-statement
+    if _WORKER_INDEX is None:
+        config = LocalConfig.find(paths=_WORKER_CONFIG_PATHS, env=_WORKER_ENVIRONMENT)
+        _WORKER_INDEX = index_connect(config, application_name=_WORKER_APP_NAME)
+    return _WORKER_INDEX
+
+
+def _run_chunk(func, chunk: List[Tuple[tuple, dict]]) -> list:
+    """Run a chunk of tasks in a worker, returning each one's (succeeded, result or exception)"""
+    outcomes = []
+    for args, kwargs in chunk:
+        try:
+            outcomes.append((True, func(*args, **kwargs)))
+        except Exception as e:  # pylint: disable=broad-except
+            outcomes.append((False, e))
+    return outcomes
+
+
+class LocalProcessExecutor:
+    """
+    A datacube-style executor (as used by `qsub.run_tasks`) over a local process pool.
+
+    With a `chunk_size` above one, submitted tasks are held until a chunk is full, or until
+    something waits for a result, and then sent to a worker together. Each task still gets
+    its own future.
+
+    Workers connect to the index with the given datacube config paths and environment
+    (as given to `-C` and `--env`), or the defaults.
+    """
+
+    def __init__(self,
+                 workers: int,
+                 chunk_size: int = 1,
+                 app_name: str = 'dea-worker',
+                 preload_modules=PRELOAD_MODULES,
+                 open_index: bool = True,
+                 config_paths: Sequence[str] = None,
+                 environment: str = None) -> None:
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self._pool = ProcessPoolExecutor(
+            workers,
+            initializer=_init_worker,
+            initargs=(app_name, tuple(preload_modules), open_index,
+                      tuple(config_paths) if config_paths else None, environment),
+        )
+        # Tasks waiting for their chunk to be sent: the function, and each task's (args, kwargs, future)
+        self._pending_func = None
+        self._pending = []  # type: List[tuple]
+
+    def __repr__(self):
+        return 'LocalProcessExecutor({} workers, chunks of {})'.format(self.workers, self.chunk_size)
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        if self._pending and func is not self._pending_func:
+            self._send_chunk()
+
+        future = Future()
+        self._pending_func = func
+        self._pending.append((args, kwargs, future))
+        if len(self._pending) >= self.chunk_size:
+            self._send_chunk()
+        return future
+
+    def _send_chunk(self):
+        func, pending = self._pending_func, self._pending
+        self._pending_func, self._pending = None, []
+        if not pending:
+            return
+
+        futures = [future for _, _, future in pending]
+        for future in futures:
+            future.set_running_or_notify_cancel()
+
+        def chunk_done(chunk_future: Future):
+            try:
+                outcomes = chunk_future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                # The whole chunk failed (such as a worker dying)
+                for future in futures:
+                    future.set_exception(e)
+                return
+            for future, (succeeded, value) in zip(futures, outcomes):
+                if succeeded:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+        chunk = [(args, kwargs) for args, kwargs, _ in pending]
+        self._pool.submit(_run_chunk, func, chunk).add_done_callback(chunk_done)
+
+    def flush(self):
+        """Send any tasks waiting for a full chunk"""
+        self._send_chunk()
+
+    def map(self, func, iterable):
+        return [self.submit(func, data) for data in iterable]
+
+    def get_ready(self, futures):
+        self.flush()
+        completed = []
+        failed = []
+        pending = []
+        for f in futures:
+            if f.done():
+                if f.exception():
+                    failed.append(f)
+                else:
+                    completed.append(f)
+            else:
+                pending.append(f)
+        return completed, failed, pending
+
+    def as_completed(self, futures):
+        self.flush()
+        return as_completed(futures)
+
+    def next_completed(self, futures, default):
+        results = list(futures)
+        if not results:
+            return default, results
+        result = next(self.as_completed(results), default)
+        results.remove(result)
+        return result, results
+
+    def results(self, futures):
+        self.flush()
+        return [future.result() for future in futures]
+
+    def result(self, future):
+        self.flush()
+        return future.result()
+
+    @staticmethod
+    def release(future):
+        pass
+
+    def shutdown(self):
+        self.flush()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,125 @@
+"""
+Processing of task results on a separate thread.
+
+Handling a result (such as recording its outputs in the index) can take as long as
+waiting for the next one. Doing it on the dispatch loop leaves workers idle, so
+results are instead passed through a bounded queue to a consumer thread.
+"""
+import logging
+import queue
+import threading
+from typing import Callable, List, Optional, Tuple
+
+_LOG = logging.getLogger(__name__)
+
+# Put on the queue (last) to tell the consumer to finish.
+_STOP = object()
+
+
+class ResultConsumer:
+    """
+    Process task results on a background thread.
+
+    Give either `process_result`, called with each result, or `process_batch`, called
+    with a list of results. Results that have accumulated while the previous batch was
+    being processed (up to `batch_size`) are handled together, so a slow index makes for
+    fewer, larger transactions rather than a growing backlog. If a batch fails, its results
+    are retried one at a time so that a single bad result doesn't fail the others.
+
+    Once the queue holds `queue_size` results, `put()` blocks until the consumer catches up.
+
+    If given, `on_processed` is called (on the consumer thread) with the task of each result that
+    was processed successfully.
+
+    Use as a context manager: all queued results are processed before it exits.
+    """
+
+    def __init__(self,
+                 process_result: Callable[[object], None] = None,
+                 process_batch: Callable[[List[object]], None] = None,
+                 queue_size: int = 100,
+                 batch_size: int = 50,
+                 on_processed: Callable[[object], None] = None) -> None:
+        if (process_result is None) == (process_batch is None):
+            raise ValueError('Exactly one of process_result or process_batch is required')
+        self._process_result = process_result
+        self._process_batch = process_batch
+        self._batch_size = batch_size if process_batch is not None else 1
+        self._on_processed = on_processed
+
+        self._queue = queue.Queue(maxsize=queue_size)  # type: queue.Queue
+        self._thread = None  # type: Optional[threading.Thread]
+
+        # Only read these once the consumer has finished.
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='result-consumer', daemon=True)
+        self._thread.start()
+
+    def put(self, result, task=None):
+        self._queue.put((task, result))
+
+    def close(self):
+        """Wait for all queued results to be processed"""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size and batch[-1] is not _STOP:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stopping = batch[-1] is _STOP
+            if stopping:
+                batch.pop()
+            if batch:
+                self._process(batch)
+            if stopping:
+                return
+
+    def _process(self, batch: List[Tuple[object, object]]):
+        if self._process_batch is not None and len(batch) > 1:
+            try:
+                self._process_batch([result for _, result in batch])
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception('Failed to process a batch of %d results, retrying them individually', len(batch))
+            else:
+                for task, _ in batch:
+                    self._processed(task)
+                return
+
+        for task, result in batch:
+            try:
+                if self._process_batch is not None:
+                    self._process_batch([result])
+                else:
+                    self._process_result(result)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOG.exception('Result processing failed: %s', err)
+                self.failed += 1
+            else:
+                self._processed(task)
+
+    def _processed(self, task):
+        self.processed += 1
+        if self._on_processed is not None:
+            try:
+                self._on_processed(task)
+            except Exception:  # pylint: disable=broad-except
+                _LOG.exception('Failed to record a processed result')
@@ -0,0 +1,91 @@
+"""
+What to do about tasks that fail, or that run much longer than the others ("stragglers").
+
+Large runs often spend the end of their walltime waiting on a few slow tasks: a bad node,
+or a contended filesystem. Tasks taking several times the median duration are flagged, and
+(if they can safely be run twice) a second copy is submitted to race the first.
+"""
+import statistics
+from collections import deque
+from typing import NamedTuple, Optional
+
+
+class RetryPolicy(NamedTuple):
+    """
+    How many times to attempt a failing task, and how long to wait before each retry.
+
+    The wait doubles after each failure, up to max_backoff.
+
+    >>> policy = RetryPolicy(attempts=5, backoff=10, max_backoff=60)
+    >>> [policy.delay(failures) for failures in range(1, 5)]
+    [10, 20, 40, 60]
+    >>> policy.should_retry(4), policy.should_retry(5)
+    (True, False)
+    """
+    # Total attempts (so 1 means no retries)
+    attempts: int = 1
+    # Seconds to wait before the first retry
+    backoff: float = 30.0
+    max_backoff: float = 600.0
+
+    def should_retry(self, failures: int) -> bool:
+        return failures < self.attempts
+
+    def delay(self, failures: int) -> float:
+        return min(self.backoff * 2 ** (failures - 1), self.max_backoff)
+
+
+NO_RETRIES = RetryPolicy()
+
+
+class StragglerPolicy(NamedTuple):
+    # Flag tasks that have been running this many times longer than the median.
+    factor: float = 3.0
+    # How many tasks must have finished before we trust the median.
+    min_samples: int = 10
+    # Submit a second copy of straggling tasks (if they're idempotent), and take whichever finishes first.
+    speculate: bool = False
+    # The most speculative copies to have running at once.
+    max_speculative: int = 10
+    # How often to look for stragglers, in seconds
+    check_interval: float = 10.0
+
+
+class TaskDurations:
+    """
+    Durations of recently-completed tasks.
+
+    Durations are measured from submission, so include time spent queued. That's the same
+    for every task once the queue is steady, and stragglers stand out at the end of a run,
+    when the queue has drained.
+
+    >>> durations = TaskDurations()
+    >>> for seconds in (10, 12, 11, 300):
+    ...     durations.add(seconds)
+    >>> durations.median()
+    11.5
+    >>> durations.straggler_threshold(StragglerPolicy(factor=3, min_samples=4))
+    34.5
+    >>> durations.straggler_threshold(StragglerPolicy(factor=3, min_samples=5)) is None
+    True
+    """
+
+    def __init__(self, sample_size: int = 500) -> None:
+        self._recent = deque(maxlen=sample_size)  # type: deque
+
+    def add(self, seconds: float):
+        self._recent.append(seconds)
+
+    def __len__(self):
+        return len(self._recent)
+
+    def median(self) -> Optional[float]:
+        if not self._recent:
+            return None
+        return statistics.median(self._recent)
+
+    def straggler_threshold(self, policy: StragglerPolicy) -> Optional[float]:
+        """How long a task can run before it's a straggler (None if we can't tell yet)"""
+        if len(self._recent) < policy.min_samples:
+            return None
+        return self.median() * policy.factor
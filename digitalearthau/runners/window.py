@@ -0,0 +1,235 @@
+"""
+Adaptive sizing of the number of tasks kept in flight.
+
+Too few tasks in flight and workers sit idle waiting for more; too many and the
+broker (Redis) has to buffer all of their payloads. The right number depends on how
+long tasks take and how large they are, which varies between apps.
+
+The window is adjusted in the manner of TCP Vegas: we track the smallest (smoothed)
+time a task has recently taken from submission to result, and treat anything above that
+as time spent queued. Little queueing means workers may be idle, so the window grows; lots
+of queueing means we're only filling the broker, so it shrinks. Broker memory pressure
+shrinks it quickly, and an estimate of each task's payload size caps it.
+"""
+import logging
+import pickle
+import time
+from typing import Callable, Optional, Tuple
+
+_LOG = logging.getLogger(__name__)
+
+# Fraction of the broker's memory that queued task payloads may use.
+# (the rest is left for results and bookkeeping)
+BROKER_MEMORY_BUDGET_FRACTION = 0.5
+
+# Above this fraction of broker memory in use we stop growing, and above the high mark we halve the window.
+BROKER_MEMORY_LOW_WATERMARK = 0.6
+BROKER_MEMORY_HIGH_WATERMARK = 0.8
+
+# How often to probe broker memory, in seconds
+MEMORY_PROBE_INTERVAL = 5.0
+
+# How long the smallest latency seen is trusted as the unqueued latency, in seconds. Tasks may
+# legitimately get slower during a run (eg. larger inputs), so older minimums are forgotten.
+BASE_LATENCY_PERIOD = 600.0
+
+# How often to log the window sizes, in seconds (also logged at the end of a run)
+LOG_INTERVAL = 60.0
+
+# Task payloads are sized by pickling them: do it for the first few, then only a sample.
+_PAYLOAD_FULL_SAMPLES = 10
+_PAYLOAD_SAMPLE_EVERY = 50
+
+
+class AdaptiveWindow:
+    """
+    How many tasks to keep submitted at once.
+
+    Call `submitted()` as each task is submitted, and `completed()` with its latency as
+    each result arrives. `size` is the current window.
+
+    A window with min_size == max_size is fixed, and never adjusts.
+    """
+
+    # Queued tasks (in excess of those being processed) to aim for: Vegas' alpha and beta.
+    QUEUED_LOW = 2
+    QUEUED_HIGH = 6
+
+    # Smoothing of the latency average
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self,
+                 initial: int,
+                 min_size: int = 1,
+                 max_size: int = None,
+                 memory_probe: Callable[[], Optional[float]] = None,
+                 memory_budget_bytes: int = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        """
+        :param memory_probe: returns the fraction of broker memory in use (or None if unknown)
+        :param memory_budget_bytes: how many bytes of task payloads the broker can hold.
+        """
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size if max_size is not None else initial)
+        self.size = self._clamp(initial)
+
+        self._memory_probe = memory_probe
+        self._memory_budget_bytes = memory_budget_bytes
+        self._clock = clock
+
+        self._payload_samples = 0
+        self._mean_payload_bytes = None  # type: Optional[float]
+        self._submitted_count = 0
+
+        self._smoothed_latency = None  # type: Optional[float]
+        # The smallest latency of the previous and current periods, and of the current period alone.
+        self._base_latency = None  # type: Optional[float]
+        self._period_min_latency = None  # type: Optional[float]
+        self._period_start = None  # type: Optional[float]
+        self._memory_usage = None  # type: Optional[float]
+        self._last_probe = None  # type: Optional[float]
+        self._last_log = None  # type: Optional[float]
+
+        # Smallest and largest sizes actually used
+        self.smallest = self.largest = self.size
+
+    @classmethod
+    def fixed(cls, size: int) -> 'AdaptiveWindow':
+        return cls(size, min_size=size, max_size=size)
+
+    @property
+    def is_fixed(self):
+        return self.min_size == self.max_size
+
+    @property
+    def cap(self) -> int:
+        """The largest the window may currently grow to, given the estimated task payload size"""
+        if not self._memory_budget_bytes or not self._mean_payload_bytes:
+            return self.max_size
+        payload_cap = int(self._memory_budget_bytes // self._mean_payload_bytes)
+        return max(self.min_size, min(self.max_size, payload_cap))
+
+    def submitted(self, task):
+        """Record a task submission (sampling its payload size)"""
+        self._submitted_count += 1
+        if self.is_fixed or not self._memory_budget_bytes:
+            return
+        if self._payload_samples < _PAYLOAD_FULL_SAMPLES or self._submitted_count % _PAYLOAD_SAMPLE_EVERY == 0:
+            try:
+                payload_bytes = len(pickle.dumps(task, protocol=pickle.HIGHEST_PROTOCOL))
+            except Exception:  # pylint: disable=broad-except
+                # Unpicklable tasks will fail on submission anyway: don't estimate from them.
+                return
+            self._payload_samples += 1
+            if self._mean_payload_bytes is None:
+                self._mean_payload_bytes = float(payload_bytes)
+            else:
+                self._mean_payload_bytes += (payload_bytes - self._mean_payload_bytes) / self._payload_samples
+
+            if self.size > self.cap:
+                self._resize(self.cap, 'payload_cap')
+
+    def completed(self, latency: float):
+        """Record a task result, which arrived the given number of seconds after submission"""
+        if self.is_fixed:
+            return
+
+        if self._smoothed_latency is None:
+            self._smoothed_latency = latency
+        else:
+            self._smoothed_latency += self.LATENCY_SMOOTHING * (latency - self._smoothed_latency)
+        self._update_base_latency()
+
+        memory_usage, is_fresh = self._probe_memory()
+        if memory_usage is not None and memory_usage >= BROKER_MEMORY_HIGH_WATERMARK:
+            # Halve once per reading: until the next probe we can't tell whether that was enough.
+            if is_fresh:
+                self._resize(self.size // 2, 'broker_memory')
+            return
+
+        # Expected (unqueued) vs. actual latency: the difference is roughly how many of our tasks are queued.
+        if self._smoothed_latency > 0:
+            queued = self.size * (1 - self._base_latency / self._smoothed_latency)
+        else:
+            queued = 0
+
+        if queued < self.QUEUED_LOW:
+            if memory_usage is None or memory_usage < BROKER_MEMORY_LOW_WATERMARK:
+                self._resize(self.size + 1, 'workers_idle')
+        elif queued > self.QUEUED_HIGH:
+            self._resize(self.size - 1, 'latency')
+
+        self._maybe_log()
+
+    def _update_base_latency(self):
+        now = self._clock()
+        if self._period_start is None:
+            self._period_start = now
+        elif now - self._period_start >= BASE_LATENCY_PERIOD:
+            # Forget the minimums from before the period that just ended.
+            self._base_latency = self._period_min_latency
+            self._period_min_latency = None
+            self._period_start = now
+
+        latency = self._smoothed_latency
+        if self._base_latency is None or latency < self._base_latency:
+            self._base_latency = latency
+        if self._period_min_latency is None or latency < self._period_min_latency:
+            self._period_min_latency = latency
+
+    def _probe_memory(self) -> Tuple[Optional[float], bool]:
+        """The fraction of broker memory in use (if known), and whether it's a new reading"""
+        if self._memory_probe is None:
+            return None, False
+        now = self._clock()
+        if self._last_probe is None or now - self._last_probe >= MEMORY_PROBE_INTERVAL:
+            self._last_probe = now
+            self._memory_usage = self._memory_probe()
+            return self._memory_usage, True
+        return self._memory_usage, False
+
+    def _clamp(self, size: int) -> int:
+        return max(self.min_size, min(size, self.max_size))
+
+    def _resize(self, size: int, reason: str):
+        size = max(self.min_size, min(size, self.cap))
+        if size == self.size:
+            return
+        _LOG.debug('Task window %d -> %d (%s)', self.size, size, reason)
+        self.size = size
+        self.smallest = min(self.smallest, size)
+        self.largest = max(self.largest, size)
+
+    def _maybe_log(self):
+        now = self._clock()
+        if self._last_log is None:
+            self._last_log = now
+        elif now - self._last_log >= LOG_INTERVAL:
+            self._last_log = now
+            self.log_summary()
+
+    def log_summary(self):
+        _LOG.info('Task window: %d in flight (smallest %d, largest %d; limits %d-%d)',
+                  self.size, self.smallest, self.largest, self.min_size, self.cap)
+
+    def __repr__(self):
+        return 'AdaptiveWindow(size={}, min_size={}, max_size={})'.format(self.size, self.min_size, self.max_size)
+
+
+def parse_memory_size(size: str) -> int:
+    """
+    Parse a Redis-style memory size into bytes.
+
+    >>> parse_memory_size('4096mb')
+    4294967296
+    >>> parse_memory_size('1gb')
+    1073741824
+    >>> parse_memory_size('100')
+    100
+    """
+    units = {'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+    size = size.strip().lower()
+    for suffix, multiplier in units.items():
+        if size.endswith(suffix):
+            return int(size[:-len(suffix)]) * multiplier
+    return int(size)
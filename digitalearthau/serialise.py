@@ -10,34 +10,142 @@ Normal classes are an option too, but they'd need their own serialization code r
 """
 import enum
 import json
+import os
 import pathlib
+import time
 import uuid
 
 import datetime
 import dateutil.parser
 import yaml
-from typing import Dict
+from typing import Dict, Tuple
 
 from digitalearthau import paths
 from digitalearthau.events import Status
 
 
+class Durability(enum.Enum):
+    """How far written lines are pushed towards the disk each time a JsonLinesWriter flushes"""
+    # Left in the file object's own buffer
+    NONE = 0
+    # Flushed to the operating system
+    FLUSH = 1
+    # Synced to disk
+    FSYNC = 2
+
+
 class JsonLinesWriter:
     """
     Stream events (or any Namedtuple) to a file in JSON-Lines format.
+
+    By default each item is flushed as it's written. To buffer instead, give a `buffer_size` (in
+    bytes) and/or a `flush_interval` (in seconds): lines are then written out when either is
+    exceeded, when `flush()` is called, and on exit. `durability` sets how far each flush goes.
+
+    Fields named in `cached_fields` are serialised once for each distinct value, and reused,
+    which helps when every item repeats the same large sub-object (such as an event's job
+    parameters). The values must not be modified after they're first written. The output is
+    identical either way.
     """
 
-    def __init__(self, file_obj) -> None:
+    # Most distinct values of cached fields to remember
+    _CACHE_SIZE = 128
+
+    def __init__(self,
+                 file_obj,
+                 durability: Durability = Durability.FLUSH,
+                 buffer_size: int = 0,
+                 flush_interval: float = None,
+                 cached_fields=(),
+                 clock=time.monotonic) -> None:
         self._file_obj = file_obj
+        self._durability = durability
+        self._buffer_size = buffer_size
+        self._flush_interval = flush_interval
+        self._cached_fields = frozenset(cached_fields)
+        self._clock = clock
+
+        self._buffer = []
+        self._buffered_bytes = 0
+        self._last_flush = clock()
+        # Serialised values of cached fields, with the value itself (so that an id() key can't be reused)
+        self._cache = {}  # type: Dict[object, Tuple[object, str]]
+
+    @property
+    def is_buffered(self):
+        return bool(self._buffer_size or self._flush_interval)
 
     def __enter__(self):
         return self
 
     def write_item(self, item):
-        self._file_obj.write(to_lenient_json(type_to_dict(item), compact=True) + '\n')
+        line = self._to_json(item) + '\n'
+        if not self.is_buffered:
+            self._file_obj.write(line)
+            self._sync()
+            return
+
+        self._buffer.append(line)
+        self._buffered_bytes += len(line)
+        if self._buffer_size and self._buffered_bytes >= self._buffer_size:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush if the flush interval has passed (call periodically when items may arrive slowly)"""
+        if self._flush_interval is not None and self._clock() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._file_obj.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered_bytes = 0
+        self._sync()
+        self._last_flush = self._clock()
+
+    def _sync(self):
+        if self._durability is Durability.NONE:
+            return
         self._file_obj.flush()
+        if self._durability is Durability.FSYNC:
+            os.fsync(self._file_obj.fileno())
+
+    def _to_json(self, item) -> str:
+        fields = getattr(item, '_fields', None)
+        if not self._cached_fields or fields is None:
+            return to_lenient_json(type_to_dict(item), compact=True)
+
+        # Assemble the object ourselves, in the same form as json.dumps(sort_keys=True) would.
+        members = []
+        for name, value in sorted(zip(fields, item), key=lambda field: field[0]):
+            if name in self._cached_fields:
+                value_json = self._cached_json(value)
+            else:
+                value_json = to_lenient_json(type_to_dict(value), compact=True)
+            members.append(to_lenient_json(name) + ':' + value_json)
+        return '{' + ', '.join(members) + '}'
+
+    def _cached_json(self, value) -> str:
+        try:
+            hash(value)
+        except TypeError:
+            # Unhashable (eg. contains a dict): cached by identity instead.
+            key = ('id', id(value))
+        else:
+            # By repr rather than equality, as equal values can serialise differently (eg. 1 and 1.0)
+            key = ('repr', repr(value))
+
+        cached = self._cache.get(key)
+        if cached is None:
+            if len(self._cache) >= self._CACHE_SIZE:
+                self._cache.clear()
+            cached = self._cache[key] = (value, to_lenient_json(type_to_dict(value), compact=True))
+        return cached[1]
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.flush()
         self._file_obj.close()
 
 
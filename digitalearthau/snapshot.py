@@ -0,0 +1,371 @@
+"""
+Snapshots of the datasets on disk for a set of glob patterns (typically a collection).
+
+A snapshot records the mtime of every directory it visited, and the matching entries within it.
+Refreshing a snapshot only re-lists directories whose mtime has changed since the previous one,
+so a crawl of a mostly-static archive becomes mostly stat() calls instead of full listings.
+Directories modified shortly before the previous snapshot are always re-listed, as mtimes may be
+too coarse (eg. one second on Lustre) to show a change made in the same second as the listing.
+
+Directory mtimes only change when entries are added, removed or renamed directly within them, so
+every known directory is still stat'ed -- except for dataset package folders (those holding a fixed
+metadata file name, such as `LS*/ga-metadata.yaml`), which are written elsewhere and renamed into place
+whole. They're only re-read when their parent folder changes. Dataset files within unchanged directories
+aren't stat'ed again either. Use `deep=True` to stat both, so that modified datasets are found too.
+"""
+import fnmatch
+import glob
+import gzip
+import json
+import os
+import re
+import stat
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern, Sequence, Tuple
+
+import structlog
+from boltons import fileutils
+
+from digitalearthau.collections import Collection
+
+_LOG = structlog.get_logger()
+
+_SNAPSHOT_SUFFIX = '.json.gz'
+_SNAPSHOT_ID_FORMAT = '%Y%m%dT%H%M%S'
+_CREATED_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+# A directory modified this close to (or after) the previous snapshot may have changed again within
+# the same mtime, on filesystems with coarse timestamps, so its previous listing isn't trusted.
+_LISTING_SETTLE_SECS = 2
+
+
+class DatasetEntry(NamedTuple):
+    path: str
+    size: int
+    mtime: float
+
+
+class DirectoryState(NamedTuple):
+    # st_mtime_ns of the directory when it was listed
+    mtime_ns: int
+    # Names within the directory that match the pattern segment below it.
+    names: Tuple[str, ...]
+
+
+class SnapshotDiff(NamedTuple):
+    added: List[DatasetEntry]
+    removed: List[DatasetEntry]
+    modified: List[DatasetEntry]
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+
+class Snapshot(NamedTuple):
+    created: datetime
+    # Directory states for each pattern
+    directories: Dict[str, Dict[str, DirectoryState]]
+    datasets: Dict[str, DatasetEntry]
+
+    @property
+    def id(self) -> str:
+        return self.created.strftime(_SNAPSHOT_ID_FORMAT)
+
+    @property
+    def patterns(self) -> List[str]:
+        return list(self.directories.keys())
+
+    def paths(self) -> Iterable[Path]:
+        for path in sorted(self.datasets):
+            yield Path(path)
+
+    def uris(self) -> Iterable[str]:
+        for path in self.paths():
+            yield path.as_uri()
+
+    def diff(self, older: 'Snapshot') -> SnapshotDiff:
+        """
+        The dataset changes between an older snapshot and this one.
+
+        >>> a = DatasetEntry('/tmp/a', 1, 1.0)
+        >>> b = DatasetEntry('/tmp/b', 1, 1.0)
+        >>> b2 = DatasetEntry('/tmp/b', 2, 2.0)
+        >>> c = DatasetEntry('/tmp/c', 1, 1.0)
+        >>> old = Snapshot(datetime(2018, 1, 1), {}, {'/tmp/a': a, '/tmp/b': b})
+        >>> new = Snapshot(datetime(2018, 1, 2), {}, {'/tmp/b': b2, '/tmp/c': c})
+        >>> d = new.diff(old)
+        >>> [e.path for e in d.added], [e.path for e in d.removed], [e.path for e in d.modified]
+        (['/tmp/c'], ['/tmp/a'], ['/tmp/b'])
+        >>> bool(new.diff(new))
+        False
+        """
+        return SnapshotDiff(
+            added=[e for p, e in sorted(self.datasets.items()) if p not in older.datasets],
+            removed=[e for p, e in sorted(older.datasets.items()) if p not in self.datasets],
+            modified=[
+                e for p, e in sorted(self.datasets.items())
+                if p in older.datasets and older.datasets[p] != e
+            ],
+        )
+
+    def to_doc(self) -> dict:
+        return {
+            'created': self.created.strftime(_CREATED_FORMAT),
+            'directories': {
+                pattern: {path: [d.mtime_ns, list(d.names)] for path, d in dirs.items()}
+                for pattern, dirs in self.directories.items()
+            },
+            'datasets': [[e.path, e.size, e.mtime] for e in self.datasets.values()],
+        }
+
+    @classmethod
+    def from_doc(cls, doc: dict) -> 'Snapshot':
+        return cls(
+            created=datetime.strptime(doc['created'], _CREATED_FORMAT),
+            directories={
+                pattern: {path: DirectoryState(mtime_ns, tuple(names)) for path, (mtime_ns, names) in dirs.items()}
+                for pattern, dirs in doc['directories'].items()
+            },
+            datasets={path: DatasetEntry(path, size, mtime) for path, size, mtime in doc['datasets']},
+        )
+
+
+def _compile_segment(segment: str) -> Optional[Pattern]:
+    """A regex for a wildcard pattern segment, or None if the segment is a literal name"""
+    if not glob.has_magic(segment):
+        return None
+    return re.compile(fnmatch.translate(segment))
+
+
+def _split_pattern(pattern: str) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Split a glob pattern into its literal leading directory, and the remaining segments.
+
+    >>> _split_pattern('/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/LS*/ga-metadata.yaml')
+    ('/g/data/v10/reprocess/ls8/level1', ('[0-9][0-9][0-9][0-9]', 'LS*', 'ga-metadata.yaml'))
+    >>> _split_pattern('/g/data/fk4/datacube/some-file.nc')
+    ('/g/data/fk4/datacube', ('some-file.nc',))
+    """
+    parts = Path(pattern).parts
+    literal_count = 0
+    # Always leave at least the final segment, so that we have something to list.
+    while literal_count < len(parts) - 1 and not glob.has_magic(parts[literal_count]):
+        literal_count += 1
+    return os.path.join(*parts[:literal_count]), tuple(parts[literal_count:])
+
+
+class _Crawler:
+    """Crawl a single pattern, reusing the state of a previous snapshot where directories haven't changed"""
+
+    def __init__(self,
+                 segments: Sequence[str],
+                 previous_directories: Dict[str, DirectoryState],
+                 previous_datasets: Dict[str, DatasetEntry],
+                 deep: bool,
+                 previous_created: Optional[datetime] = None) -> None:
+        self.segments = tuple(segments)
+        self.regexes = [_compile_segment(s) for s in segments]
+        self.previous_directories = previous_directories
+        self.previous_datasets = previous_datasets
+        self.deep = deep
+        # Directory listings can only be trusted if the directory was modified before this (in epoch ns)
+        self.settled_before_ns = None  # type: Optional[int]
+        if previous_created is not None:
+            settled_before = previous_created.replace(tzinfo=timezone.utc).timestamp() - _LISTING_SETTLE_SECS
+            self.settled_before_ns = int(settled_before * 1e9)
+
+        self.directories = {}  # type: Dict[str, DirectoryState]
+        self.datasets = {}  # type: Dict[str, DatasetEntry]
+        self.listed_count = 0
+        self.stat_count = 0
+
+    def crawl(self, path: str, depth: int = 0):
+        self.stat_count += 1
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        if not stat.S_ISDIR(st.st_mode):
+            return
+
+        previous = self.previous_directories.get(path)
+        unchanged = previous is not None and previous.mtime_ns == st.st_mtime_ns and self._is_settled(st)
+        if unchanged:
+            names = previous.names
+        else:
+            names = self._list_matching(path, depth)
+        self.directories[path] = DirectoryState(st.st_mtime_ns, names)
+
+        is_leaf = depth == len(self.segments) - 1
+        trust_children = unchanged and not self.deep and self._is_package_level(depth + 1)
+        for name in names:
+            child = os.path.join(path, name)
+            if is_leaf:
+                if unchanged and not self.deep and child in self.previous_datasets:
+                    self.datasets[child] = self.previous_datasets[child]
+                else:
+                    self._add_dataset(child)
+            elif trust_children and child in self.previous_directories:
+                self._reuse(child, depth + 1)
+            else:
+                self.crawl(child, depth + 1)
+
+    def _is_settled(self, st: os.stat_result) -> bool:
+        """Was the directory last modified long enough before the previous snapshot to trust its listing?"""
+        return self.settled_before_ns is not None and st.st_mtime_ns < self.settled_before_ns
+
+    def _is_package_level(self, depth: int) -> bool:
+        """Are directories at this depth dataset packages? (folders containing a fixed metadata file name)"""
+        return depth == len(self.segments) - 1 and self.regexes[-1] is None
+
+    def _reuse(self, path: str, depth: int):
+        """Copy a directory's subtree from the previous snapshot, without touching the filesystem"""
+        state = self.previous_directories[path]
+        self.directories[path] = state
+
+        is_leaf = depth == len(self.segments) - 1
+        for name in state.names:
+            child = os.path.join(path, name)
+            if is_leaf:
+                if child in self.previous_datasets:
+                    self.datasets[child] = self.previous_datasets[child]
+            elif child in self.previous_directories:
+                self._reuse(child, depth + 1)
+
+    def _list_matching(self, path: str, depth: int) -> Tuple[str, ...]:
+        segment, regex = self.segments[depth], self.regexes[depth]
+
+        # A literal name doesn't need a listing.
+        if regex is None:
+            self.stat_count += 1
+            return (segment,) if os.path.lexists(os.path.join(path, segment)) else ()
+
+        self.listed_count += 1
+        # As with glob, hidden files are only matched when the pattern asks for them explicitly.
+        include_hidden = segment.startswith('.')
+        with os.scandir(path) as entries:
+            return tuple(sorted(
+                entry.name for entry in entries
+                if (include_hidden or not entry.name.startswith('.')) and regex.match(entry.name)
+            ))
+
+    def _add_dataset(self, path: str):
+        self.stat_count += 1
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return
+        self.datasets[path] = DatasetEntry(path, st.st_size, st.st_mtime)
+
+
+def take_snapshot(patterns: Iterable[str],
+                  previous: Optional[Snapshot] = None,
+                  deep: bool = False,
+                  log=_LOG) -> Snapshot:
+    """
+    Take a snapshot of all files matching the given glob patterns.
+
+    If a previous snapshot is given, only directories that have changed since then will be re-listed.
+    """
+    created = datetime.utcnow()
+    directories = {}  # type: Dict[str, Dict[str, DirectoryState]]
+    datasets = {}  # type: Dict[str, DatasetEntry]
+
+    for pattern in patterns:
+        root, segments = _split_pattern(str(pattern))
+        crawler = _Crawler(
+            segments,
+            previous_directories=previous.directories.get(pattern, {}) if previous else {},
+            previous_datasets=previous.datasets if previous else {},
+            deep=deep,
+            previous_created=previous.created if previous else None,
+        )
+        crawler.crawl(root)
+        log.debug(
+            "snapshot.pattern.done",
+            pattern=pattern,
+            dataset_count=len(crawler.datasets),
+            directory_count=len(crawler.directories),
+            listed_count=crawler.listed_count,
+            stat_count=crawler.stat_count,
+        )
+        directories[pattern] = crawler.directories
+        datasets.update(crawler.datasets)
+
+    return Snapshot(created, directories, datasets)
+
+
+class SnapshotStore:
+    """
+    A folder of snapshots, one file per snapshot, named by creation time.
+    """
+
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def snapshot_ids(self) -> List[str]:
+        """All stored snapshot ids, oldest first"""
+        if not self.directory.exists():
+            return []
+        return sorted(
+            p.name[:-len(_SNAPSHOT_SUFFIX)] for p in self.directory.iterdir()
+            if p.name.endswith(_SNAPSHOT_SUFFIX)
+        )
+
+    def _path(self, snapshot_id: str) -> Path:
+        return self.directory.joinpath(snapshot_id + _SNAPSHOT_SUFFIX)
+
+    def load(self, snapshot_id: str) -> Snapshot:
+        path = self._path(snapshot_id)
+        if not path.exists():
+            raise ValueError("No snapshot {!r} in {}".format(snapshot_id, self.directory))
+        with gzip.open(str(path), 'rt') as f:
+            return Snapshot.from_doc(json.load(f))
+
+    def latest(self) -> Optional[Snapshot]:
+        ids = self.snapshot_ids()
+        return self.load(ids[-1]) if ids else None
+
+    def save(self, snapshot: Snapshot, keep: int = None) -> str:
+        """
+        Save a snapshot, optionally removing old snapshots so that only `keep` remain.
+        """
+        fileutils.mkdir_p(str(self.directory))
+        with fileutils.atomic_save(str(self._path(snapshot.id))) as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+                gz.write(json.dumps(snapshot.to_doc()).encode('utf-8'))
+
+        if keep is not None:
+            for old_id in self.snapshot_ids()[:-keep]:
+                self._path(old_id).unlink()
+        return snapshot.id
+
+    def refresh(self, patterns: Iterable[str], deep=False, keep: int = None, log=_LOG) -> Snapshot:
+        """
+        Take a new snapshot (based on the latest stored one) and store it.
+        """
+        snapshot = take_snapshot(patterns, previous=self.latest(), deep=deep, log=log)
+        self.save(snapshot, keep=keep)
+        log.info("snapshot.saved", snapshot_id=snapshot.id, dataset_count=len(snapshot.datasets))
+        return snapshot
+
+    def current_listing(self, patterns: Iterable[str], deep=False, log=_LOG) -> Iterable[Path]:
+        """
+        All current dataset paths on disk for the patterns.
+        """
+        return self.refresh(patterns, deep=deep, log=log).paths()
+
+    def diff_since(self, snapshot_id: str, patterns: Iterable[str], deep=False, log=_LOG) -> SnapshotDiff:
+        """
+        Changes on disk since the given snapshot was taken.
+        """
+        older = self.load(snapshot_id)
+        return self.refresh(patterns, deep=deep, log=log).diff(older)
+
+
+def collection_store(collection: Collection, cache_path: Path) -> SnapshotStore:
+    """
+    The snapshot store of a collection, within the given cache directory.
+    """
+    return SnapshotStore(cache_path.joinpath(collection.name, 'snapshots'))
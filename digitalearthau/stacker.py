@@ -25,6 +25,7 @@ As such, it is a three step process, with the second two happening automatically
  out across a large PBS job.
 """
 import logging
+import sys
 from datetime import datetime
 from functools import partial
 from math import ceil
@@ -39,9 +40,11 @@ from datacube.api.query import Query
 from datacube.index import Index
 from datacube.ui import click as ui
 from datacube.ui import task_app
+from datacube.utils import mk_part_uri
 from datacube_apps.stacker import stacker
 from digitalearthau import __version__
-from digitalearthau import paths, serialise
+from digitalearthau import paths, serialise, taskfile
+from digitalearthau.index import BatchedIndexWriter
 # pylint: disable=invalid-name
 from digitalearthau.qsub import with_qsub_runner, TaskRunner
 from digitalearthau.runners.model import TaskDescription
@@ -50,6 +53,9 @@ from digitalearthau.runners.util import init_task_app, submit_subjob
 _LOG = logging.getLogger(__file__)
 APP_NAME = 'dea-stacker'
 
+# How long "run --follow" waits for more tasks to be written before giving up, in seconds.
+DEFAULT_FOLLOW_TIMEOUT = 3600.0
+
 
 @click.group(help='DEA Stacker\n\n' + __doc__)
 @click.version_option(version=__version__)
@@ -131,10 +137,10 @@ def generate(index: Index,
              no_qsub: bool):
     config, task_desc = _make_config_and_description(index, Path(task_desc_file))
 
-    num_tasks_saved = task_app.save_tasks(
+    num_tasks_saved = taskfile.write_tasks(
+        task_desc.runtime_state.task_serialisation_path,
         config,
         stacker.make_stacker_tasks(index, config, **task_desc.parameters.query),
-        task_desc.runtime_state.task_serialisation_path
     )
     _LOG.info('Found and saved %d tasks', num_tasks_saved)
 
@@ -203,6 +209,29 @@ def estimate_job_size(num_tasks):
     return nodes, wall_time_mins
 
 
+def process_results(index: Index, results):
+    """
+    Record the new locations of stacked datasets: the equivalent of `stacker.process_result`, but
+    with one index transaction for a whole batch of results.
+    """
+    with BatchedIndexWriter(index, batch_size=sys.maxsize) as index_writer:
+        for datasets, new_common_uri in results:
+            for idx, dataset in enumerate(datasets.values):
+                new_uri = mk_part_uri(new_common_uri, idx)
+                _LOG.info('Updating dataset location: %s', dataset.local_path)
+                index_writer.add_location(dataset.id, new_uri)
+                index_writer.archive_location(dataset.id, dataset.local_uri)
+
+
+def _parse_shard(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return taskfile.Shard.parse(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @cli.command(help='Process all tasks in a task file')
 @click.option('--dry-run', is_flag=True, default=False, help='Check if output files already exist')
 @click.option(
@@ -210,6 +239,13 @@ def estimate_job_size(num_tasks):
     required=True,
     type=click.Path(exists=True, readable=True, writable=False, dir_okay=False)
 )
+@click.option('--shard', callback=_parse_shard,
+              help="Only run one portion of the tasks, given as 'index/count' (eg. '0/4')")
+@click.option('--follow', is_flag=True, default=False,
+              help='Keep waiting for more tasks until the task file has been fully generated')
+@click.option('--follow-timeout', type=float, default=DEFAULT_FOLLOW_TIMEOUT, show_default=True,
+              help='When following, give up if nothing more has been written to the task file '
+                   'for this many seconds (eg. the generating job died)')
 @with_qsub_runner()
 @ui.config_option
 @ui.verbose_option
@@ -217,22 +253,26 @@ def estimate_job_size(num_tasks):
 def run(index,
         dry_run: bool,
         task_desc_file: str,
+        shard: taskfile.Shard,
+        follow: bool,
+        follow_timeout: float,
         runner: TaskRunner,
         qsub):
     _LOG.info('Starting DEA Stacker processing...')
 
     task_desc = serialise.load_structure(Path(task_desc_file), TaskDescription)
-    config, tasks = task_app.load_tasks(task_desc.runtime_state.task_serialisation_path)
+    config, tasks = taskfile.load_tasks(task_desc.runtime_state.task_serialisation_path,
+                                        shard=shard, follow=follow, idle_timeout=follow_timeout)
 
     if dry_run:
         task_app.check_existing_files((task['filename'] for task in tasks))
         return
 
     task_func = partial(stacker.do_stack_task, config)
-    process_func = partial(stacker.process_result, index)
+    process_func = partial(process_results, index)
 
     try:
-        runner(task_desc, tasks, task_func, process_func)
+        runner(task_desc, tasks, task_func, on_task_batch_complete=process_func)
         _LOG.info("Runner finished normally, triggering shutdown.")
     finally:
         runner.stop()
@@ -15,7 +15,7 @@ from datacube.index.index import Index  # DEA index
 from datacube.drivers.postgres import PostgresDb
 
 from datacube.utils import uri_to_local_path, InvalidDocException
-from digitalearthau import paths
+from digitalearthau import paths, snapshot
 from digitalearthau.collections import Collection
 from digitalearthau.index import DatasetLite, get_datasets_for_uri
 from digitalearthau.sync import validate
@@ -28,6 +28,9 @@ _LOG = structlog.get_logger()
 # 23 hours (roughly the same day)
 CACHE_TIMEOUT_SECS = 60 * 60 * 23
 
+# How many filesystem snapshots to keep for each collection (for diffing against)
+SNAPSHOT_KEEP_COUNT = 14
+
 
 def cache_is_too_old(path):
     if not path.exists():
@@ -57,10 +60,21 @@ def build_pathset(
         path_set.load(str(locations_cache))
     else:
         log.info("paths.trie.build")
+        if cache_path:
+            # Only re-list the folders that have changed since our last build.
+            # (A deep refresh: sync needs to notice every change, so all known folders are stat'ed)
+            fs_uris = snapshot.collection_store(collection, cache_path).refresh(
+                collection.file_patterns,
+                deep=True,
+                keep=SNAPSHOT_KEEP_COUNT,
+                log=log,
+            ).uris()
+        else:
+            fs_uris = collection.iter_fs_uris()
         path_set = dawg.CompletionDAWG(
             chain(
                 collection.iter_index_uris(),
-                collection.iter_fs_uris()
+                fs_uris
             )
         )
         log.info("paths.trie.done")
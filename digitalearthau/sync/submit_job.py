@@ -1,14 +1,16 @@
 #!/usr/bin/env python
 
 import datetime
+import glob
 import logging
 import os
 import shlex
 import time
-from collections import defaultdict
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from subprocess import check_output
-from typing import List, Optional, Tuple, Iterable, Dict, Set
+from typing import List, Optional, Tuple, Iterable, Dict
 
 import click
 import typing
@@ -20,13 +22,19 @@ from click import style
 from datacube.index import index_connect
 from digitalearthau import collections
 from digitalearthau.collections import Trust
-from digitalearthau.paths import get_dataset_paths
+from digitalearthau.paths import get_dataset_base_path
 from digitalearthau.sync import scan
 
 SUBMIT_THROTTLE_SECS = 1
 
 FILES_PER_JOB_CUTOFF = 15000
 
+# Number of threads used to search for (and count) datasets when planning tasks.
+DEFAULT_DISCOVERY_WORKERS = 8
+
+# Number of collection path lists to build concurrently before submission.
+DEFAULT_CACHE_WORKERS = 4
+
 _LOG = logging.getLogger(__name__)
 
 
@@ -79,27 +87,54 @@ class SyncSubmission(object):
                  queue='normal',
                  dry_run=False,
                  verbose=True,
-                 workers=4) -> None:
+                 workers=4,
+                 cache_workers=DEFAULT_CACHE_WORKERS) -> None:
         self.project = project
         self.queue = queue
         self.dry_run = dry_run
         self.verbose = verbose
         self.workers = workers
+        self.cache_workers = cache_workers
         self.cache_folder = cache_folder
 
-    def warm_cache(self, tasks: Iterable[Task]):
-        # Update the cached path list ahead of time, so PBS jobs don't waste time doing it themselves.
-        click.echo("Checking path list, this may take a few minutes...")
-
-        done_collections = set()  # type: Set[collections.Collection]
+    def warm_cache(self, tasks: Iterable[Task]) -> Iterable[collections.Collection]:
+        """
+        Update the cached path lists ahead of time, so PBS jobs don't waste time doing it themselves.
 
+        The path lists of distinct collections are built concurrently, and each collection is
+        returned as soon as its own cache is ready.
+        """
+        cache_paths = {}  # type: Dict[collections.Collection, Path]
         for task in tasks:
-            if task.collection in done_collections:
-                continue
-            cache_path = Path(task.resolve_path(self.cache_folder))
-            scan.build_pathset(task.collection, cache_path=cache_path)
+            if task.collection not in cache_paths:
+                cache_paths[task.collection] = Path(task.resolve_path(self.cache_folder))
+
+        click.echo("Checking path list of {} collection(s), this may take a few minutes...".format(len(cache_paths)))
+
+        with ThreadPoolExecutor(max_workers=self.cache_workers) as pool:
+            futures = {
+                pool.submit(self._build_cache, collection, cache_path): collection
+                for collection, cache_path in cache_paths.items()
+            }
+            for done_count, future in enumerate(as_completed(futures), start=1):
+                collection = futures[future]
+                build_secs = future.result()
+                click.echo(
+                    "Path list ready for {} ({}/{}) in {:.0f}s".format(
+                        style(collection.name, bold=True),
+                        done_count,
+                        len(futures),
+                        build_secs
+                    )
+                )
+                yield collection
 
-            done_collections.add(task.collection)
+    @staticmethod
+    def _build_cache(collection: collections.Collection, cache_path: Path) -> float:
+        start_time = time.time()
+        click.echo("Building path list for {}".format(collection.name))
+        scan.build_pathset(collection, cache_path=cache_path)
+        return time.time() - start_time
 
     def submit(self,
                task: Task,
@@ -206,6 +241,14 @@ class SyncSubmission(object):
               type=int,
               default=None,
               help="Stop submitting after this many jobs. Useful for testing.")
+@click.option('--cache-workers',
+              type=int,
+              default=DEFAULT_CACHE_WORKERS,
+              help="Number of collection path lists to build concurrently before submitting")
+@click.option('--discovery-workers',
+              type=int,
+              default=DEFAULT_DISCOVERY_WORKERS,
+              help="Number of threads used to search for datasets when planning jobs")
 def main(folders: Iterable[str],
          dry_run: bool,
          queue: str,
@@ -214,7 +257,9 @@ def main(folders: Iterable[str],
          cache_folder: str,
          max_jobs: int,
          concurrent_jobs: int,
-         submit_limit: int):
+         submit_limit: int,
+         cache_workers: int,
+         discovery_workers: int):
     """
     Submit PBS jobs to run dea-sync
 
@@ -232,11 +277,12 @@ def main(folders: Iterable[str],
 
     with index_connect(application_name='sync-submit') as index:
         collections.init_nci_collections(index)
-        submitter = SyncSubmission(cache_folder, project, queue, dry_run, verbose=True, workers=4)
+        submitter = SyncSubmission(cache_folder, project, queue, dry_run, verbose=True, workers=4,
+                                   cache_workers=cache_workers)
         click.echo(
             "{} input path(s)".format(len(input_paths))
         )
-        tasks = _paths_to_tasks(input_paths)
+        tasks = _paths_to_tasks(input_paths, workers=discovery_workers)
         click.echo(
             "Found {} tasks across collection(s): {}".format(
                 len(tasks),
@@ -263,24 +309,25 @@ def main(folders: Iterable[str],
         _find_and_submit(tasks, work_folder, concurrent_jobs, submit_limit, submitter)
 
 
-def _paths_to_tasks(input_paths: List[Path]) -> List[Task]:
+def _paths_to_tasks(input_paths: List[Path], workers: int = DEFAULT_DISCOVERY_WORKERS) -> List[Task]:
     # Remove duplicates
     normalised_input_paths = set(p.absolute() for p in input_paths)
 
-    def dataset_folder_path(dataset_path):
-        # Get their dataset's parent folders: (typically the "x_y" for tiles, the month for scenes)
-
-        # Get the base path for the dataset.
-        # eg. "LS8_SOME_SCENE_1/ga-metadata.yaml" to "LS8_SOME_SCENE_1"
-        #  or "LS7_SOME_TILE.nc" to itself
-        base_path, _ = get_dataset_paths(dataset_path)
+    # Split the search into one glob per folder, so that they can be counted in parallel.
+    search_patterns = [
+        split_pattern
+        for input_path in normalised_input_paths
+        for collection in collections.get_collections_in_path(input_path)
+        for file_pattern in collection.constrained_file_patterns(input_path)
+        for split_pattern in _split_file_pattern(file_pattern)
+    ]
 
-        return base_path.parent
+    folder_counts = Counter()  # type: typing.Counter[Path]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for counts in pool.map(_count_dataset_folders, search_patterns):
+            folder_counts.update(counts)
 
-    parent_folder_counts = uniq_counts(dataset_folder_path(dataset_path)
-                                       for input_path in normalised_input_paths
-                                       for collection in collections.get_collections_in_path(input_path)
-                                       for dataset_path in collection.iter_fs_paths_within(input_path))
+    parent_folder_counts = sorted(folder_counts.items(), key=lambda t: t[1])
 
     # Sanity check: Each of these parent folders should still be within an input path
     for path, count in parent_folder_counts:
@@ -291,6 +338,40 @@ def _paths_to_tasks(input_paths: List[Path]) -> List[Task]:
     return [Task([p], c) for p, c in parent_folder_counts]
 
 
+def _split_file_pattern(file_pattern: str) -> List[str]:
+    """
+    Split a file glob into narrower globs: one for each directory matching its first wildcard folder.
+
+    Together they match the same files as the original.
+
+    >>> _split_file_pattern('/tmp/no-wildcard-folders/*.nc')
+    ['/tmp/no-wildcard-folders/*.nc']
+    >>> _split_file_pattern('/non-existent-dir/*_*/*.nc')
+    []
+    """
+    parts = Path(file_pattern).parts
+    for i, part in enumerate(parts[:-1]):
+        if glob.has_magic(part):
+            folder_pattern = os.path.join(*parts[:i + 1])
+            return [os.path.join(folder, *parts[i + 1:]) for folder in glob.iglob(folder_pattern)]
+    return [file_pattern]
+
+
+def _count_dataset_folders(file_pattern: str) -> typing.Counter[Path]:
+    """
+    Count the datasets matching a glob by their parent folder:
+    typically the "x_y" for tiles, the month for scenes.
+
+    Only the metadata paths are used: the dataset contents are never listed.
+    """
+    # eg. "LS8_SOME_SCENE_1/ga-metadata.yaml" to "LS8_SOME_SCENE_1"
+    #  or "LS7_SOME_TILE.nc" to itself
+    return Counter(
+        get_dataset_base_path(Path(path).absolute()).parent
+        for path in glob.iglob(file_pattern)
+    )
+
+
 def group_tasks(tasks: List[Task], maximum) -> List[Task]:
     """
     >>> collections._add(collections.Collection('test', {}, ['/test/*'], ()))
@@ -319,39 +400,17 @@ def group_tasks(tasks: List[Task], maximum) -> List[Task]:
     return tasks
 
 
-T = typing.TypeVar('T')
-
-
-def uniq_counts(paths: Iterable[T]) -> List[Tuple[T, int]]:
-    """
-    Group unique items, retuning them with a count of instances.
-
-    >>> uniq_counts([])
-    []
-    >>> uniq_counts(['a'])
-    [('a', 1)]
-    >>> uniq_counts(['a', 'b', 'b'])
-    [('a', 1), ('b', 2)]
-    """
-    s = defaultdict(int)  # type: Dict[T, int]
-    for p in paths:
-        s[p] += 1
-    return list(sorted(s.items(), key=lambda t: t[1]))
-
-
 def _find_and_submit(tasks: List[Task],
                      work_folder: str,
                      concurrent_jobs: int,
                      submit_limit: int,
                      submitter: SyncSubmission):
-    submitter.warm_cache(tasks)
-
     submitted = 0
     # To maintain concurrent_jobs limit, we set a pbs dependency on previous jobs.
     # mapping of concurrent slot number to the last job id to be submitted in it.
     last_job_slots = {}  # type: Dict[int, str]
 
-    for task in tasks:
+    for task in _iter_cache_ready_tasks(tasks, submitter):
         if submitted == submit_limit:
             click.echo("Submit limit ({}) reached, done.".format(submit_limit))
             break
@@ -406,6 +465,18 @@ def _find_and_submit(tasks: List[Task],
         time.sleep(SUBMIT_THROTTLE_SECS)
 
 
+def _iter_cache_ready_tasks(tasks: List[Task], submitter: SyncSubmission) -> Iterable[Task]:
+    """
+    Iterate over the tasks, grouped by collection, as soon as each collection's path cache is ready.
+    """
+    collection_tasks = defaultdict(list)  # type: Dict[collections.Collection, List[Task]]
+    for task in tasks:
+        collection_tasks[task.collection].append(task)
+
+    for collection in submitter.warm_cache(tasks):
+        yield from collection_tasks[collection]
+
+
 def get_collection(tile_path: Path) -> collections.Collection:
     """
     Get the collection that covers the given path
@@ -0,0 +1,330 @@
+"""
+Task files: a config record followed by a stream of task records.
+
+This replaces the plain pickle stream of `task_app.save_tasks()`. Each record is length-prefixed,
+and the offset of each task is also written to an index file alongside, so that readers can:
+
+- skip records without unpickling them (to read only one shard of the tasks),
+- count tasks, or read a single task, without reading the whole file, and
+- follow a file that's still being written, waiting for each record to be complete.
+
+Files written by `task_app.save_tasks()` can still be read by `load_tasks()`.
+"""
+import logging
+import os
+import pickle
+import struct
+import time
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+from datacube.ui import task_app
+
+_LOG = logging.getLogger(__name__)
+
+MAGIC = b'DEATASK\x01'
+
+# Each record is its length followed by its pickled bytes. A zero length marks the end of the file.
+_LENGTH = struct.Struct('>Q')
+
+# The index is the offset of each task record, in the same format.
+_OFFSET = _LENGTH
+
+DEFAULT_POLL_INTERVAL = 5.0
+
+
+class Shard(NamedTuple):
+    """One of `count` interleaved portions of the tasks"""
+    index: int
+    count: int
+
+    def includes(self, task_number: int) -> bool:
+        return task_number % self.count == self.index
+
+    @classmethod
+    def parse(cls, s: str) -> 'Shard':
+        """
+        >>> Shard.parse('2/8')
+        Shard(index=2, count=8)
+        >>> Shard.parse('8/8')
+        Traceback (most recent call last):
+        ...
+        ValueError: Invalid shard '8/8': expected 'index/count', with 0 <= index < count
+        """
+        try:
+            index, count = (int(part) for part in s.split('/'))
+        except ValueError:
+            index, count = -1, 0
+        if not 0 <= index < count:
+            raise ValueError("Invalid shard {!r}: expected 'index/count', with 0 <= index < count".format(s))
+        return cls(index, count)
+
+
+def index_path(path: Path) -> Path:
+    return path.with_name(path.name + '.index')
+
+
+def is_task_file(path: Path) -> bool:
+    """Is this file in our format? (rather than the older task_app format)"""
+    with path.open('rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class TaskFileWriter:
+    """
+    Write a task file, one task at a time.
+
+    Each task is flushed as it's written, so that a reader following the file sees it
+    immediately. If the file already exists the tasks are appended to it (and the config
+    is not needed).
+
+    Use as a context manager, or call `close()`, to mark the file as complete.
+    """
+
+    def __init__(self, path: Path, config: dict = None) -> None:
+        self.path = path
+
+        if path.exists():
+            self._file = path.open('r+b')
+            if self._file.read(len(MAGIC)) != MAGIC:
+                self._file.close()
+                raise ValueError("Can't append to {}: not a task file".format(path))
+            offsets = _scan(self._file)
+            # Drop any end marker or partially-written record, and resume from the last complete task.
+            self._file.truncate()
+            self._index = index_path(path).open('wb')
+            for offset in offsets:
+                self._index.write(_OFFSET.pack(offset))
+            self.count = len(offsets)
+            _LOG.info('Appending to %s, which has %d tasks', path, self.count)
+        else:
+            if config is None:
+                raise ValueError('A config is needed to create a new task file')
+            self._file = path.open('wb')
+            self._index = index_path(path).open('wb')
+            self._file.write(MAGIC)
+            self._write_record(config)
+            self.count = 0
+        self._flush()
+
+    def write(self, task):
+        offset = self._write_record(task)
+        self._index.write(_OFFSET.pack(offset))
+        self.count += 1
+        self._flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.write(_LENGTH.pack(0))
+        self._flush()
+        self._file.close()
+        self._index.close()
+
+    def _write_record(self, obj) -> int:
+        offset = self._file.tell()
+        data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        self._file.write(_LENGTH.pack(len(data)))
+        self._file.write(data)
+        return offset
+
+    def _flush(self):
+        # The index must never refer to data that isn't written yet.
+        self._file.flush()
+        self._index.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def write_tasks(path: Path, config: dict, tasks) -> int:
+    """
+    Write the config and all tasks to a new task file, as `task_app.save_tasks()` does.
+
+    Tasks are readable as soon as they're written, so a run can follow the file while it's generated.
+
+    :return: Number of tasks written. If there were none, no file is left behind.
+    """
+    # Replace any existing file, rather than appending to it.
+    if path.exists():
+        path.unlink()
+    with TaskFileWriter(path, config) as writer:
+        for task in tasks:
+            writer.write(task)
+
+    if not writer.count:
+        path.unlink()
+        index_path(path).unlink()
+        return 0
+    _LOG.info('Saved config and %d tasks to %s', writer.count, path)
+    return writer.count
+
+
+def count_tasks(path: Path) -> int:
+    """Number of tasks written so far (from the index)"""
+    return index_path(path).stat().st_size // _OFFSET.size
+
+
+def read_task(path: Path, task_number: int):
+    """Read a single task (numbered from zero)"""
+    with index_path(path).open('rb') as index:
+        index.seek(task_number * _OFFSET.size)
+        entry = index.read(_OFFSET.size)
+        if len(entry) < _OFFSET.size:
+            raise IndexError('Task {} is not in {}'.format(task_number, path))
+        offset, = _OFFSET.unpack(entry)
+
+    with path.open('rb') as f:
+        f.seek(offset)
+        length, = _LENGTH.unpack(f.read(_LENGTH.size))
+        return pickle.loads(f.read(length))
+
+
+def load_tasks(path: Path,
+               shard: Shard = None,
+               follow: bool = False,
+               poll_interval: float = DEFAULT_POLL_INTERVAL,
+               idle_timeout: float = None) -> Tuple[dict, Iterator]:
+    """
+    Load the config, and a lazy iterator of tasks, as `task_app.load_tasks()` does.
+
+    Tasks are read only as the iterator is consumed, so that the first can be run without
+    waiting for the rest.
+
+    :param shard: only return the tasks in this shard.
+    :param follow: if the file is still being written, wait for more tasks until it's complete.
+    :param idle_timeout: when following, give up if no more has been written for this many seconds.
+    """
+    path = Path(path)
+    if not is_task_file(path):
+        return _load_legacy_tasks(path, shard, follow)
+
+    f = path.open('rb')
+    f.seek(len(MAGIC))
+    reader = _RecordReader(f, follow, poll_interval, idle_timeout)
+    config = reader.read()
+    if config is None:
+        f.close()
+        raise ValueError('Task file {} has no config'.format(path))
+
+    def tasks():
+        try:
+            task_number = 0
+            while True:
+                if shard is None or shard.includes(task_number):
+                    task = reader.read()
+                    if task is None:
+                        break
+                    yield task
+                elif not reader.skip():
+                    break
+                task_number += 1
+        finally:
+            f.close()
+
+    return config, tasks()
+
+
+def _load_legacy_tasks(path: Path, shard: Optional[Shard], follow: bool) -> Tuple[dict, Iterator]:
+    if follow:
+        _LOG.warning("Can't follow %s as it's in the older task_app format: reading what's there", path)
+    config, tasks = task_app.load_tasks(str(path))
+    if shard is not None:
+        tasks = (task for task_number, task in enumerate(tasks) if shard.includes(task_number))
+    return config, tasks
+
+
+class _RecordReader:
+    """
+    Read records from a task file stream.
+
+    A record that isn't (fully) written yet is treated as the end of the file, unless
+    following, in which case we wait for it.
+    """
+
+    def __init__(self, f,
+                 follow: bool = False,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 idle_timeout: Optional[float] = None,
+                 warn_incomplete: bool = True) -> None:
+        self._f = f
+        self._follow = follow
+        self._poll_interval = poll_interval
+        self._idle_timeout = idle_timeout
+        self._warn_incomplete = warn_incomplete
+
+    def read(self):
+        """The next record, or None at the end of the file"""
+        length = self._next_length(read_data=True)
+        if length is None:
+            return None
+        return pickle.loads(self._f.read(length))
+
+    def skip(self) -> bool:
+        """Skip the next record without unpickling it. False at the end of the file"""
+        length = self._next_length(read_data=False)
+        if length is None:
+            return False
+        self._f.seek(length, os.SEEK_CUR)
+        return True
+
+    def _next_length(self, read_data: bool) -> Optional[int]:
+        """
+        Wait for the next record to be complete, and return its length (positioned at its data).
+        """
+        waited_since = None
+        while True:
+            start = self._f.tell()
+            size = os.fstat(self._f.fileno()).st_size
+
+            if size - start >= _LENGTH.size:
+                length, = _LENGTH.unpack(self._f.read(_LENGTH.size))
+                if length == 0:
+                    # The end marker
+                    return None
+                if size - self._f.tell() >= length:
+                    return length
+                self._f.seek(start)
+
+            if not self._follow:
+                if self._warn_incomplete:
+                    if size > start:
+                        _LOG.warning('Ignoring a partially-written task at the end of %s', self._f.name)
+                    else:
+                        _LOG.warning('%s is not complete: it may still be being written', self._f.name)
+                return None
+
+            now = time.monotonic()
+            if waited_since is None:
+                waited_since = now
+            elif self._idle_timeout is not None and now - waited_since > self._idle_timeout:
+                _LOG.warning('Nothing written to %s for %ds: stopping', self._f.name, self._idle_timeout)
+                return None
+            time.sleep(self._poll_interval)
+
+
+def _scan(f) -> List[int]:
+    """
+    Find the offsets of all complete task records, leaving the stream positioned after the last.
+    """
+    f.seek(len(MAGIC))
+    size = os.fstat(f.fileno()).st_size
+    reader = _RecordReader(f, warn_incomplete=False)
+
+    # The config
+    reader.skip()
+
+    offsets = []
+    while True:
+        offset = f.tell()
+        if not reader.skip():
+            f.seek(offset)
+            break
+        offsets.append(offset)
+
+    if f.tell() < size - _LENGTH.size:
+        _LOG.warning('Discarding a partially-written task at the end of %s', f.name)
+    return offsets
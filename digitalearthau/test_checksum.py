@@ -0,0 +1,101 @@
+import hashlib
+from pathlib import Path
+
+import pytest
+from eodatasets3 import verify
+
+from . import checksum
+
+
+def _write_package(base: Path) -> Path:
+    package = base.joinpath('LS8_PACKAGE')
+    package.joinpath('product').mkdir(parents=True)
+    package.joinpath('ga-metadata.yaml').write_text('id: test')
+    package.joinpath('product', 'band1.tif').write_bytes(b'some band data' * 10000)
+
+    ch = verify.PackageChecksum()
+    ch.add_file(package.joinpath('ga-metadata.yaml'))
+    ch.add_file(package.joinpath('product'))
+    ch.write(package.joinpath('package.sha1'))
+    return package
+
+
+def test_hash_file_matches_hashlib(tmpdir):
+    f = Path(str(tmpdir)).joinpath('file.bin')
+    data = b'0123456789' * 100000
+    f.write_bytes(data)
+
+    assert checksum.hash_file(f, buffer_size=4096) == hashlib.sha1(data).hexdigest()
+
+
+@pytest.mark.parametrize('kernel_copy', [False, True])
+def test_copy_tree_and_verify(tmpdir, kernel_copy):
+    base = Path(str(tmpdir))
+    package = _write_package(base)
+    expected = checksum.read_checksum_file(package.joinpath('package.sha1'))
+    assert len(expected) == 2
+
+    dest = base.joinpath('dest')
+    failures = checksum.copy_tree_and_verify(package, dest, expected, kernel_copy=kernel_copy)
+    assert failures == []
+
+    band = dest.joinpath('product', 'band1.tif')
+    assert band.read_bytes() == package.joinpath('product', 'band1.tif').read_bytes()
+    assert dest.joinpath('package.sha1').exists()
+
+
+def test_copy_tree_with_empty_and_linked_directories(tmpdir):
+    base = Path(str(tmpdir))
+    package = _write_package(base)
+    package.joinpath('empty').mkdir()
+    linked = base.joinpath('elsewhere')
+    linked.mkdir()
+    linked.joinpath('band2.tif').write_bytes(b'linked band data')
+    package.joinpath('linked').symlink_to(linked)
+
+    dest = base.joinpath('dest')
+    failures = checksum.copy_tree_and_verify(package, dest, {})
+    assert failures == []
+
+    assert dest.joinpath('empty').is_dir()
+    # Linked directories are copied, as with shutil.copytree.
+    assert not dest.joinpath('linked').is_symlink()
+    assert dest.joinpath('linked', 'band2.tif').read_bytes() == b'linked band data'
+
+
+def test_copy_tree_reports_failures(tmpdir):
+    base = Path(str(tmpdir))
+    package = _write_package(base)
+    expected = checksum.read_checksum_file(package.joinpath('package.sha1'))
+
+    # Corrupt one file, and list another that doesn't exist.
+    package.joinpath('product', 'band1.tif').write_bytes(b'corrupt')
+    missing = package.joinpath('product', 'band2.tif')
+    expected[missing] = 'abcdef'
+
+    failures = checksum.copy_tree_and_verify(package, base.joinpath('dest'), expected)
+    assert {f.path for f in failures} == {package.joinpath('product', 'band1.tif'), missing}
+
+
+def test_generate_then_verify(tmpdir):
+    base = Path(str(tmpdir))
+    nc_file = base.joinpath('LS8_SOMETHING.nc')
+    nc_file.write_bytes(b'netcdf data' * 1000)
+
+    stats = checksum.generate_checksums([nc_file], checksum.Throughput('test'), workers=2)
+    assert stats.dataset_count == 1
+    checksum_file = checksum.package_checksum_path(nc_file)
+    assert checksum_file.read_text() == '{}\tLS8_SOMETHING.nc\n'.format(checksum.hash_file(nc_file))
+
+    with checksum.HashCache(base.joinpath('cache.jsonl')) as cache:
+        stats = checksum.verify_datasets([nc_file], checksum.Throughput('test'), cache=cache)
+        assert (stats.failure_count, stats.read_bytes, stats.cached_bytes) == (0, 11000, 0)
+
+    # Unchanged files are verified from the cache, without being read again.
+    with checksum.HashCache(base.joinpath('cache.jsonl')) as cache:
+        stats = checksum.verify_datasets([nc_file], checksum.Throughput('test'), cache=cache)
+        assert (stats.failure_count, stats.read_bytes, stats.cached_bytes) == (0, 0, 11000)
+
+    nc_file.write_bytes(b'corrupted')
+    stats = checksum.verify_datasets([nc_file], checksum.Throughput('test'))
+    assert stats.failure_count == 1
@@ -0,0 +1,43 @@
+import multiprocessing
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from mock import mock
+
+from . import cleanup
+
+
+def _slow_dataset_ids(path: Path):
+    """Read no ids slowly, recording when we were reading"""
+    start = time.time()
+    time.sleep(0.2)
+    path.with_suffix('.times').write_text('{} {}'.format(start, time.time()))
+    return [uuid.uuid4()]
+
+
+def test_netcdf_reads_overlap(tmpdir):
+    base = Path(str(tmpdir))
+    cleanup.paths.register_base_directory(base)
+    files = [base.joinpath('LS8_{}.nc'.format(i)) for i in range(4)]
+    for f in files:
+        f.write_text('')
+    locations = [(f.as_uri(), [uuid.uuid4()]) for f in files]
+
+    # Forked, so that the workers see the patched reader.
+    with mock.patch.object(cleanup.paths, 'get_path_dataset_ids', _slow_dataset_ids), \
+            mock.patch.object(cleanup, '_get_known_dataset_ids', lambda db, ids: ids), \
+            ThreadPoolExecutor(max_workers=4) as executor, \
+            ProcessPoolExecutor(max_workers=4, mp_context=multiprocessing.get_context('fork')) as reader:
+        trash_count = cleanup._cleanup_locations(None, True, locations, mock.Mock(), mock.Mock(),
+                                                 executor=executor, reader=reader, jobs=4)
+
+    assert trash_count == 4
+    # Every read started before any had finished.
+    times = [tuple(map(float, f.with_suffix('.times').read_text().split())) for f in files]
+    assert max(start for start, _ in times) < min(end for _, end in times)
+
+
+def test_missing_location(tmpdir):
+    assert cleanup._read_location_ids(Path(str(tmpdir)).joinpath('missing.nc').as_uri()) is None
@@ -0,0 +1,95 @@
+import uuid
+from contextlib import contextmanager
+
+import pytest
+
+from .index import BatchedIndexWriter
+
+
+class FakeTransaction:
+    def __init__(self) -> None:
+        self.operations = []
+
+    def __getattr__(self, operation):
+        return lambda *args: self.operations.append((operation,) + args)
+
+
+class FakeDb:
+    def __init__(self) -> None:
+        self.transactions = []
+        self.fail = False
+
+    @contextmanager
+    def begin(self):
+        transaction = FakeTransaction()
+        yield transaction
+        if self.fail:
+            raise RuntimeError('Commit failed')
+        self.transactions.append(transaction.operations)
+
+
+class FakeIndex:
+    """Just enough of an index for BatchedIndexWriter: it records the operations of each committed transaction"""
+
+    def __init__(self) -> None:
+        self.datasets = self
+        self._db = FakeDb()
+
+    @property
+    def transactions(self):
+        return self._db.transactions
+
+
+def test_changes_applied_in_batches():
+    index = FakeIndex()
+    ids = [uuid.uuid4() for _ in range(5)]
+    applied = []
+
+    with BatchedIndexWriter(index, batch_size=2) as writer:
+        for id_ in ids:
+            writer.add_location(id_, 'file:///new/' + str(id_), on_applied=lambda id_=id_: applied.append(id_))
+        # Two full batches were applied as they filled.
+        assert len(index.transactions) == 2
+        assert applied == ids[:4]
+
+    # ... and the rest on exit.
+    assert [len(t) for t in index.transactions] == [2, 2, 1]
+    assert index.transactions[2] == [('insert_dataset_location', ids[4], 'file:///new/' + str(ids[4]))]
+    assert applied == ids
+    assert writer.applied_count == 5
+
+
+def test_queued_changes_applied_when_caller_fails():
+    index = FakeIndex()
+    id_ = uuid.uuid4()
+
+    with pytest.raises(ValueError):
+        with BatchedIndexWriter(index) as writer:
+            writer.archive_location(id_, 'file:///old')
+            raise ValueError('Something else failed')
+
+    assert index.transactions == [[('archive_location', id_, 'file:///old')]]
+
+
+def test_not_applied_callbacks_when_commit_fails():
+    index = FakeIndex()
+    index._db.fail = True
+    applied = []
+
+    writer = BatchedIndexWriter(index)
+    writer.archive_dataset(uuid.uuid4(), on_applied=lambda: applied.append(True))
+    with pytest.raises(RuntimeError):
+        writer.flush()
+
+    assert applied == []
+
+
+def test_dry_run_changes_nothing():
+    index = FakeIndex()
+    applied = []
+
+    with BatchedIndexWriter(index, dry_run=True) as writer:
+        writer.remove_location(uuid.uuid4(), 'file:///old', on_applied=lambda: applied.append(True))
+
+    assert index.transactions == []
+    assert applied == [True]
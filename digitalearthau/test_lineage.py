@@ -0,0 +1,37 @@
+import uuid
+from datetime import datetime, timedelta
+
+from .lineage import LineageEdge, LineageGraph
+
+_TIME = datetime(2018, 1, 1)
+
+
+def test_lineage_graph():
+    level1, other_level1 = uuid.uuid4(), uuid.uuid4()
+    nbar_a, nbar_b, nbar_c = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+
+    graph = LineageGraph.from_edges([
+        LineageEdge(nbar_a, False, _TIME, 'level1', level1, False),
+        LineageEdge(nbar_b, True, _TIME + timedelta(days=1), 'level1', level1, False),
+        LineageEdge(nbar_c, False, _TIME + timedelta(days=2), 'level1', other_level1, True),
+        LineageEdge(nbar_c, False, _TIME + timedelta(days=2), 'extra', level1, False),
+    ])
+    assert len(graph) == 5
+    assert graph.edge_count == 4
+
+    assert graph.sources(nbar_a) == [('level1', level1)]
+    assert graph.sources(nbar_c) == [('level1', other_level1), ('extra', level1)]
+    assert graph.derived(level1) == [nbar_a, nbar_b, nbar_c]
+    assert graph.derived(nbar_a) == []
+
+    unknown = uuid.uuid4()
+    assert unknown not in graph
+    assert graph.sources(unknown) == []
+
+    assert graph.is_archived(nbar_b)
+    assert graph.is_archived(other_level1)
+    assert not graph.is_archived(nbar_a)
+    assert graph.indexed_time(nbar_c) > graph.indexed_time(nbar_b) > graph.indexed_time(nbar_a)
+
+    graph.mark_archived([nbar_a, unknown])
+    assert graph.is_archived(nbar_a)
@@ -0,0 +1,288 @@
+import shutil
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+import pytest
+from eodatasets3 import verify
+
+from . import paths
+from .index import BatchedIndexWriter
+from .move import FileMover, MoveJournal, _FolderLimit, move_all, \
+    MOVE_PLANNED, MOVE_COPIED, MOVE_DEST_ADDED, MOVE_SOURCE_ARCHIVED
+
+
+class FakeDataset:
+    def __init__(self, id_: uuid.UUID, uris) -> None:
+        self.id = id_
+        self.uris = list(uris)
+        self.is_archived = False
+
+
+class FakeTransaction:
+    def __init__(self, index: 'FakeIndex') -> None:
+        self.index = index
+
+    def insert_dataset_location(self, id_, uri):
+        self.index.datasets.get(id_).uris.append(uri)
+
+    def archive_location(self, id_, uri):
+        self.index.datasets.get(id_).uris.remove(uri)
+
+
+class FakeIndex:
+    """Datasets by id, with location changes applied by BatchedIndexWriter transactions"""
+
+    def __init__(self, datasets) -> None:
+        self._datasets = {d.id: d for d in datasets}
+        self.datasets = self
+        self._db = self
+        self.transaction_count = 0
+
+    def get(self, id_):
+        return self._datasets.get(id_)
+
+    @contextmanager
+    def begin(self):
+        yield FakeTransaction(self)
+        self.transaction_count += 1
+
+
+def _write_dataset(base: Path, name: str, corrupt=False) -> FakeDataset:
+    package = base.joinpath('LS8_SCENES', name)
+    package.mkdir(parents=True)
+    id_ = uuid.uuid4()
+    package.joinpath('ga-metadata.yaml').write_text('id: {}\n'.format(id_))
+    package.joinpath('band1.tif').write_bytes(b'some band data ' * 1000)
+
+    ch = verify.PackageChecksum()
+    ch.add_file(package.joinpath('ga-metadata.yaml'))
+    ch.add_file(package.joinpath('band1.tif'))
+    ch.write(package.joinpath('package.sha1'))
+    if corrupt:
+        package.joinpath('band1.tif').write_bytes(b'changed since it was checksummed')
+
+    return FakeDataset(id_, [package.joinpath('ga-metadata.yaml').as_uri()])
+
+
+@pytest.fixture
+def bases(tmpdir):
+    source = Path(str(tmpdir)).joinpath('source')
+    destination = Path(str(tmpdir)).joinpath('destination')
+    source.mkdir()
+    destination.mkdir()
+    paths.register_base_directory(source)
+    paths.register_base_directory(destination)
+    return source, destination
+
+
+def _dest_uri(destination: Path, name: str) -> str:
+    return destination.joinpath('LS8_SCENES', name, 'ga-metadata.yaml').as_uri()
+
+
+def test_parallel_move(bases):
+    source, destination = bases
+    names = ['LS8_SCENE_{}'.format(i) for i in range(6)]
+    datasets = [_write_dataset(source, name) for name in names]
+    index = FakeIndex(datasets)
+
+    move_all(index, [source.joinpath('LS8_SCENES', name) for name in names], destination, jobs=3)
+
+    for name, dataset in zip(names, datasets):
+        assert destination.joinpath('LS8_SCENES', name, 'band1.tif').exists()
+        assert dataset.uris == [_dest_uri(destination, name)]
+    # Changes were batched, rather than a transaction per change.
+    assert index.transaction_count < len(names) * 2
+
+
+def test_move_with_empty_directory(bases):
+    source, destination = bases
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    source.joinpath('LS8_SCENES', 'LS8_SCENE', 'empty').mkdir()
+    index = FakeIndex([dataset])
+
+    move_all(index, [source.joinpath('LS8_SCENES', 'LS8_SCENE')], destination)
+
+    assert destination.joinpath('LS8_SCENES', 'LS8_SCENE', 'empty').is_dir()
+    assert dataset.uris == [_dest_uri(destination, 'LS8_SCENE')]
+
+
+def test_parallel_move_failure_keeps_finished_copies(bases):
+    source, destination = bases
+    good = _write_dataset(source, 'LS8_SCENE_GOOD')
+    bad = _write_dataset(source, 'LS8_SCENE_BAD', corrupt=True)
+    index = FakeIndex([good, bad])
+
+    with pytest.raises(RuntimeError):
+        move_all(index,
+                 [source.joinpath('LS8_SCENES', 'LS8_SCENE_BAD'), source.joinpath('LS8_SCENES', 'LS8_SCENE_GOOD')],
+                 destination, jobs=2)
+
+    # The good dataset was still moved in the index, despite the other failing.
+    assert good.uris == [_dest_uri(destination, 'LS8_SCENE_GOOD')]
+    assert len(bad.uris) == 1
+    assert not destination.joinpath('LS8_SCENES', 'LS8_SCENE_BAD').exists()
+
+
+def test_index_logged_when_applied(bases):
+    source, destination = bases
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    index = FakeIndex([dataset])
+    mover = FileMover.evaluate_and_create(index, source.joinpath('LS8_SCENES', 'LS8_SCENE'), destination)
+
+    logged = []
+    mover.log = _RecordingLog(logged)
+
+    with BatchedIndexWriter(index) as writer:
+        mover.record_move(writer)
+        assert logged == []
+    assert logged == ['index.dest.added', 'index.source.archived']
+
+
+class _RecordingLog:
+    def __init__(self, events) -> None:
+        self.events = events
+
+    def info(self, event, **kwargs):
+        self.events.append(event)
+
+
+def test_folder_limit():
+    limit = _FolderLimit(2)
+    lock = threading.Lock()
+    active = {'a': 0, 'b': 0}
+    most_active = {'a': 0, 'b': 0}
+
+    def use(folder):
+        with limit.acquire(Path(folder)):
+            with lock:
+                active[folder] += 1
+                most_active[folder] = max(most_active[folder], active[folder])
+            time.sleep(0.05)
+            with lock:
+                active[folder] -= 1
+
+    threads = [threading.Thread(target=use, args=(folder,)) for folder in 'ab' * 4]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Each folder is limited separately.
+    assert most_active == {'a': 2, 'b': 2}
+
+
+def _journal_move(index, source, destination, name, state, journal_path) -> FileMover:
+    """Record a move as having reached the given state in a previous run"""
+    mover = FileMover.evaluate_and_create(index, source.joinpath('LS8_SCENES', name), destination)
+    with MoveJournal(journal_path) as journal:
+        journal.record(mover, state)
+    return mover
+
+
+def test_journal_replay(tmpdir, bases):
+    source, destination = bases
+    journal_path = Path(str(tmpdir)).joinpath('move-journal.jsonl')
+    datasets = [_write_dataset(source, name) for name in ('LS8_SCENE_1', 'LS8_SCENE_2')]
+    index = FakeIndex(datasets)
+
+    _journal_move(index, source, destination, 'LS8_SCENE_1', MOVE_PLANNED, journal_path)
+    _journal_move(index, source, destination, 'LS8_SCENE_2', MOVE_PLANNED, journal_path)
+    _journal_move(index, source, destination, 'LS8_SCENE_2', MOVE_SOURCE_ARCHIVED, journal_path)
+
+    with MoveJournal(journal_path) as journal:
+        # The latest state of each dataset.
+        assert len(journal) == 2
+        assert [r['state'] for r in journal.unfinished()] == [MOVE_PLANNED]
+        assert journal.has(source.joinpath('LS8_SCENES', 'LS8_SCENE_1', 'ga-metadata.yaml'))
+
+        # No paths given: the unfinished move is resumed from the journal alone.
+        move_all(index, [], destination, journal=journal)
+        assert journal.unfinished() == []
+
+    assert datasets[0].uris == [_dest_uri(destination, 'LS8_SCENE_1')]
+    # The finished one isn't touched again.
+    assert not destination.joinpath('LS8_SCENES', 'LS8_SCENE_2').exists()
+
+
+@pytest.mark.parametrize('state', [MOVE_PLANNED, MOVE_COPIED])
+def test_resume_with_valid_copy(tmpdir, bases, state):
+    source, destination = bases
+    journal_path = Path(str(tmpdir)).joinpath('move-journal.jsonl')
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    index = FakeIndex([dataset])
+    mover = _journal_move(index, source, destination, 'LS8_SCENE', state, journal_path)
+
+    # Interrupted after the copy, before it was recorded in the index.
+    shutil.copytree(str(mover.source_path), str(mover.dest_path))
+    marker = mover.dest_path.joinpath('not-copied-again')
+    marker.write_text('')
+
+    with MoveJournal(journal_path) as journal:
+        move_all(index, [], destination, journal=journal)
+
+    # Verified in place rather than copied again.
+    assert marker.exists()
+    assert dataset.uris == [_dest_uri(destination, 'LS8_SCENE')]
+
+
+def test_resume_with_corrupt_copy(tmpdir, bases):
+    source, destination = bases
+    journal_path = Path(str(tmpdir)).joinpath('move-journal.jsonl')
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    index = FakeIndex([dataset])
+    mover = _journal_move(index, source, destination, 'LS8_SCENE', MOVE_COPIED, journal_path)
+
+    shutil.copytree(str(mover.source_path), str(mover.dest_path))
+    mover.dest_path.joinpath('band1.tif').write_bytes(b'corrupt')
+
+    with MoveJournal(journal_path) as journal:
+        move_all(index, [], destination, journal=journal)
+        # Skipped, and left for an operator to look at.
+        assert len(journal.unfinished()) == 1
+
+    assert dataset.uris == [mover.source_uri]
+
+
+@pytest.mark.parametrize('checksum, remove_checksum_file', [(False, False), (True, True)])
+def test_resume_with_unverifiable_copy(tmpdir, bases, checksum, remove_checksum_file):
+    source, destination = bases
+    journal_path = Path(str(tmpdir)).joinpath('move-journal.jsonl')
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    index = FakeIndex([dataset])
+    mover = _journal_move(index, source, destination, 'LS8_SCENE', MOVE_COPIED, journal_path)
+    if remove_checksum_file:
+        mover.source_path.joinpath('package.sha1').unlink()
+
+    # A previous copy that may be incomplete.
+    mover.dest_path.mkdir(parents=True)
+    mover.dest_path.joinpath('ga-metadata.yaml').write_text('partial')
+
+    with MoveJournal(journal_path) as journal:
+        move_all(index, [], destination, journal=journal, checksum=checksum)
+        assert journal.unfinished() == []
+
+    # It's copied again, and the old copy trashed.
+    assert mover.dest_path.joinpath('band1.tif').exists()
+    assert mover.dest_metadata_path.read_text() == mover.from_metadata_path.read_text()
+    assert paths.get_trash_path(mover.dest_metadata_path).read_text() == 'partial'
+    assert dataset.uris == [_dest_uri(destination, 'LS8_SCENE')]
+
+
+def test_resume_after_dest_added(tmpdir, bases):
+    source, destination = bases
+    journal_path = Path(str(tmpdir)).joinpath('move-journal.jsonl')
+    dataset = _write_dataset(source, 'LS8_SCENE')
+    index = FakeIndex([dataset])
+    mover = _journal_move(index, source, destination, 'LS8_SCENE', MOVE_DEST_ADDED, journal_path)
+    shutil.copytree(str(mover.source_path), str(mover.dest_path))
+    dataset.uris.append(mover.dest_uri)
+
+    with MoveJournal(journal_path) as journal:
+        move_all(index, [], destination, journal=journal)
+        assert journal.unfinished() == []
+
+    # Only the source is archived: the destination isn't added twice.
+    assert dataset.uris == [mover.dest_uri]
@@ -0,0 +1,73 @@
+import fnmatch
+from pathlib import PurePosixPath
+
+from .pathmatch import PathTrie
+
+PATTERNS = {
+    'ls8_scene': '/g/data/v10/reprocess/ls8/level1/[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml',
+    'ls7_scene': '/g/data/v10/reprocess/ls7/level1/[0-9][0-9][0-9][0-9]/[0-9][0-9]/LS*/ga-metadata.yaml',
+    'ls8_nbar': '/g/data/rs0/datacube/002/LS8_OLI_NBAR/*_*/LS8*NBAR*.nc',
+    'ls8_pq': '/g/data/rs0/datacube/002/LS8_OLI_PQ/*_*/LS8*PQ*.nc',
+}
+
+SAMPLE_PATHS = [
+    '/g/data/v10/reprocess',
+    '/g/data/v10/reprocess/ls8/level1/2016',
+    '/g/data/v10/reprocess/ls8/level1/2016/09',
+    '/g/data/v10/reprocess/ls8/level1/2016/09/LS8_OLITIRS_OTH_P51_GALPGS01-032_114_080_20160926',
+    '/g/data/v10/reprocess/ls8/level1/2016/09/LS8_OLITIRS_OTH_P51_GALPGS01-032_114_080_20160926/ga-metadata.yaml',
+    '/g/data/v10/reprocess/ls8/level1/201',
+    '/g/data/v10/reprocess/ls9',
+    '/g/data/rs0/datacube/002',
+    '/g/data/rs0/datacube/002/LS8_OLI_NBAR/15_-40',
+    '/g/data/rs0/datacube/002/LS8_OLI_NBAR/15_-40/LS8_OLI_NBAR_3577_15_-40_2016_v1.nc',
+    '/g/data/rs0/datacube/002/LS8_OLI_NBAR/1540',
+    '/g/data',
+    '/g/data/fk4',
+    '/',
+]
+
+
+def _fnmatch_owners(path):
+    """The slow, reference implementation: each pattern (or its parents) checked in turn"""
+    return [
+        name for name, pat in PATTERNS.items()
+        if fnmatch.fnmatch(path, pat) or any(fnmatch.fnmatch(path, str(p)) for p in PurePosixPath(pat).parents)
+    ]
+
+
+def test_matches_same_as_fnmatch():
+    trie = PathTrie()
+    for name, pat in PATTERNS.items():
+        trie.add(pat, name)
+
+    for path in SAMPLE_PATHS:
+        assert trie.matches(path) == _fnmatch_owners(path), path
+
+
+def test_wildcards_stay_within_a_segment():
+    trie = PathTrie()
+    trie.add('/data/*/file.nc', 'a')
+
+    assert trie.matches('/data/x/file.nc') == ['a']
+    # Unlike plain fnmatch, a star doesn't cross directories.
+    assert trie.matches('/data/x/y/file.nc') == []
+
+
+def test_value_with_multiple_patterns_returned_once():
+    trie = PathTrie()
+    trie.add('/data/one/*.nc', 'a')
+    trie.add('/data/*/*.nc', 'a')
+    trie.add('/data/two/*.nc', 'b')
+
+    assert trie.matches('/data/one/x.nc') == ['a']
+    assert trie.matches('/data') == ['a', 'b']
+
+
+def test_longest_match_respects_segment_boundaries():
+    trie = PathTrie()
+    trie.add('/g/data/fk4/datacube', 'fk4')
+
+    assert trie.longest_match('/g/data/fk4/datacube/ls7/x.nc') == ('fk4', ('ls7', 'x.nc'))
+    # A sibling folder that merely shares a name prefix isn't within the base directory.
+    assert trie.longest_match('/g/data/fk4/datacube2/ls7/x.nc') is None
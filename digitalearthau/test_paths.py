@@ -1,3 +1,7 @@
+import os
+
+import pytest
+
 from . import paths
 
 
@@ -89,3 +93,70 @@ def test_get_data_paths_s2_ard_package():
         metadata_path,
         packaged_dataset.joinpath('package', 'file1.txt')
     }
+
+
+def test_register_base_directory():
+    base = paths.write_files({'LS7_SOMETHING.nc': ''})
+    nc_path = base.joinpath('LS7_SOMETHING.nc')
+
+    with pytest.raises(ValueError):
+        paths.split_path_from_base(nc_path)
+
+    # The compiled index must pick up new base directories.
+    paths.register_base_directory(base)
+    assert paths.split_path_from_base(nc_path) == (base, 'LS7_SOMETHING.nc')
+
+
+def test_trash_uris_journal():
+    base = paths.write_files({
+        'LS7_SOMETHING.nc': '',
+        'LS8_PACKAGE': {
+            'ga-metadata.yaml': '',
+            'band.tif': '',
+        },
+    })
+    paths.register_base_directory(base)
+
+    nc_path = base.joinpath('LS7_SOMETHING.nc')
+    package_metadata = base.joinpath('LS8_PACKAGE', 'ga-metadata.yaml')
+    missing_path = base.joinpath('LS7_MISSING.nc')
+
+    was_trashed = paths.trash_uris(
+        [nc_path.as_uri(), package_metadata.as_uri(), missing_path.as_uri()],
+        workers=2
+    )
+    assert was_trashed == {
+        nc_path.as_uri(): True,
+        package_metadata.as_uri(): True,
+        missing_path.as_uri(): False,
+    }
+
+    trash_day_folder = base.joinpath('.trash', paths._TRASH_DAY)
+    assert not nc_path.exists()
+    assert trash_day_folder.joinpath('LS7_SOMETHING.nc').exists()
+    assert not package_metadata.parent.exists()
+    assert trash_day_folder.joinpath('LS8_PACKAGE', 'band.tif').exists()
+
+    # Every move is journalled, so it can be undone.
+    moves = list(paths.read_trash_journal(trash_day_folder.joinpath(paths.TRASH_JOURNAL_NAME)))
+    assert {(m.original_path, m.trash_path) for m in moves} == {
+        (nc_path, trash_day_folder.joinpath('LS7_SOMETHING.nc')),
+        (package_metadata.parent, trash_day_folder.joinpath('LS8_PACKAGE')),
+    }
+
+
+def test_directory_listing_cache():
+    d = paths.write_files({
+        'LS7_SOMETHING.tif': '',
+    })
+    # Pretend the folder was last changed long ago, so its listing is cached.
+    os.utime(str(d), (1000000000, 1000000000))
+    assert paths._list_directory(d) == ('LS7_SOMETHING.tif',)
+
+    # Folder changes are noticed: the mtime is part of the cache key.
+    d.joinpath('LS7_SOMETHING.tif.ga-md.yaml').write_text('')
+    os.utime(str(d), (1000000001, 1000000001))
+    assert paths._list_directory(d) == ('LS7_SOMETHING.tif', 'LS7_SOMETHING.tif.ga-md.yaml')
+    assert paths.get_metadata_path(d.joinpath('LS7_SOMETHING.tif')) == d.joinpath('LS7_SOMETHING.tif.ga-md.yaml')
+
+    assert paths._list_directory(d.joinpath('missing')) == ()
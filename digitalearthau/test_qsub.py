@@ -1,8 +1,13 @@
+import collections
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import StringIO
 from uuid import UUID
 
 import os
+from pathlib import Path
 
 import pytest
 from boltons.jsonutils import JSONLIterator
@@ -15,6 +20,11 @@ from typing import List
 from digitalearthau.events import TaskEvent, NodeMessage, Status
 from digitalearthau.runners import model
 from digitalearthau.runners.celery_environment import _celery_event_to_task
+from digitalearthau.runners.completion import CompletionLog
+from digitalearthau.runners import local
+from digitalearthau.runners.local import LocalProcessExecutor
+from digitalearthau.runners.stragglers import RetryPolicy, StragglerPolicy
+from digitalearthau.runners.window import AdaptiveWindow
 from . import qsub
 
 import celery.events.state as celery_state
@@ -256,3 +266,326 @@ def test_celery_success_to_task(input_json: str, expected_events: List[TaskEvent
     assert len(events) == len(expected_events)
     for i, event in enumerate(events):
         assert event == expected_events[i]
+
+
+###############################################
+# Task window
+###############################################
+
+class _FakeExecutor:
+    """Completes tasks in submission order, running each when its result is asked for"""
+
+    def __init__(self):
+        self.in_flight = []
+        self.max_in_flight = 0
+
+    def submit(self, func, task):
+        future = (func, task)
+        self.in_flight.append(future)
+        self.max_in_flight = max(self.max_in_flight, len(self.in_flight))
+        return future
+
+    def next_completed(self, futures, default):
+        self.in_flight.remove(futures[0])
+        return futures[0], futures[1:]
+
+    def result(self, future):
+        func, task = future
+        return func(task=task)
+
+    def release(self, future):
+        pass
+
+
+def test_run_tasks_fixed_window():
+    executor = _FakeExecutor()
+    results = []
+
+    counts = qsub.run_tasks(range(20), executor, lambda task: 10 // task, results.append, queue_size=3)
+
+    # Dividing by zero fails
+    assert counts == (19, 1, 0)
+    assert sorted(results) == sorted(10 // i for i in range(1, 20))
+    assert executor.max_in_flight == 3
+
+
+def test_run_tasks_result_failures_counted_separately():
+    batches = []
+
+    def process_batch(results):
+        if 13 in results:
+            raise ValueError('Unlucky')
+        batches.append(results)
+
+    counts = qsub.run_tasks(range(40), _FakeExecutor(), lambda task: task,
+                            process_result_batch=process_batch, queue_size=5)
+
+    assert counts == qsub.TaskCounts(successful=40, failed=0, result_failed=1)
+    # Every other result was processed (a failed batch is retried one at a time)
+    assert sorted(r for batch in batches for r in batch) == [i for i in range(40) if i != 13]
+
+
+class _ThreadedExecutor:
+    """Runs tasks on a thread pool"""
+
+    def __init__(self, workers):
+        self._pool = ThreadPoolExecutor(workers)
+
+    def submit(self, func, task):
+        return self._pool.submit(func, task=task)
+
+    @staticmethod
+    def get_ready(futures):
+        return [f for f in futures if f.done()], [], [f for f in futures if not f.done()]
+
+    @staticmethod
+    def next_completed(futures, default):
+        future = next(as_completed(futures))
+        return future, [f for f in futures if f is not future]
+
+    @staticmethod
+    def result(future):
+        return future.result()
+
+    @staticmethod
+    def release(future):
+        pass
+
+
+def test_run_tasks_retries_failures():
+    attempts = collections.Counter()
+
+    def flaky_task(task):
+        attempts[task] += 1
+        # Task 3 fails twice, task 5 always fails.
+        if (task == 3 and attempts[task] <= 2) or task == 5:
+            raise IOError('Lustre hiccup')
+        return task
+
+    results = []
+    counts = qsub.run_tasks(range(8), _FakeExecutor(), flaky_task, results.append, queue_size=4,
+                            retry_policy=RetryPolicy(attempts=3, backoff=0))
+
+    assert counts == (7, 1, 0)
+    assert sorted(results) == [0, 1, 2, 3, 4, 6, 7]
+    assert attempts[3] == 3
+    assert attempts[5] == 3
+    assert attempts[0] == 1
+
+
+@mock.patch.object(qsub, '_COMPLETION_POLL_INTERVAL', 0.001)
+def test_run_tasks_speculates_on_stragglers():
+    attempts = collections.Counter()
+    unstick = threading.Event()
+
+    def task_on_bad_node(task):
+        attempts[task] += 1
+        # The first attempt at task 15 is stuck
+        if task == 15 and attempts[task] == 1:
+            unstick.wait(10)
+            return 'stuck'
+        time.sleep(0.01)
+        return 'ok'
+
+    results = []
+    try:
+        counts = qsub.run_tasks(
+            range(20), _ThreadedExecutor(4), task_on_bad_node, results.append, queue_size=4,
+            straggler_policy=StragglerPolicy(factor=3, min_samples=5, speculate=True, check_interval=0),
+            is_idempotent=lambda task: True,
+        )
+    finally:
+        unstick.set()
+
+    assert counts == (20, 0, 0)
+    assert attempts[15] == 2
+    # The speculative copy finished first
+    assert results.count('ok') == 20
+
+
+@mock.patch.object(qsub, '_COMPLETION_POLL_INTERVAL', 0.001)
+def test_run_tasks_wont_speculate_without_idempotency():
+    attempts = collections.Counter()
+
+    def slow_task(task):
+        attempts[task] += 1
+        time.sleep(0.2 if task == 15 else 0.01)
+        return task
+
+    with mock.patch.object(qsub, '_LOG') as log:
+        counts = qsub.run_tasks(
+            range(20), _ThreadedExecutor(4), slow_task, queue_size=4,
+            straggler_policy=StragglerPolicy(factor=3, min_samples=5, speculate=True, check_interval=0),
+        )
+
+    assert counts == (20, 0, 0)
+    # Flagged, but not run twice.
+    assert attempts[15] == 1
+    warnings = [call[0][0] for call in log.warning.call_args_list]
+    assert any('safely run twice' in w for w in warnings)
+    assert any('straggling' in w for w in warnings)
+
+
+def _square(task):
+    if task == 7:
+        raise ValueError('Unlucky')
+    return task * task
+
+
+@pytest.mark.parametrize('chunk_size', [1, 3])
+def test_local_process_executor(chunk_size):
+    executor = LocalProcessExecutor(2, chunk_size=chunk_size, preload_modules=(), open_index=False)
+    results = []
+    try:
+        counts = qsub.run_tasks(range(10), executor, _square, results.append, queue_size=4)
+    finally:
+        executor.shutdown()
+
+    assert counts == (9, 1, 0)
+    assert sorted(results) == [i * i for i in range(10) if i != 7]
+
+
+def _unreachable_config(tmpdir) -> Path:
+    config_path = Path(str(tmpdir)).joinpath('datacube.conf')
+    config_path.write_text('[unreachable]\ndb_hostname: localhost\ndb_port: 1\n')
+    return config_path
+
+
+def test_local_process_executor_without_an_index(tmpdir):
+    # Tasks that don't use the index still run when it can't be reached.
+    executor = LocalProcessExecutor(2, preload_modules=(),
+                                    config_paths=[str(_unreachable_config(tmpdir))], environment='unreachable')
+    try:
+        assert executor.result(executor.submit(abs, -3)) == 3
+    finally:
+        executor.shutdown()
+
+
+def test_worker_index_uses_given_config(tmpdir):
+    config_path = _unreachable_config(tmpdir)
+    with mock.patch.multiple(local, _WORKER_INDEX=None, _WORKER_APP_NAME=None,
+                             _WORKER_CONFIG_PATHS=None, _WORKER_ENVIRONMENT=None), \
+            mock.patch.object(local, 'index_connect') as index_connect:
+        local._init_worker('test-app', (), True, [str(config_path)], 'unreachable')
+        assert local.worker_index() is index_connect.return_value
+
+    config, = index_connect.call_args[0]
+    assert config['db_port'] == '1'
+    assert index_connect.call_args[1] == dict(application_name='test-app')
+
+
+def test_window_grows_when_idle_and_shrinks_when_queued():
+    window = AdaptiveWindow(10, min_size=5, max_size=20, clock=lambda: 0)
+
+    # Steady latency: nothing is queued, so workers may be idle.
+    for _ in range(5):
+        window.completed(1.0)
+    assert window.size == 15
+
+    # Latency climbs well above the base: tasks are sitting in the queue.
+    for _ in range(10):
+        window.completed(10.0)
+    assert window.size < 15
+    assert window.smallest >= 5
+    assert window.largest == 15
+
+
+def test_window_broker_memory():
+    now = [0.0]
+    memory_usage = [0.9]
+    window = AdaptiveWindow(16, min_size=2, max_size=64,
+                            memory_probe=lambda: memory_usage[0], clock=lambda: now[0])
+
+    # Broker memory is nearly full: halve.
+    window.completed(1.0)
+    assert window.size == 8
+
+    # Between probes the last reading is used, but we only halve once for it.
+    memory_usage[0] = 0.7
+    for _ in range(20):
+        window.completed(1.0)
+    assert window.size == 8
+
+    # A new reading, still high: halve again.
+    memory_usage[0] = 0.9
+    now[0] += 10
+    window.completed(1.0)
+    assert window.size == 4
+
+    # Still above the low watermark: don't grow, even though nothing is queued.
+    memory_usage[0] = 0.7
+    now[0] += 10
+    window.completed(1.0)
+    assert window.size == 4
+
+    now[0] += 10
+    memory_usage[0] = 0.1
+    window.completed(1.0)
+    assert window.size == 5
+
+
+def test_window_base_latency_ages():
+    now = [0.0]
+    window = AdaptiveWindow(10, min_size=5, max_size=20, clock=lambda: now[0])
+
+    for _ in range(5):
+        window.completed(1.0)
+    assert window.size == 15
+
+    # Tasks become slower: at first it looks like queueing, so the window shrinks.
+    for _ in range(20):
+        now[0] += 1
+        window.completed(10.0)
+    shrunk = window.size
+    assert shrunk < 15
+
+    # But once the old minimum is forgotten, the new latency is the base, and the window grows again.
+    for _ in range(30):
+        now[0] += 60
+        window.completed(10.0)
+    assert window.size > shrunk
+
+
+def test_window_payload_cap():
+    window = AdaptiveWindow(100, max_size=1000, memory_budget_bytes=10 * 1024)
+    window.submitted(b'x' * 1024)
+    assert window.cap < 10
+    assert window.size == window.cap
+
+
+def test_fixed_window():
+    window = AdaptiveWindow.fixed(7)
+    for latency in (1.0, 50.0, 1.0):
+        window.completed(latency)
+    assert window.size == 7
+    assert window.is_fixed
+
+
+###############################################
+# Completion log
+###############################################
+
+def test_completion_log_skips_completed_tasks(tmpdir):
+    events_path = Path(tmpdir) / 'events'
+    output_path = Path(tmpdir) / 'outputs'
+    output_path.mkdir()
+    tasks = [{'tile_index': (i, -10), 'filename': str(output_path / 'tile_{}.nc'.format(i))} for i in range(6)]
+
+    def run_task(task):
+        if task['tile_index'][0] == 4:
+            raise RuntimeError('Killed at walltime')
+        Path(task['filename']).touch()
+        return task['filename']
+
+    with CompletionLog.for_events_dir(events_path) as completion_log:
+        counts = qsub.run_tasks(tasks, _FakeExecutor(), run_task, task_completed=completion_log.record)
+    assert counts == (5, 1, 0)
+
+    # The resubmitted job only needs to run the unfinished task.
+    with CompletionLog.for_events_dir(events_path) as completion_log:
+        assert len(completion_log) == 5
+        assert list(completion_log.skip_completed(tasks)) == [tasks[4]]
+
+        # Unless outputs have since been removed
+        Path(tasks[1]['filename']).unlink()
+        assert list(completion_log.skip_completed(tasks, verify_outputs=True)) == [tasks[1], tasks[4]]
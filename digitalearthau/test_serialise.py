@@ -1,11 +1,16 @@
+import io
 import pathlib
+import uuid
 
 import datetime
 import pytest
 from typing import NamedTuple, List
+from unittest import mock
+
+from dateutil import tz
 
 from digitalearthau import serialise
-from digitalearthau.events import Status
+from digitalearthau.events import Status, TaskEvent, NodeMessage
 from digitalearthau.runners.model import TaskDescription, DefaultJobParameters, TaskAppState
 from pathlib import Path
 
@@ -69,3 +74,77 @@ def test_dump_load_task_structure(tmpdir):
     result = serialise.load_structure(serialised_file, expected_type=TaskDescription)
 
     assert result == task_description
+
+
+def _task_event(job_parameters, status=Status.ACTIVE):
+    return TaskEvent(
+        timestamp=datetime.datetime(2017, 10, 5, 22, 10, 2, 948407, tzinfo=tz.tzutc()),
+        event='task.' + status.name.lower(),
+        user='testuser',
+        node=NodeMessage(hostname='kveikur', pid=29517),
+        message=None,
+        id=uuid.UUID('13d1e3c4-cecd-4306-903f-97ed1ec2d73d'),
+        status=status,
+        name='fc.test',
+        input_datasets=(uuid.UUID('60bc52f1-7a70-43f2-bc8d-2bd138eb2aba'),),
+        job_parameters=job_parameters,
+        parent_id=uuid.UUID('6c5e209a-6d56-5460-9a30-20e264492d5c'),
+    )
+
+
+class _UnclosedStringIO(io.StringIO):
+    def close(self):
+        pass
+
+
+def test_jsonl_cached_fields_output_identical():
+    job_parameters = {'query': {'time': [2013, 2015]}, 'output': pathlib.Path('/g/data/out'), 'ratio': 1.0}
+    events = [_task_event(job_parameters, status) for status in (Status.PENDING, Status.ACTIVE, Status.COMPLETE)]
+
+    plain, cached = _UnclosedStringIO(), _UnclosedStringIO()
+    with serialise.JsonLinesWriter(plain) as writer:
+        for event in events:
+            writer.write_item(event)
+    with serialise.JsonLinesWriter(cached, cached_fields=('job_parameters', 'node')) as writer:
+        for event in events:
+            writer.write_item(event)
+
+    expected = ''.join(serialise.to_lenient_json(serialise.type_to_dict(e), compact=True) + '\n' for e in events)
+    assert plain.getvalue() == expected
+    assert cached.getvalue() == expected
+
+
+def test_jsonl_buffered_writes():
+    now = [0.0]
+    out = _UnclosedStringIO()
+    writer = serialise.JsonLinesWriter(out, buffer_size=1000, flush_interval=5, clock=lambda: now[0])
+
+    writer.write_item(_task_event({}))
+    assert out.getvalue() == ''
+
+    # Flushed once the interval passes, even with no more items.
+    now[0] = 6
+    writer.flush_if_due()
+    assert out.getvalue().count('\n') == 1
+
+    # ... or once the buffer is full.
+    while out.getvalue().count('\n') == 1:
+        writer.write_item(_task_event({}))
+    assert len(out.getvalue()) >= 1000
+
+    writer.write_item(_task_event({}))
+    with writer:
+        pass
+    assert out.getvalue().endswith('\n')
+    assert all(line.startswith('{') for line in out.getvalue().splitlines())
+
+
+def test_jsonl_fsync(tmpdir):
+    events_path = Path(str(tmpdir)) / 'events.jsonl'
+    with mock.patch('os.fsync') as fsync:
+        with serialise.JsonLinesWriter(events_path.open('a'), durability=serialise.Durability.FSYNC) as writer:
+            writer.write_item(_task_event({}))
+            writer.write_item(_task_event({}))
+    # Once per item, and on exit
+    assert fsync.call_count == 3
+    assert len(events_path.read_text().splitlines()) == 2
@@ -0,0 +1,157 @@
+import os
+import shutil
+from pathlib import Path
+
+from .snapshot import SnapshotStore, take_snapshot
+
+
+def _make_dataset(base: Path, *offset: str) -> Path:
+    d = base.joinpath(*offset)
+    d.mkdir(parents=True)
+    metadata = d.joinpath('ga-metadata.yaml')
+    metadata.write_text('id: test')
+    return metadata
+
+
+def _touch_dir(d: Path):
+    """Make sure the directory mtime changes, regardless of filesystem timestamp resolution"""
+    st = d.stat()
+    os.utime(str(d), ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+
+def _age_dirs(base: Path, seconds=3600):
+    """Make every directory look like it was last modified a while ago"""
+    for d in [base, *(p for p in base.rglob('*') if p.is_dir())]:
+        st = d.stat()
+        os.utime(str(d), ns=(st.st_atime_ns, st.st_mtime_ns - seconds * 1000000000))
+
+
+class _RecordingLog:
+    def __init__(self) -> None:
+        self.events = []
+
+    def debug(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+
+def test_snapshot_matches_glob(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('[0-9][0-9][0-9][0-9]', 'LS*', 'ga-metadata.yaml'))
+
+    expected = {
+        _make_dataset(base, '2016', 'LS8_A'),
+        _make_dataset(base, '2016', 'LS8_B'),
+        _make_dataset(base, '2017', 'LS7_C'),
+    }
+    # Not matching the pattern
+    _make_dataset(base, 'other', 'LS8_D')
+    _make_dataset(base, '2017', '.LS8_hidden')
+    base.joinpath('2017', 'LS8_E').mkdir()
+
+    snap = take_snapshot([pattern])
+    assert set(snap.paths()) == expected
+    assert set(snap.paths()) == set(Path(p) for p in base.glob('[0-9][0-9][0-9][0-9]/LS*/ga-metadata.yaml'))
+
+
+def test_refresh_only_relists_changed_directories(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('*', 'LS*', 'ga-metadata.yaml'))
+
+    a = _make_dataset(base, '2016', 'LS8_A')
+    b = _make_dataset(base, '2017', 'LS8_B')
+
+    first = take_snapshot([pattern])
+    assert set(first.paths()) == {a, b}
+
+    # Nothing changed: the same result, without needing to re-list anything.
+    second = take_snapshot([pattern], previous=first)
+    assert second.datasets == first.datasets
+    assert not second.diff(first)
+
+    # Add a dataset, and remove another.
+    c = _make_dataset(base, '2017', 'LS8_C')
+    _touch_dir(base.joinpath('2017'))
+    shutil.rmtree(str(a.parent))
+    _touch_dir(base.joinpath('2016'))
+
+    third = take_snapshot([pattern], previous=second)
+    assert set(third.paths()) == {b, c}
+
+    diff = third.diff(second)
+    assert [e.path for e in diff.added] == [str(c)]
+    assert [e.path for e in diff.removed] == [str(a)]
+    assert diff.modified == []
+
+
+def test_store_round_trip(tmpdir):
+    base = Path(str(tmpdir)).joinpath('data')
+    pattern = str(base.joinpath('*', 'LS*', 'ga-metadata.yaml'))
+    a = _make_dataset(base, '2016', 'LS8_A')
+
+    store = SnapshotStore(Path(str(tmpdir)).joinpath('snapshots'))
+    assert store.latest() is None
+
+    snap = store.refresh([pattern])
+    assert store.snapshot_ids() == [snap.id]
+    assert store.latest() == snap
+    assert list(store.load(snap.id).paths()) == [a]
+
+
+def test_new_file_in_existing_tile_folder(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('*_*', 'LS8*.nc'))
+
+    tile = base.joinpath('15_-40')
+    tile.mkdir()
+    tile.joinpath('LS8_2016.nc').write_text('')
+    first = take_snapshot([pattern])
+
+    # Tile folders aren't dataset packages: a new file within one is found without its parent changing.
+    tile.joinpath('LS8_2017.nc').write_text('')
+    _touch_dir(tile)
+    second = take_snapshot([pattern], previous=first)
+    assert [e.path for e in second.diff(first).added] == [str(tile.joinpath('LS8_2017.nc'))]
+
+
+def test_refresh_trusts_settled_directories(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('*', 'LS*', 'ga-metadata.yaml'))
+    _make_dataset(base, '2016', 'LS8_A')
+    _make_dataset(base, '2017', 'LS8_B')
+    _age_dirs(base)
+    first = take_snapshot([pattern])
+
+    log = _RecordingLog()
+    second = take_snapshot([pattern], previous=first, log=log)
+    assert second.datasets == first.datasets
+    [(_, stats)] = log.events
+    assert stats['listed_count'] == 0
+
+
+def test_change_within_the_same_mtime(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('*', 'LS*', 'ga-metadata.yaml'))
+    _make_dataset(base, '2017', 'LS8_A')
+    first = take_snapshot([pattern])
+
+    # Added within the same (coarse) mtime as the folder's listing, so the mtime is unchanged.
+    folder = base.joinpath('2017')
+    mtime_ns = first.directories[pattern][str(folder)].mtime_ns
+    b = _make_dataset(base, '2017', 'LS8_B')
+    os.utime(str(folder), ns=(mtime_ns, mtime_ns))
+
+    second = take_snapshot([pattern], previous=first)
+    assert [e.path for e in second.diff(first).added] == [str(b)]
+
+
+def test_deep_finds_modified_datasets(tmpdir):
+    base = Path(str(tmpdir))
+    pattern = str(base.joinpath('*', 'LS*', 'ga-metadata.yaml'))
+    a = _make_dataset(base, '2017', 'LS8_A')
+    _age_dirs(base)
+    first = take_snapshot([pattern])
+
+    # Rewriting a file doesn't change any directory mtime.
+    a.write_text('id: test, changed')
+    assert not take_snapshot([pattern], previous=first).diff(first)
+    assert [e.path for e in take_snapshot([pattern], previous=first, deep=True).diff(first).modified] == [str(a)]
@@ -0,0 +1,113 @@
+import pickle
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from digitalearthau import taskfile
+from digitalearthau.taskfile import Shard, TaskFileWriter
+
+_CONFIG = {'output_type': 'ls8_nbar_albers', 'location': '/g/data/stacked'}
+
+
+def _tasks(count):
+    return [{'tile_index': (i, -i), 'filename': 'tile_{}.nc'.format(i)} for i in range(count)]
+
+
+def test_round_trip(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(10)
+
+    assert taskfile.write_tasks(path, _CONFIG, tasks) == 10
+    assert taskfile.count_tasks(path) == 10
+    assert taskfile.read_task(path, 3) == tasks[3]
+    with pytest.raises(IndexError):
+        taskfile.read_task(path, 10)
+
+    config, loaded = taskfile.load_tasks(path)
+    assert config == _CONFIG
+    assert list(loaded) == tasks
+
+
+def test_no_tasks(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    assert taskfile.write_tasks(path, _CONFIG, []) == 0
+    assert not path.exists()
+    assert not taskfile.index_path(path).exists()
+
+
+def test_shards(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(10)
+    taskfile.write_tasks(path, _CONFIG, tasks)
+
+    shards = [list(taskfile.load_tasks(path, shard=Shard(i, 3))[1]) for i in range(3)]
+    assert shards[1] == [tasks[1], tasks[4], tasks[7]]
+    assert sorted(t['filename'] for shard in shards for t in shard) == sorted(t['filename'] for t in tasks)
+
+
+def test_append(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(6)
+    taskfile.write_tasks(path, _CONFIG, tasks[:4])
+
+    # Simulate an interrupted writer: a trailing half-written record.
+    with path.open('ab') as f:
+        f.write(b'\x00\x00\x00\x00\x00\x00\x01\x00partial')
+
+    with TaskFileWriter(path) as writer:
+        assert writer.count == 4
+        for task in tasks[4:]:
+            writer.write(task)
+
+    config, loaded = taskfile.load_tasks(path)
+    assert config == _CONFIG
+    assert list(loaded) == tasks
+    assert taskfile.count_tasks(path) == 6
+    assert taskfile.read_task(path, 5) == tasks[5]
+
+
+def test_follow_while_writing(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(5)
+    writer = TaskFileWriter(path, _CONFIG)
+
+    def write_slowly():
+        for task in tasks:
+            time.sleep(0.01)
+            writer.write(task)
+        writer.close()
+
+    thread = threading.Thread(target=write_slowly)
+    thread.start()
+    config, loaded = taskfile.load_tasks(path, follow=True, poll_interval=0.005, idle_timeout=10)
+    assert config == _CONFIG
+    assert list(loaded) == tasks
+    thread.join()
+
+
+def test_incomplete_without_follow(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(3)
+    writer = TaskFileWriter(path, _CONFIG)
+    for task in tasks:
+        writer.write(task)
+
+    # Not closed yet: we read what's there.
+    _, loaded = taskfile.load_tasks(path)
+    assert list(loaded) == tasks
+    writer.close()
+
+
+def test_legacy_task_app_files(tmpdir):
+    path = Path(tmpdir) / 'tasks.pickle'
+    tasks = _tasks(4)
+    with path.open('wb') as f:
+        for obj in [_CONFIG] + tasks:
+            pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+
+    assert not taskfile.is_task_file(path)
+    config, loaded = taskfile.load_tasks(path, shard=Shard(0, 2))
+    assert config == _CONFIG
+    assert list(loaded) == [tasks[0], tasks[2]]
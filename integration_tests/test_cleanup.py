@@ -116,12 +116,12 @@ def test_only_clean_up_matching_uuids(run_cleanup,
     assert test_dataset.path.exists(), "Don't clean up if the on-disk UUID is different"
 
 
-@pytest.fixture
-def run_cleanup(global_integration_cli_args, integration_test_data):
+@pytest.fixture(params=[1, 4], ids=['serial', 'parallel'])
+def run_cleanup(request, global_integration_cli_args, integration_test_data):
     # Run cleanup over the integration test data directory
     return functools.partial(
         _call_cleanup,
-        ['archived', str(integration_test_data)],
+        ['archived', '--jobs', request.param, str(integration_test_data)],
         global_integration_cli_args,
     )
 
@@ -121,7 +121,6 @@ def test_nc_move(global_integration_cli_args,
     _check_successful_move(example_nc_dataset, expected_destination, other_dataset, res)
 
 
-@pytest.mark.xfail(reason="Not yet implemented", strict=True)
 def test_move_when_already_exists_at_dest(global_integration_cli_args,
                                           test_dataset: DatasetForTests,
                                           other_dataset: DatasetForTests,
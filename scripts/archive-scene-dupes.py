@@ -4,47 +4,79 @@ Find duplicate scenes by grouping by [path, row, day]
 Chooses the one with children, or else the newest,
 and archives the others.
 """
+from pathlib import Path
 from uuid import UUID
 
 import structlog
-from typing import List, Tuple, Set, Iterable
+from collections import defaultdict
+from typing import Dict, List, NamedTuple, Optional, Tuple, Set, Iterable
 
 from datacube import Datacube
 from datacube.index._api import Index
-from datacube.model import Dataset
+from datacube.utils import uri_to_local_path
+from digitalearthau.index import BatchedIndexWriter
 from digitalearthau.uiutil import init_logging
 
 _LOG = structlog.getLogger()
 
 
+class DuplicateInfo(NamedTuple):
+    """The few fields of a duplicate dataset that we need to choose which to keep"""
+    id: UUID
+    # Ids of its active derived datasets. (Updated as they're archived)
+    child_ids: Set[UUID]
+    ga_label: Optional[str]
+    creation_dt: Optional[str]
+    # The latest local file uri, if any.
+    local_uri: Optional[str]
+
+    @property
+    def has_children(self) -> bool:
+        return bool(self.child_ids)
+
+    @property
+    def local_path(self) -> Optional[Path]:
+        return uri_to_local_path(self.local_uri) if self.local_uri else None
+
+
 def main(dry_run=True):
     init_logging()
     index = Datacube().index
 
-    for group_name, dataset_ids in _find_dupes(index):
-        log = _LOG.bind(duplicate_group=group_name)
-        log.debug("duplicate.found", dataset_ids=dataset_ids)
+    dupes = _find_dupes(index)
+    # Everything we need to choose between the duplicates is fetched up-front, in one query.
+    infos = _get_duplicate_infos(index, [dataset_id for _, dataset_ids in dupes for dataset_id in dataset_ids])
+    parent_ids = _parents_by_child(infos.values())
+
+    with BatchedIndexWriter(index) as index_writer:
+        # Children first: once a duplicate is archived, its parents may no longer have (multiple) children.
+        for group_name, dataset_ids in _order_children_first(dupes, infos):
+            log = _LOG.bind(duplicate_group=group_name)
+            log.debug("duplicate.found", dataset_ids=dataset_ids)
 
-        to_remove = _choose_removable(dataset_ids, index, log)
+            to_remove = _choose_removable(dataset_ids, infos, log)
 
-        if to_remove:
-            removable_ids = [dataset.id for dataset in to_remove]
-            log.info('duplicate.archive', dataset_ids=removable_ids)
-            if not dry_run:
-                index.datasets.archive(removable_ids)
-            for dataset in to_remove:
-                log.info('duplicate.archive_location', dataset_id=dataset.id, uri=dataset.local_uri)
+            if to_remove:
+                removable_ids = [dataset.id for dataset in to_remove]
+                log.info('duplicate.archive', dataset_ids=removable_ids)
                 if not dry_run:
-                    index.datasets.archive_location(dataset.id, dataset.local_uri)
+                    for dataset_id in removable_ids:
+                        index_writer.archive_dataset(dataset_id)
+                        for parent_id in parent_ids[dataset_id]:
+                            infos[str(parent_id)].child_ids.discard(dataset_id)
+                for dataset in to_remove:
+                    log.info('duplicate.archive_location', dataset_id=dataset.id, uri=dataset.local_uri)
+                    if not dry_run:
+                        index_writer.archive_location(dataset.id, dataset.local_uri)
 
 
-def _choose_removable(dataset_ids: List[UUID], index: Index, log) -> List[Dataset]:
+def _choose_removable(dataset_ids: List[UUID], infos: Dict[str, DuplicateInfo], log) -> List[DuplicateInfo]:
     # for each id: does one of them have active children?
-    with_children, without_children = _group_by_has_children(dataset_ids, index)
+    with_children, without_children = _group_by_has_children(dataset_ids, infos)
 
     # If only one has children, it's the one to keep.
     if len(with_children) == 1:
-        return [index.datasets.get(dataset_id) for dataset_id in without_children]
+        return [infos[str(dataset_id)] for dataset_id in without_children]
 
     # If multiple have children, warn and skip for another day.
     # We haven't seen this case yet.
@@ -54,24 +86,24 @@ def _choose_removable(dataset_ids: List[UUID], index: Index, log) -> List[Datase
 
     # Otherwise none have children. Keep the newest.
 
-    datasets = [index.datasets.get(dataset_id) for dataset_id in dataset_ids]
+    datasets = [infos[str(dataset_id)] for dataset_id in dataset_ids]
 
     # Duplicated scenes should have the same label, right?
     # (level 1 could differ in processing level: P41 etc)
-    dataset_labels = set([dataset.metadata_doc['ga_label'] for dataset in datasets])
+    dataset_labels = set([dataset.ga_label for dataset in datasets])
     if len(dataset_labels) != 1:
         log.warn('duplicates.differ', labels=dataset_labels)
         return []
 
     # Keep newest, archive others.
-    datasets.sort(key=lambda d: d.metadata_doc['creation_dt'], reverse=True)
+    datasets.sort(key=lambda d: d.creation_dt, reverse=True)
 
     to_keep = datasets[0]
     to_remove = datasets[1:]
 
     log.debug("duplicate.choosing_newest",
-              keep=to_keep.metadata_doc['creation_dt'],
-              remove=[d.metadata_doc['creation_dt'] for d in to_remove])
+              keep=to_keep.creation_dt,
+              remove=[d.creation_dt for d in to_remove])
 
     if not to_keep.local_path.exists():
         log.warn('newest.not_exist', newest_path=to_keep.local_path)
@@ -80,18 +112,88 @@ def _choose_removable(dataset_ids: List[UUID], index: Index, log) -> List[Datase
     return to_remove
 
 
-def _group_by_has_children(ids: Iterable[UUID], index: Index) -> Tuple[Set[UUID], Set[UUID]]:
+def _group_by_has_children(ids: Iterable[UUID], infos: Dict[str, DuplicateInfo]) -> Tuple[Set[UUID], Set[UUID]]:
     with_children = set()
     without_children = set()
     for dataset_id in ids:
-        derived = index.datasets.get_derived(dataset_id)
-        if any(child.is_active for child in derived):
+        if infos[str(dataset_id)].has_children:
             with_children.add(dataset_id)
         else:
             without_children.add(dataset_id)
     return with_children, without_children
 
 
+def _parents_by_child(infos: Iterable[DuplicateInfo]) -> Dict[UUID, List[UUID]]:
+    """The duplicates that each child dataset is derived from"""
+    parent_ids = defaultdict(list)  # type: Dict[UUID, List[UUID]]
+    for info in infos:
+        for child_id in info.child_ids:
+            parent_ids[child_id].append(info.id)
+    return parent_ids
+
+
+def _order_children_first(dupes: List[Tuple[str, List[UUID]]],
+                          infos: Dict[str, DuplicateInfo]) -> List[Tuple[str, List[UUID]]]:
+    """
+    Sort duplicate groups so that those with children among the other duplicates come after them.
+
+    (eg. pq scenes before the nbar scenes they're derived from, and those before their level1 scenes)
+    """
+    heights = {}  # type: Dict[UUID, int]
+
+    def height(dataset_id: UUID) -> int:
+        # How many levels of duplicates are derived from this one.
+        if dataset_id not in heights:
+            child_heights = [height(c) for c in infos[str(dataset_id)].child_ids if str(c) in infos]
+            heights[dataset_id] = max(child_heights) + 1 if child_heights else 0
+        return heights[dataset_id]
+
+    return sorted(dupes, key=lambda group: max(height(dataset_id) for dataset_id in group[1]))
+
+
+# pylint: disable=protected-access
+# noinspection PyProtectedMember
+def _get_duplicate_infos(index: Index, dataset_ids: List[UUID]) -> Dict[str, DuplicateInfo]:
+    """Get the info of each dataset, by (string) id"""
+    if not dataset_ids:
+        return {}
+
+    with index.datasets._db.begin() as conn:
+        rows = conn._connection.execute("""
+            select
+                d.id,
+                array(
+                    select s.dataset_ref::text
+                    from agdc.dataset_source s
+                      inner join agdc.dataset child on child.id = s.dataset_ref
+                    where s.source_dataset_ref = d.id
+                    and child.archived is null
+                ) as child_ids,
+                d.metadata->>'ga_label' as ga_label,
+                d.metadata->>'creation_dt' as creation_dt,
+                (
+                    -- Latest active file location, as in Dataset.local_uri
+                    select l.uri_scheme || ':' || l.uri_body
+                    from agdc.dataset_location l
+                    where l.dataset_ref = d.id
+                    and l.archived is null
+                    and l.uri_scheme = 'file'
+                    order by l.added desc, l.id desc
+                    limit 1
+                ) as local_uri
+            from agdc.dataset d
+            where d.id = any(%(dataset_ids)s::uuid[])
+        """, dataset_ids=[str(dataset_id) for dataset_id in dataset_ids])
+        return {
+            str(row.id): DuplicateInfo(
+                UUID(str(row.id)),
+                {UUID(str(child_id)) for child_id in row.child_ids},
+                row.ga_label, row.creation_dt, row.local_uri
+            )
+            for row in rows
+        }
+
+
 # Need to expand the api to avoid using sql here (better grouped search).
 # pylint: disable=protected-access
 # noinspection PyProtectedMember
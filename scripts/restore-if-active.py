@@ -7,6 +7,7 @@ import structlog
 
 from datacube.index import Index
 from datacube.ui import click as ui
+from datacube.utils import uri_to_local_path
 from digitalearthau import paths
 
 _LOG = structlog.get_logger()
@@ -15,9 +16,20 @@ _LOG = structlog.get_logger()
 @click.command()
 @ui.config_option
 @click.option('--dry-run', is_flag=True, default=False)
+@click.option('--journal', 'journal_path',
+              type=click.Path(exists=True, dir_okay=False, readable=True),
+              help="Replay a trash journal (eg. .trash/2018-01-01/trash-journal.jsonl) "
+                   "rather than scanning the trash folder")
 @ui.pass_index(expect_initialised=False)
-@click.argument('trash_path', type=click.Path(exists=True, readable=True, writable=True))
-def restore(index: Index, trash_path: str, dry_run: bool):
+@click.argument('trash_path', type=click.Path(exists=True, readable=True, writable=True), required=False)
+def restore(index: Index, trash_path: str, dry_run: bool, journal_path: str):
+    if journal_path:
+        _restore_journal(index, Path(journal_path), dry_run)
+        return
+
+    if not trash_path:
+        raise click.UsageError("Either a trash path or a --journal is required")
+
     trash_base = Path(trash_path)
     assert trash_base.exists()
 
@@ -30,6 +42,58 @@ def restore(index: Index, trash_path: str, dry_run: bool):
                 Path(trashed_nc).rename(restorable_path)
 
 
+def _restore_journal(index: Index, journal_path: Path, dry_run: bool):
+    # Undo the most recent moves first.
+    for move in reversed(list(paths.read_trash_journal(journal_path))):
+        if not move.trash_path.exists():
+            _LOG.debug("trash.skip.not_in_trash", trash_path=move.trash_path)
+            continue
+
+        if _should_restore_move(index, move):
+            _LOG.info("trash.restore", trash_path=move.trash_path, original_path=move.original_path)
+            if not dry_run:
+                move.trash_path.rename(move.original_path)
+
+
+def _trashed_metadata_path(move: paths.TrashMove) -> Path:
+    """Where the dataset's metadata is now"""
+    metadata_path = uri_to_local_path(move.uri)
+    try:
+        # The location is within the trashed path (eg. the metadata file of a package folder)
+        return move.trash_path.joinpath(metadata_path.relative_to(move.original_path))
+    except ValueError:
+        # Sibling metadata (eg. "X.tif.ga-md.yaml" for "X.tif"): it sits beside the trashed file, and
+        # is only trashed along with it if something else moved it.
+        trashed_sibling = move.trash_path.parent.joinpath(metadata_path.name)
+        return trashed_sibling if trashed_sibling.exists() else metadata_path
+
+
+def _should_restore_move(index: Index, move: paths.TrashMove) -> bool:
+    trashed_file = _trashed_metadata_path(move)
+    if not trashed_file.exists():
+        _LOG.debug("trash.skip.no_metadata", metadata_path=trashed_file)
+        return False
+
+    # There's something else in the location?
+    if move.original_path.exists():
+        _LOG.debug("trash.skip.original_exists", original_path=move.original_path)
+        return False
+
+    for dataset_id in paths.get_path_dataset_ids(trashed_file):
+        dataset = index.datasets.get(dataset_id)
+
+        if dataset is None or dataset.is_archived:
+            _LOG.debug("dataset.skip.archived", dataset_id=dataset_id)
+            continue
+        if move.uri not in dataset.uris:
+            _LOG.debug("dataset.skip.unknown_location", dataset_id=dataset.id)
+            continue
+
+        # We've found an indexed, active dataset in the trashed path, so restore.
+        return True
+    return False
+
+
 def _should_restore(index, trashed_nc):
     dataset_ids = paths.get_path_dataset_ids(trashed_nc)
     original_path = paths.get_original_path(trashed_nc)
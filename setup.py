@@ -55,6 +55,7 @@ setup(
 
     entry_points={
         'console_scripts': [
+            'dea-checksum = digitalearthau.checksum:cli',
             'dea-clean = digitalearthau.cleanup:cli',
             'dea-coherence = digitalearthau.coherence:main',
             'dea-duplicates = digitalearthau.duplicates:cli',